@@ -0,0 +1,53 @@
+"""
+Measure the cost of flushing karma awards for rounds with many winning voters
+
+Usage: python benchmarks/bench_karma.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from karma_store import KarmaStore
+
+ROUND_SIZES = [100, 1000, 5000, 20000]
+ROUNDS = 20
+
+def bench_flush(store, voters):
+    """Award one round of voters and time the flush that writes it"""
+    store.award(str(user_id) for user_id in range(voters))
+    start = time.perf_counter()
+    store.flush()
+    return time.perf_counter() - start
+
+def bench_rowwise(store, voters):
+    """Time the naive approach: one committed UPDATE per winning voter"""
+    start = time.perf_counter()
+    for user_id in range(voters):
+        with store._db:
+            store._db.execute(
+                "INSERT INTO karma (user_id, points) VALUES (?, 1) "
+                "ON CONFLICT(user_id) DO UPDATE SET points = points + 1",
+                (str(user_id),),
+            )
+    return time.perf_counter() - start
+
+def main():
+    print(f"{'voters':>8} {'batched flush':>15} {'per voter':>12} {'row-by-row':>12}")
+    for voters in ROUND_SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            store = KarmaStore(os.path.join(directory, 'karma.db'))
+            batched = min(bench_flush(store, voters) for _ in range(ROUNDS))
+            rowwise = bench_rowwise(store, min(voters, 2000)) * voters / min(voters, 2000)
+            start = time.perf_counter()
+            for _ in range(1000):
+                store.get(str(voters // 2))
+            reads = (time.perf_counter() - start) / 1000
+            store.close()
+        print(f"{voters:>8} {batched * 1000:>12.2f} ms {batched / voters * 1e6:>9.2f} us {rowwise * 1000:>9.1f} ms")
+    print(f"cached read: {reads * 1e9:.0f} ns")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Measure the per-guild karma leaderboard with a million users
+
+Builds a Leaderboard with random totals, then times awards (a round's worth
+of winning voters), top-N queries and rank lookups, against the naive
+approach of sorting every total for each query.
+
+Usage: python benchmarks/bench_leaderboard.py [users]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from leaderboard import Leaderboard
+
+ROUND_VOTERS = 1000
+QUERIES = 1000
+TOP_N = 10
+
+def timed(function, repeat):
+    """Average seconds per call of function over repeat calls"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+def main(users):
+    rng = random.Random(7)
+    totals = {str(user_id): rng.randint(0, 5000) for user_id in range(users)}
+
+    start = time.perf_counter()
+    board = Leaderboard(totals)
+    built = time.perf_counter() - start
+
+    user_ids = list(totals)
+    award = timed(lambda: board.add(rng.choice(user_ids), 1), ROUND_VOTERS * 10)
+    top = timed(lambda: board.top(TOP_N), QUERIES)
+    rank = timed(lambda: board.rank(rng.choice(user_ids)), QUERIES)
+
+    # The naive approach: sort everything for each query
+    def sorted_top():
+        return sorted(board.points.items(), key=lambda item: (-item[1], item[0]))[:TOP_N]
+
+    def scanned_rank():
+        points = board.points[rng.choice(user_ids)]
+        return sum(1 for other in board.points.values() if other > points) + 1
+
+    naive_top = timed(sorted_top, 3)
+    naive_rank = timed(scanned_rank, 3)
+
+    user_id = rng.choice(user_ids)
+    assert board.top(TOP_N) == sorted_top()
+    assert board.rank(user_id) == sum(1 for other in board.points.values() if other > board.points[user_id]) + 1
+
+    print(f"{users} users, index built in {built:.2f} s")
+    print(f"{'operation':<12} {'indexed':>12} {'sort/scan':>12}")
+    print(f"{'award':<12} {award * 1e6:>9.2f} us {'-':>12}")
+    print(f"{'top ' + str(TOP_N):<12} {top * 1e6:>9.2f} us {naive_top * 1000:>9.1f} ms")
+    print(f"{'rank':<12} {rank * 1e6:>9.2f} us {naive_rank * 1000:>9.1f} ms")
+    print(f"a round of {ROUND_VOTERS} winning voters: {award * ROUND_VOTERS * 1000:.2f} ms")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
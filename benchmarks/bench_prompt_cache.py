@@ -0,0 +1,82 @@
+"""
+Measure what prompt prefix caching saves per round, against the fake Gemini server
+
+Plays one story for R rounds twice through gemini_api over REST: once sending
+every prompt in full and once with the settled prefix cached. Each round's
+prompt is built the way continue_story builds it (guidelines, then the
+settled history, then the latest segment). Prints input tokens, cached
+tokens and latency per round, then totals.
+
+Usage: python benchmarks/bench_prompt_cache.py [rounds]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fake_gemini
+
+SERVER = fake_gemini.start()
+
+# gemini_api and prompt_cache read these at import time
+os.environ['GEMINI_API_KEY'] = 'fake'
+os.environ['GEMINI_TRANSPORT'] = 'rest'
+os.environ['GEMINI_API_ENDPOINT'] = f"http://127.0.0.1:{SERVER.server_address[1]}"
+os.environ.setdefault('PROMPT_CACHE_MIN_TOKENS', '1024')
+
+from gemini_api import GeminiClient
+from prompt_cache import PromptCache
+from story_context import StoryContext
+
+# Stands in for bot.CONTINUE_GUIDELINES (bot.py needs discord installed); about 1,000 tokens
+GUIDELINES = "Continue the roleplay story following these guidelines.\n" + "Keep the tone consistent. " * 150 + "\n\n"
+
+# Each segment the fake model writes is padded to about this many characters of history
+SEGMENT_CHARS = 2400
+
+async def play(client, rounds, cache_key):
+    context = StoryContext(recent_segments=rounds, token_budget=1_000_000)
+    context.add_segment(fake_gemini.SEGMENT.ljust(SEGMENT_CHARS))
+    results = []
+    for _ in range(rounds):
+        context.record_choice("**A)** Follow the footsteps into the cellar")
+        settled, latest = context.build_split()
+        prompt = f"{GUIDELINES}{settled}{latest}\n\nNow continue the story from the group's latest choice."
+
+        started = time.perf_counter()
+        text, usage = await client.generate_with_usage(prompt, cache_key=cache_key,
+                                                       stable_chars=len(GUIDELINES) + len(settled))
+        results.append(dict(usage, latency=time.perf_counter() - started))
+        context.add_segment(text.ljust(SEGMENT_CHARS))
+    return results
+
+def print_results(label, results):
+    print(f"\n{label}")
+    print(f"{'round':>5} {'input':>8} {'cached':>8} {'latency':>9}")
+    for number, result in enumerate(results, 1):
+        print(f"{number:>5} {result['prompt_tokens']:>8} {result['cached_tokens']:>8} {result['latency'] * 1000:>7.0f}ms")
+    input_tokens = sum(result["prompt_tokens"] for result in results)
+    cached_tokens = sum(result["cached_tokens"] for result in results)
+    latency = sum(result["latency"] for result in results)
+    print(f"total: {input_tokens} input tokens, {cached_tokens} cached ({cached_tokens / input_tokens:.0%}), "
+          f"{latency:.2f}s")
+    return input_tokens - cached_tokens, latency
+
+async def run(rounds):
+    uncached = await play(GeminiClient(), rounds, cache_key=None)
+
+    cache = PromptCache()
+    cached = await play(GeminiClient(prompt_cache=cache), rounds, cache_key="bench")
+    cache.close()
+
+    sent_plain, latency_plain = print_results("Without prompt cache", uncached)
+    sent_cached, latency_cached = print_results("With prompt cache", cached)
+    print(f"\nuncached input tokens sent: {sent_plain} -> {sent_cached} "
+          f"({1 - sent_cached / sent_plain:.0%} fewer); latency {latency_plain:.2f}s -> {latency_cached:.2f}s")
+    print(f"caches created: {cache.created}, fake server caches left: {len(SERVER.gemini.caches)}")
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    asyncio.run(run(rounds))
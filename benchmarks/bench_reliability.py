@@ -0,0 +1,103 @@
+"""
+Check the Gemini call policy against a fake backend with injected latency and faults
+
+Sends the same stream of requests through reliability.CallPolicy under
+several configurations: a single attempt, retries, and retries with
+hedging. The fake backend's latency is lognormal with a slow tail, some
+requests fail with a retryable 503, and the middle of the run is a full
+outage so the circuit breaker has something to do. Runs on loadsim's
+virtual clock, so a long run takes a moment.
+
+Reports success rate, p50/p99 latency, retries, hedges (against the budget)
+and requests the breaker refused.
+
+Usage: python benchmarks/bench_reliability.py [requests]
+"""
+import asyncio
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from loadsim import VirtualClockLoop, percentile
+from reliability import CallPolicy, CircuitBreaker
+
+MEDIAN_LATENCY = 1.5
+SIGMA = 0.3
+TAIL_RATE = 0.03
+TAIL_LATENCY = 20.0
+FAULT_RATE = 0.05
+# Share of the run (by request number) during which every request fails
+OUTAGE = (0.45, 0.5)
+REQUEST_INTERVAL = 0.2
+
+class ServiceUnavailable(Exception):
+    code = 503
+
+class FakeBackend:
+    """Answers after a sampled latency, or fails"""
+
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.outage = False
+
+    async def call(self):
+        self.calls += 1
+        latency = self.random.lognormvariate(math.log(MEDIAN_LATENCY), SIGMA)
+        if self.random.random() < TAIL_RATE:
+            latency += TAIL_LATENCY
+        await asyncio.sleep(latency * self.random.uniform(0.1, 1.0) if self.outage else latency)
+        if self.outage or self.random.random() < FAULT_RATE:
+            raise ServiceUnavailable("503 Service Unavailable")
+        return "ok"
+
+async def run(name, requests, **policy_options):
+    loop = asyncio.get_event_loop()
+    backend = FakeBackend(seed=7)
+    policy = CallPolicy(breaker=CircuitBreaker(threshold=5, reset_after=10), **policy_options)
+    latencies = []
+    outcomes = {"ok": 0, "failed": 0, "refused": 0}
+
+    async def one():
+        started = loop.time()
+        try:
+            await policy.run(lambda: policy.timed(backend.call()))
+        except Exception as e:
+            outcomes["refused" if type(e).__name__ == "CircuitOpenError" else "failed"] += 1
+            return
+        outcomes["ok"] += 1
+        latencies.append(loop.time() - started)
+
+    tasks = []
+    for number in range(requests):
+        backend.outage = OUTAGE[0] <= number / requests < OUTAGE[1]
+        tasks.append(asyncio.ensure_future(one()))
+        await asyncio.sleep(REQUEST_INTERVAL)
+    await asyncio.gather(*tasks)
+
+    stats = policy.report()
+    print(f"{name:<16} {outcomes['ok'] / requests:>7.1%} {percentile(latencies, 0.5):>7.2f}s "
+          f"{percentile(latencies, 0.99):>7.2f}s {stats['retries']:>8} {stats['hedges']:>7} "
+          f"{stats['hedge_wins']:>5} {outcomes['refused']:>8} {backend.calls / requests:>10.2f}")
+
+async def main(requests):
+    print(f"{requests} requests, {FAULT_RATE:.0%} faults, {TAIL_RATE:.0%} slow by {TAIL_LATENCY:.0f}s, "
+          f"outage for {OUTAGE[1] - OUTAGE[0]:.0%} of the run")
+    print(f"{'policy':<16} {'success':>7} {'p50':>8} {'p99':>8} {'retries':>8} {'hedges':>7} {'wins':>5} "
+          f"{'refused':>8} {'calls/req':>10}")
+    await run("single attempt", requests, deadline=30, retries=0, hedge=False)
+    await run("deadline+retry", requests, deadline=8, retries=2, hedge=False)
+    await run("retry+hedge", requests, deadline=8, retries=2, hedge=True, hedge_budget=0.05)
+    await run("retry+hedge 10%", requests, deadline=8, retries=2, hedge=True, hedge_budget=0.10)
+    # Let cancelled hedges finish unwinding
+    await asyncio.sleep(1)
+
+if __name__ == '__main__':
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    loop = VirtualClockLoop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main(requests))
+    loop.close()
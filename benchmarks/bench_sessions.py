@@ -0,0 +1,70 @@
+"""
+Measure how many concurrent story sessions one event loop can hold
+
+Runs N sessions through R rounds each with a stand-in round handler and
+reports memory per session and how late votes close compared with their
+deadlines. Each vote's deadline is moved a number of times while it is open,
+the way reactions move it when votes close early.
+
+Usage: python benchmarks/bench_sessions.py [sessions] [rounds]
+"""
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from session_engine import SessionEngine
+
+VOTING_DURATION = 1.0
+# Deadline moves per vote, standing in for reactions arriving
+RESCHEDULES = 20
+
+async def run(sessions, rounds):
+    lateness = []
+    finished = asyncio.Event()
+
+    async def run_round(session):
+        lateness.append(asyncio.get_event_loop().time() - session.deadline)
+        # Replace the round's state the way the bot does
+        session.begin_vote(object(), "🅰️", "🅱️", "Go left", "Go right")
+        return session.rounds < rounds
+
+    def on_end(session):
+        if not engine.sessions:
+            finished.set()
+
+    def on_vote_open(session):
+        for step in range(RESCHEDULES):
+            engine.move_deadline(session, session.opened + VOTING_DURATION * (1 - step / (2 * RESCHEDULES)))
+
+    engine = SessionEngine(run_round, on_end=on_end, on_vote_open=on_vote_open, voting_duration=VOTING_DURATION)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for channel in range(sessions):
+        session = engine.open(str(channel), channel=None)
+        session.begin_vote(object(), "🅰️", "🅱️", "Go left", "Go right")
+        engine.schedule_vote(session)
+    per_session = (tracemalloc.get_traced_memory()[0] - baseline) / sessions
+
+    start = time.perf_counter()
+    await asyncio.sleep(VOTING_DURATION * rounds / 2)
+    mid_round = (tracemalloc.get_traced_memory()[0] - baseline) / sessions
+    await finished.wait()
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+
+    lateness.sort()
+    print(f"sessions: {sessions}, rounds each: {rounds}")
+    print(f"memory per session: {per_session:.0f} B at start, {mid_round:.0f} B mid-run")
+    print(f"rounds/sec: {sessions * rounds / elapsed:.0f}")
+    print(f"vote close lateness p50: {lateness[len(lateness) // 2] * 1000:.2f} ms, "
+          f"p99: {lateness[int(len(lateness) * 0.99)] * 1000:.2f} ms")
+
+if __name__ == '__main__':
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    asyncio.run(run(sessions, rounds))
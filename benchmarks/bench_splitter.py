@@ -0,0 +1,154 @@
+"""
+Compare message_handler's splitter with the string-concatenation splitter it replaced
+
+Each input is about 100 KB. Besides time, the table shows how much
+formatting each splitter breaks (chunks that cut a **bold** span, and quoted
+lines that lose their "> ") and how many chunks are over Discord's limit. The streamed column feeds the same text in 40-character
+fragments through MessageSplitter, as StreamingMessage does.
+
+Usage: python benchmarks/bench_splitter.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from message_handler import split_message, iter_chunks
+
+INPUT_SIZE = 100_000
+CHAR_LIMIT = 2000
+REPEATS = 20
+
+# split_message as it was before MessageSplitter, copied unchanged for comparison
+def legacy_split_message(content, char_limit=2000):
+    """
+    Split a long message into multiple smaller messages to fit within Discord's character limit
+    
+    Args:
+        content (str): The message content to split
+        char_limit (int): The character limit for each message (Discord's limit is 2000)
+        
+    Returns:
+        list: A list of message chunks, each within the character limit
+    """
+    # If the content is already within the limit, return it as a single-item list
+    if len(content) <= char_limit:
+        return [content]
+    
+    # Split the message into chunks
+    chunks = []
+    current_chunk = ""
+    
+    # Try to split at paragraph breaks first
+    paragraphs = content.split('\n\n')
+    
+    for paragraph in paragraphs:
+        # If adding this paragraph would exceed the limit, add the current chunk to chunks
+        # and start a new chunk with this paragraph
+        if len(current_chunk) + len(paragraph) + 2 > char_limit:
+            # If the current chunk is not empty, add it to chunks
+            if current_chunk:
+                chunks.append(current_chunk)
+                current_chunk = paragraph
+            else:
+                # If this single paragraph is too long, split it by sentences
+                sentences = paragraph.replace('. ', '.\n').split('\n')
+                for sentence in sentences:
+                    if len(current_chunk) + len(sentence) + 1 > char_limit:
+                        if current_chunk:
+                            chunks.append(current_chunk)
+                            current_chunk = sentence
+                        else:
+                            # If a single sentence is too long, split it by words
+                            words = sentence.split(' ')
+                            for word in words:
+                                if len(current_chunk) + len(word) + 1 > char_limit:
+                                    chunks.append(current_chunk)
+                                    current_chunk = word
+                                else:
+                                    current_chunk += ' ' + word if current_chunk else word
+                    else:
+                        current_chunk += '\n' + sentence if current_chunk else sentence
+        else:
+            # Add paragraph separator if current_chunk is not empty
+            current_chunk += '\n\n' + paragraph if current_chunk else paragraph
+    
+    # Add the last chunk if it's not empty
+    if current_chunk:
+        chunks.append(current_chunk)
+    
+    return chunks
+
+
+def make_inputs():
+    """Build ~100 KB story-like inputs with different shapes"""
+    rng = random.Random(0)
+    words = ["the", "storm", "gathered", "over", "**Captain Mira**", "*silently*", "ship", "sails", "said", "\"*hold fast*\"", "and", "waves"]
+
+    def sentence():
+        return " ".join(rng.choice(words) for _ in range(rng.randint(6, 20))).capitalize() + "."
+
+    def paragraph(sentences=(2, 8)):
+        return " ".join(sentence() for _ in range(rng.randint(*sentences)))
+
+    def bold_sentences():
+        # Long paragraphs where bold spans run over several sentences
+        return " ".join(
+            f"{paragraph()} **{paragraph((2, 4)).replace('*', '')}**" for _ in range(rng.randint(4, 8))
+        )
+
+    def fill(make, separator):
+        parts = []
+        size = 0
+        while size < INPUT_SIZE:
+            parts.append(make())
+            size += len(parts[-1]) + len(separator)
+        return separator.join(parts)
+
+    return {
+        "paragraphs": fill(paragraph, "\n\n"),
+        "one paragraph": fill(sentence, " "),
+        "bold sentences": fill(bold_sentences, "\n\n"),
+        "quoted lines": fill(lambda: "> " + paragraph(), "\n"),
+    }
+
+def best_time(function, *args):
+    """Best of REPEATS runs, in seconds"""
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def streamed(text):
+    return list(iter_chunks((text[i:i + 40] for i in range(0, len(text), 40)), CHAR_LIMIT))
+
+def broken(chunks, quoted):
+    """Chunks that cut a bold span, plus lines of an all-quoted input that lost their "> " """
+    count = sum(chunk.count("**") % 2 for chunk in chunks)
+    if quoted:
+        count += sum(not line.startswith(">") for chunk in chunks for line in chunk.split("\n"))
+    return count
+
+def oversized(chunks):
+    return sum(len(chunk) > CHAR_LIMIT for chunk in chunks)
+
+def main():
+    print(f"{'input':>16} {'old':>9} {'new':>9} {'streamed':>9}   {'broken old/new':>14} {'over limit old/new':>18}")
+    for name, text in make_inputs().items():
+        quoted = text.startswith(">")
+        old_chunks = legacy_split_message(text, CHAR_LIMIT)
+        new_chunks = split_message(text, CHAR_LIMIT)
+        old = best_time(legacy_split_message, text, CHAR_LIMIT)
+        new = best_time(split_message, text, CHAR_LIMIT)
+        stream = best_time(streamed, text)
+        print(
+            f"{name:>16} {old * 1000:>6.2f} ms {new * 1000:>6.2f} ms {stream * 1000:>6.2f} ms   "
+            f"{broken(old_chunks, quoted):>6} / {broken(new_chunks, quoted):<6} {oversized(old_chunks):>9} / {oversized(new_chunks):<6}"
+        )
+
+if __name__ == '__main__':
+    main()
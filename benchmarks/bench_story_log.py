@@ -0,0 +1,100 @@
+"""
+Measure memory and disk use of story history with the segment log
+
+Plays a short story in each of N channels, keeping history the way bot.py
+does (a StoryContext per running story, every segment appended to the
+StoryLog), then lets every story go idle and be evicted. Memory is traced
+as channels are added and after eviction, against keeping every segment of
+every channel in memory. Then replays one long story through
+StoryLog.replay and reports the peak memory that took.
+
+Usage: python benchmarks/bench_story_log.py [channels]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from story_context import StoryContext
+from story_log import StoryLog, SEGMENT, CHOICE
+
+ROUNDS = 12
+LONG_STORY_ROUNDS = 500
+
+SEGMENT_TEXT = (
+    "*The lantern gutters as the door swings shut behind you.*\n\n"
+    "**Mira** presses her back to the wall, listening to the footsteps fade. "
+    "Somewhere below, water drips onto stone, and the smell of old smoke hangs in the stairwell. "
+    "\"*They knew we were coming,*\" she breathes, turning the brass key over in her fingers. "
+) * 6 + "\n\n**A)** Follow the footsteps into the cellar\n**B)** Bar the door and search the study"
+
+def play(context, log, channel_id, rounds):
+    """One story's worth of segments and choices"""
+    for number in range(rounds):
+        segment = f"Round {number}. {SEGMENT_TEXT}"
+        context.add_segment(segment)
+        log.append(channel_id, SEGMENT, segment)
+        context.record_choice("**A)** Follow the footsteps into the cellar")
+        log.append(channel_id, CHOICE, "**A)** Follow the footsteps into the cellar")
+
+def megabytes(size):
+    return size / (1024 * 1024)
+
+async def replay_peak(log, channel_id):
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    records = 0
+    async for _ in log.replay(channel_id):
+        records += 1
+    return records, tracemalloc.get_traced_memory()[1] - before
+
+def main(channels):
+    with tempfile.TemporaryDirectory() as directory:
+        log = StoryLog(directory)
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+        # Without a summarizer StoryContext keeps only the recent segments, as it does once summaries land;
+        # "all in RAM" is what holding every segment of every story would take
+        story_history = {}
+        start = time.perf_counter()
+        print(f"{'running stories':>15} {'with log':>10} {'all in RAM':>11}")
+        for number in range(channels):
+            channel_id = str(number)
+            context = story_history[channel_id] = StoryContext()
+            play(context, log, channel_id, ROUNDS)
+            if (number + 1) % (channels // 5) == 0:
+                log.flush()
+                everything_size = ROUNDS * len(SEGMENT_TEXT) * (number + 1)
+                current = tracemalloc.get_traced_memory()[0] - baseline
+                print(f"{number + 1:>15} {megabytes(current):>7.1f} MB {megabytes(everything_size):>8.1f} MB")
+        log.flush()
+        elapsed = time.perf_counter() - start
+
+        # Every story goes idle and is evicted, as evict_idle does
+        cutoff = time.monotonic()
+        for channel_id, context in list(story_history.items()):
+            if context.last_active <= cutoff:
+                story_history.pop(channel_id).close()
+        idle = tracemalloc.get_traced_memory()[0] - baseline
+        print(f"{channels} idle channels after eviction: {megabytes(idle):.2f} MB")
+
+        appends = channels * ROUNDS * 2
+        print(f"{appends} records logged in {elapsed:.2f} s ({elapsed / appends * 1e6:.1f} us each, "
+              f"including StoryContext); compressed to {log.bytes_out / log.bytes_in:.0%} of "
+              f"{megabytes(log.bytes_in):.1f} MB")
+
+        long_story = "long"
+        play(StoryContext(), log, long_story, LONG_STORY_ROUNDS)
+        log.flush()
+        records, peak = asyncio.run(replay_peak(log, long_story))
+        print(f"replaying {records} records ({megabytes(LONG_STORY_ROUNDS * len(SEGMENT_TEXT)):.1f} MB of story) "
+              f"peaked at {megabytes(peak) * 1024:.0f} KB")
+        log.close()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
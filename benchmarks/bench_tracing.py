@@ -0,0 +1,50 @@
+"""
+Measure what round tracing costs, with tracing off and on
+
+Runs a stand-in round with the same number of spans and recorded requests
+as continue_story, with no real work in between, so the timings are pure
+tracing overhead per round.
+
+Usage: python benchmarks/bench_tracing.py [rounds]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tracing
+
+STAGES = ("tally", "emoji", "generate", "parse", "split", "send", "emoji", "react")
+REQUESTS = ("gemini:queue", "gemini:request", "discord:send", "discord:send", "discord:react", "discord:react")
+
+@tracing.traced("continue", lambda channel_id: channel_id)
+async def play_round(channel_id):
+    for stage in STAGES:
+        with tracing.span(stage):
+            pass
+    for name in REQUESTS:
+        tracing.record(name, time.monotonic(), 0.0)
+    return True
+
+async def run(rounds):
+    start = time.perf_counter()
+    for number in range(rounds):
+        await play_round(str(number % 100))
+    return (time.perf_counter() - start) / rounds
+
+def main(rounds):
+    baseline = asyncio.run(run(rounds))
+    with tempfile.TemporaryDirectory() as directory:
+        tracing.TRACE_PATH = os.path.join(directory, 'trace.jsonl')
+        traced = asyncio.run(run(rounds))
+        tracing.close()
+        size = os.path.getsize(tracing.TRACE_PATH) / rounds
+    print(f"{len(STAGES)} spans and {len(REQUESTS)} recorded requests per round")
+    print(f"tracing off: {baseline * 1e6:.1f} us per round")
+    print(f"tracing on:  {traced * 1e6:.1f} us per round, {size:.0f} bytes of trace")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
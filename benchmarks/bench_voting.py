@@ -0,0 +1,89 @@
+"""
+Compare the fixed voting window with the adaptive voting policy
+
+Simulates stories with a few players each. Every round, each player shows
+up with some probability and votes after a lognormal delay; late votes
+past the window are lost either way. Each round is closed once with the
+fixed VOTING_DURATION and once with voting_policy.VotingPolicy fed the same
+reactions, and the benchmark reports the distribution of vote durations, why
+adaptive votes closed, rounds per hour (including generation time), and how
+often closing early picked a different winner than the full window would.
+
+Usage: python benchmarks/bench_voting.py [stories]
+"""
+import math
+import os
+import random
+import sys
+from collections import Counter, deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from session_engine import RECENT_ROUNDS
+from voting_policy import VotingPolicy, expected_players
+
+VOTING_DURATION = 60
+ROUNDS = 20
+PLAYER_COUNTS = (1, 2, 3, 4, 6, 8)
+TURNOUT = 0.85
+MEDIAN_DELAY = 12.0
+DELAY_SIGMA = 0.8
+# Seconds to generate and post the next segment, added to every round
+GENERATION = 6.0
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+def winner(votes, until):
+    a = sum(1 for time, _, choice in votes if time <= until and choice == 'a')
+    b = sum(1 for time, _, choice in votes if time <= until and choice == 'b')
+    return 'a' if a > b else 'b' if b > a else 'tie'
+
+def close_adaptive(policy, votes, expected):
+    """When the policy closes a round with these (time, player, choice) votes, and why"""
+    voters = {'a': set(), 'b': set()}
+    deadline, reason = policy.decide(set(), set(), set(), expected, 0.0, 0.0)
+    for time, player, choice in votes:
+        if time >= deadline:
+            break
+        voters[choice].add(player)
+        deadline, reason = policy.decide(voters['a'], voters['b'], voters['a'] | voters['b'], expected, 0.0, time)
+        deadline = max(deadline, time)
+    return deadline, reason
+
+def main(stories):
+    rng = random.Random(11)
+    policy = VotingPolicy(VOTING_DURATION)
+    fixed, adaptive, reasons = [], [], Counter()
+    changed = 0
+    for _ in range(stories):
+        players = range(rng.choice(PLAYER_COUNTS))
+        bias = rng.uniform(0.3, 0.7)
+        participants = deque(maxlen=RECENT_ROUNDS)
+        for _ in range(ROUNDS):
+            votes = sorted(
+                (rng.lognormvariate(math.log(MEDIAN_DELAY), DELAY_SIGMA), player, 'a' if rng.random() < bias else 'b')
+                for player in players if rng.random() < TURNOUT
+            )
+            votes = [vote for vote in votes if vote[0] < VOTING_DURATION]
+            closed, reason = close_adaptive(policy, votes, expected_players(participants))
+            fixed.append(VOTING_DURATION)
+            adaptive.append(closed)
+            reasons[reason] += 1
+            if winner(votes, closed) != winner(votes, VOTING_DURATION):
+                changed += 1
+            participants.append({player for time, player, _ in votes if time <= closed})
+
+    rounds = len(fixed)
+    print(f"{stories} stories, {rounds} rounds, {GENERATION:.0f}s generation per round")
+    print(f"{'window':<10} {'p50':>6} {'p90':>6} {'mean':>6} {'rounds/hour':>12}")
+    for name, durations in (("fixed", fixed), ("adaptive", adaptive)):
+        mean = sum(durations) / rounds
+        print(f"{name:<10} {percentile(durations, 0.5):>5.1f}s {percentile(durations, 0.9):>5.1f}s {mean:>5.1f}s "
+              f"{3600 / (mean + GENERATION):>12.1f}")
+    print("adaptive votes closed on: " + ", ".join(f"{reason} {count / rounds:.0%}" for reason, count in reasons.most_common()))
+    print(f"winner differed from the full window in {changed / rounds:.1%} of rounds")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
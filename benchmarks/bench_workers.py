@@ -0,0 +1,105 @@
+"""
+Load test: round throughput as the number of worker processes grows
+
+Each worker runs its share of story sessions on its own event loop with a
+stand-in round (emoji matching, context building, message splitting, karma
+awards) and checkpoints every vote to one shared session database, with
+karma flushed in the background to one shared karma database, the way
+launcher.py workers do. Generation is simulated with a fixed delay.
+
+Usage: python benchmarks/bench_workers.py [max_workers] [seconds]
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+SESSIONS_PER_WORKER = 200
+GENERATION_DELAY = 0.01
+SEGMENT = ("*The wind howls through the ruined tower.* **Mira** grips her sword. " * 40
+           + "\n\n**A)** Climb the tower and search for the key\n**B)** Hide in the cave and wait for night")
+
+def worker(worker_id, directory, seconds, results):
+    from emoji_handler import get_relevant_emojis, describe_many
+    from karma_store import KarmaStore
+    from message_handler import split_message
+    from session_engine import SessionEngine
+    from shared_state import SessionStore
+    from story_context import StoryContext
+
+    async def main():
+        store = SessionStore(os.path.join(directory, 'sessions.db'), worker_id=f"worker-{worker_id}")
+        karma = KarmaStore(os.path.join(directory, 'karma.db'))
+        karma.start()
+        contexts = {}
+        rounds = 0
+
+        async def run_round(session):
+            nonlocal rounds
+            context = contexts[session.channel_id]
+            context.record_choice(f"**A)** {session.option_a}")
+            context.build()
+            describe_many(["🔥", "🐉"])
+            await asyncio.sleep(GENERATION_DELAY)
+            context.add_segment(SEGMENT)
+            split_message(SEGMENT * 2)
+            get_relevant_emojis("Climb the tower and search for the key", "Hide in the cave and wait for night")
+            karma.award(str(user_id) for user_id in range(20))
+            session.begin_vote(None, "🧗", "🙈", "Climb the tower", "Hide in the cave")
+            rounds += 1
+            return True
+
+        def checkpoint(session):
+            state = {"rounds": session.rounds, "story": contexts[session.channel_id].to_dict()}
+            asyncio.ensure_future(store.save(session.channel_id, None, state))
+
+        engine = SessionEngine(run_round, on_vote_open=checkpoint, voting_duration=0)
+        for channel in range(SESSIONS_PER_WORKER):
+            channel_id = f"{worker_id}-{channel}"
+            contexts[channel_id] = StoryContext()
+            contexts[channel_id].add_segment(SEGMENT)
+            session = engine.open(channel_id, None)
+            session.begin_vote(None, "🧗", "🙈", "Climb the tower", "Hide in the cave")
+            engine.schedule_vote(session)
+
+        await asyncio.sleep(seconds)
+        results.put(rounds)
+        for session in list(engine.sessions.values()):
+            engine.end(session)
+        store.close()
+        karma.close()
+
+    asyncio.run(main())
+
+def run(workers, seconds):
+    with tempfile.TemporaryDirectory() as directory:
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=worker, args=(worker_id, directory, seconds, results))
+            for worker_id in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        total = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+    return total / seconds
+
+def main():
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(f"CPU cores available: {os.cpu_count()}")
+    print(f"{'workers':>8} {'rounds/sec':>12} {'scaling':>9}")
+    single = None
+    workers = 1
+    while workers <= max_workers:
+        throughput = run(workers, seconds)
+        single = single or throughput
+        print(f"{workers:>8} {throughput:>12.0f} {throughput / (single * workers):>8.0%}")
+        workers *= 2
+
+if __name__ == '__main__':
+    main()
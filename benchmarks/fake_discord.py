@@ -0,0 +1,177 @@
+"""
+Just enough of discord.py's objects to run the bot's story rounds offline
+
+Channels, messages, reactions and users behave like the parts of discord.py
+that bot.py touches. Every API call takes a configurable latency, and each
+channel applies Discord's published rate limits: a request over the limit is
+counted as a 429 and retried after the window frees up, the way discord.py
+handles rate limits internally. Latencies and retries use asyncio.sleep, so
+they run on virtual time under loadsim's event loop.
+"""
+import asyncio
+import itertools
+import random
+from collections import deque
+
+import outbound
+
+# Seconds a simulated Discord API call takes: (minimum, maximum)
+API_LATENCY = (0.04, 0.12)
+
+_ids = itertools.count(10_000)
+
+class RateLimitWindow:
+    """Discord's side of one rate-limit bucket, counting requests over the limit"""
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self._sent = deque()
+
+    async def enter(self, stats):
+        loop = asyncio.get_event_loop()
+        while True:
+            now = loop.time()
+            while self._sent and now - self._sent[0] >= self.period:
+                self._sent.popleft()
+            if len(self._sent) < self.limit:
+                self._sent.append(now)
+                return
+            stats["rate_limited"] += 1
+            await asyncio.sleep(self.period - (now - self._sent[0]))
+
+class FakeDiscord:
+    """The simulated API: counts requests and owns the global rate limit"""
+
+    def __init__(self, latency=API_LATENCY, seed=None):
+        """
+        Args:
+            latency (tuple): Minimum and maximum seconds per API call
+            seed (int): Seed for the latency jitter
+        """
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.stats = {"requests": 0, "rate_limited": 0, "messages": 0, "reactions": 0, "dms": 0}
+        self.global_window = RateLimitWindow(*outbound.GLOBAL_LIMIT)
+
+    async def call(self, window):
+        """Wait out the rate limits and latency of one API call"""
+        await window.enter(self.stats)
+        await self.global_window.enter(self.stats)
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.random.uniform(*self.latency))
+
+class FakeUser:
+    def __init__(self, discord, user_id, name=None):
+        self._discord = discord
+        self.id = user_id
+        self.name = name or f"user{user_id}"
+        self.display_name = self.name
+
+    async def send(self, content):
+        self._discord.stats["dms"] += 1
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class FakeReaction:
+    def __init__(self, emoji, users):
+        self.emoji = emoji
+        self._users = users
+
+    async def users(self):
+        for user in list(self._users):
+            yield user
+
+class FakeMessage:
+    def __init__(self, channel, content):
+        self.id = next(_ids)
+        self.channel = channel
+        self.content = content
+        self.deleted = False
+        # emoji -> set of FakeUser
+        self._reactions = {}
+
+    @property
+    def reactions(self):
+        return [FakeReaction(emoji, users) for emoji, users in self._reactions.items() if users]
+
+    async def edit(self, content=None):
+        await self.channel.discord.call(self.channel.windows['edit'])
+        self.content = content
+        return self
+
+    async def delete(self):
+        await self.channel.discord.call(self.channel.windows['delete'])
+        self.deleted = True
+
+    async def add_reaction(self, emoji):
+        await self.channel.discord.call(self.channel.windows['react'])
+        self.channel.discord.stats["reactions"] += 1
+        self.react(emoji, self.channel.me)
+
+    def react(self, emoji, user):
+        """Record a reaction without an API call (one a user made in their client)"""
+        self._reactions.setdefault(str(emoji), set()).add(user)
+
+class FakeChannel:
+    def __init__(self, discord, channel_id, guild, me):
+        """
+        Args:
+            discord (FakeDiscord): The simulated API
+            channel_id (int): The channel's id
+            guild (FakeGuild): The guild the channel is in
+            me (FakeUser): The bot's own user
+        """
+        self.discord = discord
+        self.id = channel_id
+        self.guild = guild
+        self.me = me
+        self.messages = {}
+        self.windows = {
+            'send': RateLimitWindow(*outbound.MESSAGE_CREATE_LIMIT),
+            'edit': RateLimitWindow(*outbound.MESSAGE_EDIT_LIMIT),
+            'delete': RateLimitWindow(*outbound.MESSAGE_DELETE_LIMIT),
+            'react': RateLimitWindow(*outbound.REACTION_LIMIT),
+        }
+
+    async def send(self, content):
+        await self.discord.call(self.windows['send'])
+        self.discord.stats["messages"] += 1
+        message = FakeMessage(self, content)
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, message_id):
+        await self.discord.call(self.windows['send'])
+        return self.messages[message_id]
+
+    def get_partial_message(self, message_id):
+        return self.messages[message_id]
+
+class FakeContext:
+    """The command context a !roleplay invocation would get"""
+
+    def __init__(self, channel, author):
+        self.channel = channel
+        self.author = author
+        self.guild = channel.guild
+
+    async def send(self, content):
+        return await self.channel.send(content)
+
+class FakeReactionPayload:
+    """The fields of discord.RawReactionActionEvent the bot reads"""
+
+    def __init__(self, message_id, channel_id, user_id, emoji):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.emoji = emoji
@@ -0,0 +1,273 @@
+"""
+A local stand-in for the Gemini REST API, for exercising the Gemini client offline
+
+Serves generateContent, streamGenerateContent, countTokens and cachedContents well enough
+for the google-generativeai SDK's REST transport. Responses are canned text;
+latency is modelled as a fixed cost plus a cost per uncached input token and
+per output token, so cached prefixes show up as faster requests. Token counts
+use the same four-characters-per-token estimate as story_context.
+
+Point the bot (or a benchmark) at it with:
+    GEMINI_API_KEY=fake GEMINI_TRANSPORT=rest GEMINI_API_ENDPOINT=http://127.0.0.1:8765
+
+Faults can be injected: a share of generate requests answer 503, and a
+share take an extra tail latency, to exercise reliability.CallPolicy.
+
+Usage: python benchmarks/fake_gemini.py [--port 8765] [--fault-rate 0.05]
+       [--tail-rate 0.02] [--tail-latency 20]
+"""
+import argparse
+import datetime
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds every request takes
+BASE_LATENCY = 0.05
+
+# Seconds per input token that isn't served from a cache
+INPUT_TOKEN_LATENCY = 0.00002
+
+# Seconds per generated token
+OUTPUT_TOKEN_LATENCY = 0.0005
+
+# The canned story segment returned for every prompt
+SEGMENT = (
+    "*The lantern gutters as the door swings shut behind you.*\n\n"
+    "**Mira** presses her back to the wall, listening to the footsteps fade. "
+    "Somewhere below, water drips onto stone.\n\n"
+    "**A)** Follow the footsteps into the cellar\n"
+    "**B)** Bar the door and search the study"
+)
+
+_GENERATE = re.compile(r'^/v1beta/(models/[^:]+):(generateContent|streamGenerateContent|countTokens)$')
+_CACHE = re.compile(r'^/v1beta/(cachedContents)(?:/([^/]+))?$')
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+def _get(data, camel, snake, default=None):
+    # The SDK may send either spelling depending on version
+    return data.get(camel, data.get(snake, default))
+
+def _contents_text(contents):
+    return "".join(part.get("text", "") for content in contents or [] for part in content.get("parts", []))
+
+def _timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def _ttl_seconds(ttl):
+    return float(ttl.rstrip('s')) if ttl else 3600.0
+
+class FakeGemini:
+    """State shared by the request handlers: cached contents and counters"""
+
+    def __init__(self, fault_rate=0.0, tail_rate=0.0, tail_latency=0.0):
+        """
+        Args:
+            fault_rate (float): Share of generate requests that fail with a 503
+            tail_rate (float): Share of generate requests that are slow
+            tail_latency (float): Extra seconds a slow request takes
+        """
+        self.fault_rate = fault_rate
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.faults = 0
+        self.caches = {}
+        self.requests = 0
+        self.cached_tokens = 0
+        self.input_tokens = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def generate(self, body):
+        """
+        Answer a generateContent request
+
+        Args:
+            body (dict): The request body
+
+        Returns:
+            tuple: The response body and the simulated latency in seconds;
+                the body is None for an unknown cached content and a string
+                for an injected fault
+        """
+        if random.random() < self.fault_rate:
+            self.faults += 1
+            return "fault", BASE_LATENCY
+        prompt_tokens = estimate_tokens(_contents_text(body.get("contents")))
+        cached_tokens = 0
+        name = _get(body, "cachedContent", "cached_content")
+        with self._lock:
+            if name:
+                cache = self.caches.get(name)
+                if cache is None or cache["expires"] < time.time():
+                    return None, 0.0
+                cached_tokens = cache["tokens"]
+            self.requests += 1
+            self.input_tokens += prompt_tokens + cached_tokens
+            self.cached_tokens += cached_tokens
+
+        config = _get(body, "generationConfig", "generation_config", {})
+        text = SEGMENT
+        if _get(config, "responseMimeType", "response_mime_type") == "application/json":
+            narrative, options = SEGMENT.split("\n\n**A)** ")
+            option_a, option_b = options.split("\n**B)** ")
+            text = json.dumps({"narrative": narrative, "option_a": option_a, "option_b": option_b})
+        output_tokens = estimate_tokens(text)
+
+        latency = BASE_LATENCY + prompt_tokens * INPUT_TOKEN_LATENCY + output_tokens * OUTPUT_TOKEN_LATENCY
+        if random.random() < self.tail_rate:
+            latency += self.tail_latency
+        usage = {
+            "promptTokenCount": prompt_tokens + cached_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + cached_tokens + output_tokens,
+        }
+        if cached_tokens:
+            usage["cachedContentTokenCount"] = cached_tokens
+        response = {
+            "candidates": [{
+                "content": {"parts": [{"text": text}], "role": "model"},
+                "finishReason": "STOP",
+                "index": 0,
+            }],
+            "usageMetadata": usage,
+        }
+        return response, latency
+
+    def create_cache(self, body):
+        """Register a cached content and return its resource"""
+        now = time.time()
+        with self._lock:
+            name = f"cachedContents/fake-{next(self._ids)}"
+            self.caches[name] = {
+                "model": body.get("model", ""),
+                "tokens": estimate_tokens(_contents_text(body.get("contents"))),
+                "created": now,
+                "expires": now + _ttl_seconds(body.get("ttl")),
+            }
+        return self.cache_resource(name)
+
+    def update_cache(self, name, body):
+        """Move a cached content's expiry; returns None if it doesn't exist"""
+        with self._lock:
+            cache = self.caches.get(name)
+            if cache is None:
+                return None
+            cache["expires"] = time.time() + _ttl_seconds(body.get("ttl"))
+        return self.cache_resource(name)
+
+    def delete_cache(self, name):
+        """Forget a cached content; returns whether it existed"""
+        with self._lock:
+            return self.caches.pop(name, None) is not None
+
+    def cache_resource(self, name):
+        """The JSON form of a cached content, or None if it doesn't exist"""
+        cache = self.caches.get(name)
+        if cache is None:
+            return None
+        return {
+            "name": name,
+            "model": cache["model"],
+            "createTime": _timestamp(cache["created"]),
+            "updateTime": _timestamp(cache["created"]),
+            "expireTime": _timestamp(cache["expires"]),
+            "usageMetadata": {"totalTokenCount": cache["tokens"]},
+        }
+
+class Handler(BaseHTTPRequestHandler):
+    """Routes Gemini REST paths to the server's FakeGemini"""
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        body = self._body()
+        match = _GENERATE.match(path)
+        if match and match.group(2) == "countTokens":
+            return self._reply(200, {"totalTokens": estimate_tokens(_contents_text(body.get("contents")))})
+        if match:
+            response, latency = self.server.gemini.generate(body)
+            if response is None:
+                return self._reply(404, {"error": {"code": 404, "message": "Cached content not found", "status": "NOT_FOUND"}})
+            time.sleep(latency)
+            if response == "fault":
+                return self._reply(503, {"error": {"code": 503, "message": "Injected fault", "status": "UNAVAILABLE"}})
+            # Streamed responses come back as a JSON array of chunks; one chunk is enough here
+            return self._reply(200, [response] if match.group(2) == "streamGenerateContent" else response)
+        if _CACHE.match(path):
+            return self._reply(200, self.server.gemini.create_cache(body))
+        self._reply(404, {"error": {"code": 404, "message": f"Unknown path {path}", "status": "NOT_FOUND"}})
+
+    def do_GET(self):
+        match = _CACHE.match(self.path.split('?')[0])
+        resource = self.server.gemini.cache_resource(f"cachedContents/{match.group(2)}") if match else None
+        self._reply(200 if resource else 404, resource or {})
+
+    def do_PATCH(self):
+        match = _CACHE.match(self.path.split('?')[0])
+        body = self._body()
+        # The SDK sends the fields to change either at the top level or under "cachedContent"
+        body = _get(body, "cachedContent", "cached_content", body)
+        resource = self.server.gemini.update_cache(f"cachedContents/{match.group(2)}", body) if match else None
+        self._reply(200 if resource else 404, resource or {})
+
+    def do_DELETE(self):
+        match = _CACHE.match(self.path.split('?')[0])
+        found = match is not None and self.server.gemini.delete_cache(f"cachedContents/{match.group(2)}")
+        self._reply(200 if found else 404, {})
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def _reply(self, status, data):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def start(port=0, **options):
+    """
+    Run a fake Gemini server on a background thread
+
+    Args:
+        port (int): Port to listen on, or 0 for any free port
+        **options: Fault injection settings passed on to FakeGemini
+
+    Returns:
+        ThreadingHTTPServer: The running server; its .gemini holds the state
+            and server_address[1] the port
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.gemini = FakeGemini(**options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fault-rate', type=float, default=0.0)
+    parser.add_argument('--tail-rate', type=float, default=0.0)
+    parser.add_argument('--tail-latency', type=float, default=20.0)
+    args = parser.parse_args()
+
+    server = start(args.port, fault_rate=args.fault_rate, tail_rate=args.tail_rate, tail_latency=args.tail_latency)
+    print(f"Fake Gemini API listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""
+Load simulation: the bot's full round loop against fake Discord and Gemini
+
+Imports bot.py and drives the real roleplay command and continue_story
+rounds across N simulated channels with M voters each. Discord comes from
+fake_discord (latency plus rate limits) and generation is a fake
+generate_text/stream_text with a configurable latency distribution. Everything
+runs on an event loop with a virtual clock: sleeps and timers complete as soon
+as nothing else is runnable, so a 60 second vote costs no real time while the
+bot's own CPU work is measured as it happens.
+
+Reports rounds per second (wall and virtual), p50/p99 round latency in
+virtual seconds (from a vote closing to the next one opening), API calls per
+round and peak memory, and writes them to a JSON file. Pass --baseline with an
+earlier result file to print the change in each metric.
+
+Latency specs: "fixed:S", "uniform:LOW,HIGH" or "lognormal:MEDIAN,SIGMA" seconds.
+Bot settings such as STREAM_RESPONSES or SPECULATIVE_GENERATION are read from
+the environment as usual.
+
+Usage: python benchmarks/loadsim.py [--channels N] [--voters M] [--rounds R]
+       [--latency SPEC] [--output FILE] [--baseline FILE]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import selectors
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fake_discord
+
+# Canned story text; options are drawn per segment so emojis and votes vary
+NARRATIVE = (
+    "*Rain hammers the copper roofs of the harbour district as the bells fall silent.*\n\n"
+    "**Captain Ilsa Marr** steps off the gangplank, coat heavy with salt. \"*We're being watched,*\" "
+    "she murmurs, eyes on the warehouse windows. Somewhere behind the crates a lantern flickers and dies.\n\n"
+    "The ledger in her satchel is the only proof of what the Guild has done. "
+) * 3
+OPTIONS = [
+    "Slip into the warehouse and confront the watcher",
+    "Head for the tavern and find the smuggler",
+    "Burn the ledger before anyone can take it",
+    "Climb to the rooftops and follow the lantern",
+    "Bribe the harbour guard for safe passage",
+    "Hide aboard the ship until nightfall",
+]
+
+# Share of voters who add a custom emoji instead of voting
+CUSTOM_REACTION_SHARE = 0.05
+
+class VirtualSelector(selectors.DefaultSelector):
+    """
+    A selector that skips ahead in time instead of waiting
+
+    Ready I/O (including results from worker threads) is always returned
+    first; when there is none and the loop would sleep until its next timer,
+    the loop's virtual clock jumps forward by that much instead.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # Nothing scheduled: only a worker thread can wake the loop
+            return super().select(None)
+        self.loop.virtual_time += timeout
+        return []
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """An event loop whose clock only moves when every task is waiting"""
+
+    def __init__(self):
+        selector = VirtualSelector()
+        super().__init__(selector)
+        selector.loop = self
+        self.virtual_time = 0.0
+
+    def time(self):
+        return self.virtual_time
+
+def latency_sampler(spec, rng):
+    """
+    Build a function returning latencies drawn from a distribution
+
+    Args:
+        spec (str): "fixed:S", "uniform:LOW,HIGH" or "lognormal:MEDIAN,SIGMA"
+        rng (random.Random): Source of randomness
+
+    Returns:
+        callable: Returns one latency in seconds per call
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',') if value]
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        return lambda: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+class FakeGemini:
+    """Stands in for gemini_api.generate_text and stream_text"""
+
+    def __init__(self, latency, rng, chunks=8):
+        """
+        Args:
+            latency: Callable returning the seconds a request takes
+            rng (random.Random): Source of randomness for the options
+            chunks (int): Fragments a streamed response arrives in
+        """
+        self.latency = latency
+        self.rng = rng
+        self.chunks = chunks
+        self.calls = 0
+        self.summaries = 0
+        self.prompt_chars = 0
+
+    def respond(self, prompt, json_output=False):
+        self.calls += 1
+        self.prompt_chars += len(prompt)
+        if prompt.startswith("Summarize"):
+            self.summaries += 1
+            return "The captain reached the harbour with the Guild's ledger and was followed by an unseen watcher."
+        option_a, option_b = self.rng.sample(OPTIONS, 2)
+        if json_output:
+            return json.dumps({"narrative": NARRATIVE, "option_a": option_a, "option_b": option_b})
+        return f"{NARRATIVE}\n\n**A)** {option_a}\n**B)** {option_b}"
+
+    async def generate_text(self, prompt, max_tokens=2000, json_output=False, **kwargs):
+        text = self.respond(prompt, json_output)
+        await asyncio.sleep(self.latency())
+        return text
+
+    async def stream_text(self, prompt, max_tokens=2000, **kwargs):
+        text = self.respond(prompt)
+        latency = self.latency()
+        size = -(-len(text) // self.chunks)
+        for start in range(0, len(text), size):
+            await asyncio.sleep(latency / self.chunks)
+            yield text[start:start + size]
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+async def simulate(bot_module, args):
+    loop = asyncio.get_event_loop()
+    rng = random.Random(args.seed)
+    gemini = FakeGemini(latency_sampler(args.latency, rng), rng)
+    bot_module.generate_text = gemini.generate_text
+    bot_module.stream_text = gemini.stream_text
+
+    discord = fake_discord.FakeDiscord(seed=args.seed)
+    me = fake_discord.FakeUser(discord, 1, "storybot")
+    # bot.user is read from the connection state, which is only filled in on login
+    bot_module.bot._connection.user = me
+
+    engine = bot_module.engine
+    engine.voting_duration = args.voting_duration
+    closed_at = {}
+    round_latencies = []
+    opener_latencies = []
+    finished = asyncio.Event()
+    rounds = 0
+
+    run_round = engine.run_round
+    async def timed_round(session):
+        closed_at[session.channel_id] = loop.time()
+        return await run_round(session)
+    engine.run_round = timed_round
+
+    on_vote_open = engine.on_vote_open
+    def vote_opened(session):
+        nonlocal rounds
+        on_vote_open(session)
+        rounds += 1
+        started = closed_at.pop(session.channel_id, None)
+        if started is not None:
+            round_latencies.append(loop.time() - started)
+        # Voters stop turning up after the last round, so the story ends on its own
+        if session.rounds <= args.rounds:
+            schedule_voters(session)
+    engine.on_vote_open = vote_opened
+
+    on_end = engine.on_end
+    def ended(session):
+        on_end(session)
+        if not engine.sessions:
+            finished.set()
+    engine.on_end = ended
+
+    def schedule_voters(session):
+        message, channel_id = session.message, session.channel.id
+        for voter in range(args.voters):
+            user_id = 1000 + voter
+            if rng.random() < CUSTOM_REACTION_SHARE:
+                emoji = rng.choice(["🔥", "🐉", "💀", "🌧️"])
+            else:
+                emoji = session.emoji_a if rng.random() < 0.5 else session.emoji_b
+            payload = fake_discord.FakeReactionPayload(message.id, channel_id, user_id, emoji)
+            delay = rng.uniform(0, args.voting_duration * 0.9)
+            loop.call_later(delay, lambda payload=payload: asyncio.ensure_future(bot_module.on_raw_reaction_add(payload)))
+
+    async def open_story(channel):
+        await asyncio.sleep(rng.uniform(0, args.stagger))
+        author = fake_discord.FakeUser(discord, 1000)
+        started = loop.time()
+        await bot_module.roleplay.callback(fake_discord.FakeContext(channel, author), theme=rng.choice(args.themes))
+        opener_latencies.append(loop.time() - started)
+
+    bot_module.karma.start()
+    channels = [
+        fake_discord.FakeChannel(discord, 100_000 + number, fake_discord.FakeGuild(number % 50), me)
+        for number in range(args.channels)
+    ]
+
+    tracemalloc.start()
+    wall_start = time.perf_counter()
+    virtual_start = loop.time()
+    await asyncio.gather(*(open_story(channel) for channel in channels))
+    if engine.sessions:
+        await finished.wait()
+    wall = time.perf_counter() - wall_start
+    virtual = loop.time() - virtual_start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # Story rounds after the opener; the opener is counted separately
+    continued = len(round_latencies)
+    return {
+        "rounds": rounds,
+        "continued_rounds": continued,
+        "wall_seconds": wall,
+        "virtual_seconds": virtual,
+        "rounds_per_sec_wall": rounds / wall if wall else 0.0,
+        "rounds_per_sec_virtual": rounds / virtual if virtual else 0.0,
+        "round_latency_p50": percentile(round_latencies, 0.5),
+        "round_latency_p99": percentile(round_latencies, 0.99),
+        "opener_latency_p50": percentile(opener_latencies, 0.5),
+        "opener_latency_p99": percentile(opener_latencies, 0.99),
+        "api_calls": gemini.calls,
+        "api_calls_per_round": gemini.calls / rounds if rounds else 0.0,
+        "summary_calls": gemini.summaries,
+        "prompt_chars_per_call": gemini.prompt_chars / gemini.calls if gemini.calls else 0.0,
+        "discord_requests": discord.stats["requests"],
+        "discord_requests_per_round": discord.stats["requests"] / rounds if rounds else 0.0,
+        "discord_rate_limited": discord.stats["rate_limited"],
+        "peak_memory_mb": peak / 1_000_000,
+    }
+
+def print_comparison(result, baseline):
+    print(f"\nchange from baseline ({baseline.get('revision') or 'unknown revision'}):")
+    for name, value in result["metrics"].items():
+        old = baseline.get("metrics", {}).get(name)
+        if isinstance(old, (int, float)) and old:
+            print(f"  {name:<28} {old:>12.3f} -> {value:>12.3f} ({(value - old) / old:+.1%})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--voters', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=10, help="rounds voted on per story")
+    parser.add_argument('--latency', default='lognormal:2.0,0.4', help="Gemini latency distribution")
+    parser.add_argument('--voting-duration', type=float, default=60.0, help="virtual seconds per vote")
+    parser.add_argument('--stagger', type=float, default=30.0, help="virtual seconds over which stories start")
+    parser.add_argument('--themes', nargs='+', default=["space adventure", "haunted castle", "pirate heist"])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='loadsim_result.json')
+    parser.add_argument('--baseline', help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # bot.py opens its databases at import time
+        os.environ['KARMA_DB_PATH'] = os.path.join(directory, 'karma.db')
+        os.environ['SHARED_STATE_PATH'] = os.path.join(directory, 'sessions.db')
+        # Nothing the simulated stories write should end up in the working directory
+        os.environ['STORY_LOG_DIR'] = os.path.join(directory, 'story_logs')
+        os.environ['TRACE_PATH'] = os.path.join(directory, 'traces.jsonl')
+        os.environ.setdefault('GEMINI_API_KEY', 'fake')
+        import bot as bot_module
+
+        loop = VirtualClockLoop()
+        asyncio.set_event_loop(loop)
+        try:
+            metrics = loop.run_until_complete(simulate(bot_module, args))
+        finally:
+            bot_module.karma.close()
+            bot_module.session_store.close()
+            bot_module.story_log.close()
+            bot_module.tracing.close()
+            loop.close()
+
+    result = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "metrics": metrics,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    print(f"channels: {args.channels}, voters: {args.voters}, rounds per story: {args.rounds}, latency: {args.latency}")
+    for name, value in metrics.items():
+        print(f"  {name:<28} {value:>12.3f}" if isinstance(value, float) else f"  {name:<28} {value:>12}")
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(result, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,40 @@
+import startup
 import discord
 import asyncio
 import json
 import os
-import re
+import time
 from dotenv import load_dotenv
 from discord.ext import commands
-from gemini_api import generate_text
-from emoji_handler import get_relevant_emojis, emoji_to_text
-from message_handler import split_message
 
-# Load environment variables
+# Load environment variables before the modules below read their settings
 load_dotenv()
+
+import gemini_api
+from gemini_api import generate_text, stream_text
+from scheduler import Lane, OPENER, CONTINUE, BACKGROUND
+from emoji_handler import get_relevant_emojis, describe_many
+from message_handler import split_message, StreamingMessage
+from story_context import StoryContext
+from speculative import Speculation
+import vote_tally
+from karma_store import KarmaStore
+from session_engine import SessionEngine, GENERATING, VOTING
+from shared_state import SessionStore
+import outbound
+from outbound import get_outbox, release_outbox
+from story_parser import parse_segment, visible_text, STRUCTURED_INSTRUCTIONS
+from opener_cache import OpenerCache
+from voting_policy import VotingPolicy, EARLY_CLOSE, expected_players, vote_seconds
+from output_budget import OutputBudget
+from story_log import StoryLog, SEGMENT, CHOICE
+from message_handler import MessageSplitter
+import metrics
+import profiler
+import tracing
+
+startup.mark("imports")
+
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 
 # Set up intents for reactions
@@ -19,35 +43,78 @@ intents.message_content = True
 intents.reactions = True
 intents.members = True
 
+# Sharding, set by launcher.py when running as one of several worker processes
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()] or None
+
 # Initialize bot
-bot = commands.Bot(command_prefix='!', intents=intents)
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
 
-# Karma tracking dictionary
-karma = {}
+# Karma tracking (persisted to SQLite, served from memory)
+karma = KarmaStore()
 
-# Story history for active channels
+# Story history for active channels (channel id -> StoryContext)
 story_history = {}
 
-# Voting duration in seconds
+# Every story in full, on disk, for !recap
+story_log = StoryLog()
+
+# Running sessions saved so they can be resumed by this or another worker
+session_store = SessionStore()
+
+# The /metrics endpoint, started on the first on_ready
+metrics_server = None
+
+# The Gemini warm-up, started once logged in
+warm_up = None
+
+# Voting duration in seconds; votes close sooner when the result is clear (see voting_policy)
 VOTING_DURATION = 60
 
-@bot.event
-async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
+# Decides when each vote may close before VOTING_DURATION is up
+voting_policy = VotingPolicy(VOTING_DURATION)
 
-@bot.command(name='roleplay')
-async def roleplay(ctx, *, theme=None):
-    """Start a new roleplay scenario with the specified theme"""
-    if not theme:
-        await ctx.send("Please provide a theme for the roleplay. Example: `!roleplay space adventure`")
-        return
-    
-    # Initialize story history for this channel
-    channel_id = str(ctx.channel.id)
-    story_history[channel_id] = []
-    
-    # Generate initial scenario with improved formatting instructions
-    prompt = (
+# Post story segments while they are being generated instead of after
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() == 'true'
+
+# Generate both branches in the background while a vote is open
+SPECULATIVE_GENERATION = os.getenv('SPECULATIVE_GENERATION', 'false').lower() == 'true'
+
+# Ask the model for JSON (narrative, option_a, option_b) instead of parsing labelled options; disables streaming
+STRUCTURED_OUTPUT = os.getenv('STRUCTURED_OUTPUT', 'false').lower() == 'true'
+
+# Rounds in a row that may fail to generate before the story is ended
+MAX_ROUND_FAILURES = int(os.getenv('MAX_ROUND_FAILURES', '3'))
+
+# Keep pre-generated openers for popular themes so !roleplay can post one immediately
+OPENER_CACHE = os.getenv('OPENER_CACHE', 'false').lower() == 'true'
+
+# Seconds a story may go without a new segment or choice (outside a vote) before it is treated as abandoned
+STORY_IDLE_TIMEOUT = float(os.getenv('STORY_IDLE_TIMEOUT', '1800'))
+
+# The task that evicts abandoned stories, started on the first on_ready
+idle_sweeper = None
+
+# Sizes each segment to fit SEGMENT_MESSAGES Discord messages
+output_budget = OutputBudget()
+
+# A third option is never wanted, so generation stops if the model starts one
+SEGMENT_STOP_SEQUENCES = ["**C)**"]
+
+def build_opening_prompt(theme):
+    """
+    Build the prompt that generates a story's opening scenario
+
+    Args:
+        theme (str): The theme given to !roleplay
+
+    Returns:
+        str: The complete prompt for the opener
+    """
+    return (
         "You are an expert storyteller creating an immersive, dramatic roleplay scenario. "
         f"Generate an engaging opening scenario for a roleplay about: {theme}.\n\n"
         "Follow these formatting and narrative guidelines:\n"
@@ -61,42 +128,324 @@ async def roleplay(ctx, *, theme=None):
         "7. **End Choices**: Conclude with two distinct, meaningful choices formatted as:\n\n"
         "**A)** [first option] - Make this option distinct and consequential\n"
         "**B)** [second option] - Make this option clearly different with its own potential outcomes\n\n"
-        "Ensure your storytelling creates a sense of immersion, urgency, and emotional investment."
+        "Ensure your storytelling creates a sense of immersion, urgency, and emotional investment.\n\n"
+        f"{output_budget.instruction()}"
     )
+
+# Instructions that open every continuation prompt; they never change, so they lead the cacheable prefix
+CONTINUE_GUIDELINES = (
+    "You are continuing a roleplay story. After the story so far, continue it based on the group's latest "
+    "choice, following these advanced formatting guidelines:\n"
+    "1. **Transition**: Begin with a brief *italic* summary connecting to the previous choice.\n"
+    "2. **Consequences**: Detail the immediate effects of the choice using vivid sensory descriptions.\n"
+    "3. **Character Development**: Use **bold** for character names and show emotional/physical reactions to events.\n"
+    "4. **Dramatic Moments**: Emphasize key revelations or shocking moments with *italic* or **bold** formatting.\n"
+    "5. **Environmental Changes**: Describe how the setting evolves or responds to the characters' actions.\n"
+    "6. **Dialogue**: Format dialogue with quotation marks, including tone indicators, e.g., \"*We need to hurry,*\" she urged.\n"
+    "7. **Pacing**: Vary paragraph length – short for tension, longer for description and reflection.\n"
+    "\nEnd with exactly two distinct choices labeled as:\n\n"
+    "**A)** [first option] - Make this option carry significant weight and consequences\n"
+    "**B)** [second option] - Make this option provide a completely different direction\n\n"
+    "Ensure each choice creates a meaningful branch in the narrative and maintains emotional investment.\n\n"
+    "The story so far:\n\n"
+)
+
+def build_continue_prompt(full_context, custom_elements_text="", length_instruction=None):
+    """
+    Build the prompt that continues a story after a vote
+
+    The prompt starts with CONTINUE_GUIDELINES followed directly by the story,
+    so everything up to the latest segment is a prefix shared by later rounds.
+    The length instruction changes as the output budget adapts, so it goes
+    at the end, outside that prefix.
+
+    Args:
+        full_context (str): The story so far, including the chosen option
+        custom_elements_text (str): Instructions for elements added via custom emojis
+        length_instruction (str): The round's length instruction; the output
+            budget's current one by default
+
+    Returns:
+        str: The complete prompt for the next segment
+    """
+    prompt = f"{CONTINUE_GUIDELINES}{full_context}\n\n"
+
+    # Add custom elements if any
+    if custom_elements_text:
+        prompt += f"**Special Elements**: {custom_elements_text}\n\n"
+
+    prompt += "Now continue the story from the group's latest choice, following the guidelines above. "
+    prompt += length_instruction or output_budget.instruction()
+    return prompt
+
+def lane_for(channel, priority):
+    """
+    Describe who a generation request is for, so the scheduler can share capacity fairly
+
+    Args:
+        channel: The channel the story is told in (None for work not tied to a story)
+        priority (str): OPENER, CONTINUE or BACKGROUND
+
+    Returns:
+        Lane: The request's priority, guild and channel
+    """
+    if channel is None:
+        return Lane(priority)
+    guild = getattr(channel, 'guild', None)
+    return Lane(priority, guild.id if guild else None, channel.id)
+
+def summarizer_for(channel):
+    """Return a summarize callable for a channel's StoryContext, scheduled as background work"""
+    lane = lane_for(channel, BACKGROUND)
+    return lambda prompt: generate_text(prompt, lane=lane)
+
+async def generate_segment(prompt, cache_key=None, stable_chars=0, lane=None):
+    """
+    Generate a complete story segment, as JSON when STRUCTURED_OUTPUT is set
+
+    The response is capped by the output budget, and the length of what
+    players will see of it (not the JSON around it) is recorded so the
+    budget can adapt.
+
+    Args:
+        prompt (str): The prompt to send to the API
+        cache_key (str): The story's channel id, if the prompt's prefix may be cached
+        stable_chars (int): Length of the prompt's prefix that stays the same between rounds
+        lane (Lane): Who the request is for (see lane_for)
+
+    Returns:
+        str: The raw response, ready for parse_segment
+    """
+    if STRUCTURED_OUTPUT:
+        text = await generate_text(prompt + STRUCTURED_INSTRUCTIONS, max_tokens=output_budget.max_tokens,
+                                   json_output=True, cache_key=cache_key, stable_chars=stable_chars, lane=lane)
+    else:
+        text = await generate_text(prompt, max_tokens=output_budget.max_tokens, cache_key=cache_key,
+                                   stable_chars=stable_chars, lane=lane, stop_sequences=SEGMENT_STOP_SEQUENCES)
+    output_budget.record(visible_text(text, STRUCTURED_OUTPUT))
+    return text
+
+async def stream_segment(outbox, prompt, cache_key=None, stable_chars=0, lane=None):
+    """
+    Stream a story segment into the channel as it is generated
+
+    Any status lines queued on the outbox are shown at the top of the first message.
+
+    Args:
+        outbox (Outbox): The channel's outbox
+        prompt (str): The prompt to send to the API
+        cache_key (str): The story's channel id, if the prompt's prefix may be cached
+        stable_chars (int): Length of the prompt's prefix that stays the same between rounds
+        lane (Lane): Who the request is for (see lane_for)
+
+    Returns:
+        tuple: The complete generated text and the StreamingMessage holding the posts
+    """
+    stream = StreamingMessage(outbox, prefix=outbox.take_notes())
+    await stream.begin()
+    async for fragment in stream_text(prompt, max_tokens=output_budget.max_tokens, cache_key=cache_key,
+                                      stable_chars=stable_chars, lane=lane, stop_sequences=SEGMENT_STOP_SEQUENCES):
+        await stream.feed(fragment)
+    output_budget.record(stream.text)
+    return stream.text, stream
+
+async def send_segment(outbox, segment):
+    """
+    Send a complete story segment, split to fit Discord's limit
+
+    Any status lines queued on the outbox are merged into the first message.
+
+    Args:
+        outbox (Outbox): The channel's outbox
+        segment (str): The story segment
+
+    Returns:
+        list: The sent messages, in order
+    """
+    notes = outbox.take_notes()
+    text = f"{notes}\n\n{segment}" if notes else segment
+    sent_messages = []
+    with tracing.span("split"):
+        chunks = split_message(text)
+    for chunk in chunks:
+        sent_messages.append(await outbox.send(chunk))
+    return sent_messages
+
+def start_speculation(channel, context, option_a, option_b, length_instruction):
+    """
+    Start generating the continuation for both options while the vote is open
+
+    Branches are built as if no custom elements will be added; rounds where
+    custom emojis change the prompt fall back to fresh generation.
+
+    Args:
+        channel: The channel the story is told in
+        context (StoryContext): The channel's story context
+        option_a (str): The text for option A
+        option_b (str): The text for option B
+        length_instruction (str): The round's length instruction, which the
+            winning branch's prompt has to share with the round's own
+
+    Returns:
+        Speculation: The running branches, or None if speculation is disabled
+    """
+    if not SPECULATIVE_GENERATION:
+        return None
+
+    # Branches share the story's cached prompt prefix, if it has one
+    # Nobody is waiting on these yet, so they are scheduled behind live rounds
+    channel_id = str(channel.id)
+    lane = lane_for(channel, BACKGROUND)
+    speculation = Speculation(lambda prompt: generate_segment(prompt, cache_key=channel_id, lane=lane))
+    for chosen_option in (f"**A)** {option_a}", f"**B)** {option_b}"):
+        speculation.start(
+            chosen_option,
+            lambda chosen_option=chosen_option: build_continue_prompt(context.build(chosen_option),
+                                                                      length_instruction=length_instruction),
+            ready=context.settled,
+        )
+    return speculation
+
+async def scrape_votes(channel, message, emoji_a, emoji_b):
+    """
+    Count votes by re-fetching the message and paging through each reaction's users
+
+    This costs one API call per reaction (more for popular ones), so it is only
+    used when the live tally may have missed events.
+
+    Returns:
+        tuple: Voter id sets for A and B, and a dict of custom emoji -> reaction count
+    """
+    message = await channel.fetch_message(message.id)
     
-    try:
-        initial_response = await generate_text(prompt)
+    voters_a = set()
+    voters_b = set()
+    custom_reactions = {}
+    
+    for reaction in message.reactions:
+        users = set()
+        async for user in reaction.users():
+            if user != bot.user:
+                users.add(user.id)
         
-        # Check if response has the expected format with bold markdown
-        option_pattern = r'\*\*A\)\*\*(.*?)(?:\n|$).*?\*\*B\)\*\*(.*?)(?:\n|$)'
-        options_match = re.search(option_pattern, initial_response, re.DOTALL)
+        emoji = str(reaction.emoji)
+        if emoji == str(emoji_a):
+            voters_a = users
+        elif emoji == str(emoji_b):
+            voters_b = users
+        elif users:  # Only add emojis that users actually reacted with
+            custom_reactions[emoji] = len(users)
+    
+    return voters_a, voters_b, custom_reactions
+
+async def collect_votes(channel, message, emoji_a, emoji_b):
+    """
+    Close voting on a message and return the result
+
+    Returns:
+        tuple: Voter id sets for A and B, and a dict of custom emoji -> reaction count
+    """
+    tally = vote_tally.close_tally(message.id)
+    if tally is None or tally.stale:
+        return await scrape_votes(channel, message, emoji_a, emoji_b)
+    return tally.voters_a, tally.voters_b, tally.custom_reactions
+
+@bot.event
+async def setup_hook():
+    # Runs after login, before the gateway connects: get Gemini ready meanwhile
+    global warm_up
+    warm_up = asyncio.ensure_future(gemini_api.warm_up())
+
+@bot.event
+async def on_ready():
+    print(f'{bot.user} has connected to Discord!')
+    global metrics_server, idle_sweeper
+    karma.start()
+    session_store.start_heartbeat()
+    # on_ready fires again after reconnects, but the endpoint and sweeper only need starting once
+    if metrics_server is None:
+        metrics_server = await metrics.serve()
+    if idle_sweeper is None:
+        idle_sweeper = asyncio.ensure_future(sweep_idle())
+    if "gateway connect" not in startup.phases:
+        startup.mark("gateway connect")
+        # Usually finished by now; resumed stories shouldn't race it for the first connection
+        seconds = await warm_up if warm_up is not None else None
+        if seconds is not None:
+            startup.record("warm-up", seconds)
+        print(startup.report())
+    await resume_sessions()
+
+@bot.event
+async def on_raw_reaction_add(payload):
+    if payload.user_id != bot.user.id:
+        vote_tally.record_add(payload.message_id, payload.emoji, payload.user_id)
+        reschedule_vote(payload.message_id)
+
+@bot.event
+async def on_raw_reaction_remove(payload):
+    if payload.user_id != bot.user.id:
+        vote_tally.record_remove(payload.message_id, payload.emoji, payload.user_id)
+        reschedule_vote(payload.message_id)
+
+def reschedule_vote(message_id):
+    """Move a vote's deadline after its reactions change, closing it early once the result is clear"""
+    if not EARLY_CLOSE:
+        return
+    tally = vote_tally.active_tallies.get(message_id)
+    # A stale tally may be missing reactions, so that vote runs its full time
+    if tally is None or tally.stale:
+        return
+    session = engine.sessions.get(str(tally.channel_id))
+    if session is None or session.state != VOTING or session.message.id != message_id:
+        return
+    deadline, session.close_reason = voting_policy.decide(
+        tally.voters_a, tally.voters_b, tally.reactors,
+        expected_players(session.participants), session.opened, asyncio.get_event_loop().time(),
+    )
+    engine.move_deadline(session, deadline)
+
+@bot.event
+async def on_disconnect():
+    # Reactions made while disconnected are never delivered, so open votes need a recount
+    vote_tally.mark_all_stale()
+
+@bot.command(name='roleplay')
+async def roleplay(ctx, *, theme=None):
+    """Start a new roleplay scenario with the specified theme"""
+    if not theme:
+        await ctx.send("Please provide a theme for the roleplay. Example: `!roleplay space adventure`")
+        return
+    
+    # Only one story runs per channel at a time
+    channel_id = str(ctx.channel.id)
+    session = engine.open(channel_id, ctx.channel)
+    if session is None:
+        await ctx.send("A story is already running in this channel! Vote on it, or wait for it to end before starting a new one.")
+        return
+    
+    # Initialize story history for this channel; the log keeps all of it, the context only what prompts need
+    story_history[channel_id] = StoryContext(summarize=summarizer_for(ctx.channel))
+    story_log.start(channel_id)
+    outbox = get_outbox(ctx.channel)
+    trace = tracing.begin("opener", channel_id)
+    outcome = "failed"
+    
+    try:
+        stream = None
+        # A pre-generated opener for a popular theme is posted straight away
+        initial_response = opener_cache.take(theme) if opener_cache is not None else None
+        if initial_response is None:
+            prompt = build_opening_prompt(theme)
+            with tracing.span("generate"):
+                if STREAM_RESPONSES and not STRUCTURED_OUTPUT:
+                    initial_response, stream = await stream_segment(outbox, prompt, lane=lane_for(ctx.channel, OPENER))
+                else:
+                    initial_response = await generate_segment(prompt, lane=lane_for(ctx.channel, OPENER))
         
-        if options_match:
-            option_a = options_match.group(1).strip()
-            option_b = options_match.group(2).strip()
-        else:
-            # Try alternate pattern without bold formatting
-            alt_pattern = r'A\)(.*?)(?:\n|$).*?B\)(.*?)(?:\n|$)'
-            alt_match = re.search(alt_pattern, initial_response, re.DOTALL)
-            
-            if alt_match:
-                option_a = alt_match.group(1).strip()
-                option_b = alt_match.group(2).strip()
-                
-                # Add proper formatting if the AI didn't use it
-                narrative_parts = initial_response.split('A)')
-                if len(narrative_parts) > 1:
-                    narrative = narrative_parts[0].strip()
-                    options_part = 'A)' + narrative_parts[1]
-                    formatted_options = options_part.replace('A)', '**A)**').replace('B)', '**B)**')
-                    initial_response = f"{narrative}\n\n{formatted_options}"
-            else:
-                # Fallback if AI didn't format options correctly
-                split_text = initial_response.split('\n\n')
-                narrative = '\n\n'.join(split_text[:-1]) if len(split_text) > 1 else initial_response
-                option_a = "Continue cautiously"
-                option_b = "Take a risk"
-                initial_response = f"{narrative}\n\n**A)** {option_a}\n**B)** {option_b}"
+        # Pull out the options, putting them in the expected format if the AI didn't
+        with tracing.span("parse"):
+            initial_response, option_a, option_b = parse_segment(initial_response, STRUCTURED_OUTPUT)
         
         # If theme includes "secret", assign secret role to command invoker
         if "secret" in theme.lower():
@@ -109,85 +458,80 @@ async def roleplay(ctx, *, theme=None):
                 pass  # User has DMs closed
         
         # Add initial scenario to history
-        story_history[channel_id].append({"narrative": initial_response, "chosen_option": None})
+        story_history[channel_id].add_segment(initial_response)
+        story_log.append(channel_id, SEGMENT, initial_response)
         
-        # Split long messages if needed
-        messages = split_message(initial_response)
-        sent_messages = []
-        for message in messages:
-            sent_message = await ctx.send(message)
-            sent_messages.append(sent_message)
+        with tracing.span("send"):
+            if stream is not None:
+                # Bring the streamed messages in line with any reformatted options
+                sent_messages = await stream.finish(initial_response)
+            else:
+                # Split long messages if needed
+                sent_messages = await send_segment(outbox, initial_response)
         
         # Add reactions based on the options
         last_message = sent_messages[-1]
-        emoji_a, emoji_b = get_relevant_emojis(option_a, option_b)
-        await last_message.add_reaction(emoji_a)
-        await last_message.add_reaction(emoji_b)
-        
-        # Wait for votes
-        await asyncio.sleep(VOTING_DURATION)
+        with tracing.span("emoji"):
+            emoji_a, emoji_b = get_relevant_emojis(option_a, option_b)
+        vote_tally.open_tally(last_message, emoji_a, emoji_b)
+        with tracing.span("react"):
+            await outbox.react(last_message, emoji_a, emoji_b)
         
-        # Continue the story with voting
-        await continue_story(ctx, last_message, emoji_a, emoji_b, option_a, option_b)
+        # Open the vote, generating both branches meanwhile if enabled
+        # Every generation records its length with the budget, so the round's instruction is fixed now
+        length_instruction = output_budget.instruction()
+        speculation = start_speculation(ctx.channel, story_history[channel_id], option_a, option_b, length_instruction)
+        session.begin_vote(last_message, emoji_a, emoji_b, option_a, option_b, speculation, length_instruction)
+        metrics.rounds.inc()
+        engine.schedule_vote(session)
+        outcome = "ok"
         
     except Exception as e:
+        metrics.error('roleplay', e)
+        engine.end(session)
         await ctx.send(f"An error occurred: {str(e)}")
+    finally:
+        tracing.finish(trace, outcome)
 
-async def continue_story(ctx, message, emoji_a, emoji_b, option_a, option_b):
-    """Process votes and continue the story"""
-    channel_id = str(ctx.channel.id)
-    
-    # Refresh message to get latest reactions
-    message = await ctx.channel.fetch_message(message.id)
-    
-    # Count votes
-    reaction_a = discord.utils.get(message.reactions, emoji=emoji_a)
-    reaction_b = discord.utils.get(message.reactions, emoji=emoji_b)
-    
-    voters_a = []
-    voters_b = []
+@tracing.traced("continue", lambda session: session.channel_id)
+async def continue_story(session):
+    """
+    Process the votes for a session's round and continue the story
+
+    Args:
+        session (Session): The session whose vote just closed
+
+    Returns:
+        bool: True if a new round is open for voting, False if the story ended
+    """
+    channel = session.channel
+    channel_id = session.channel_id
+    outbox = get_outbox(channel)
+    message, emoji_a, emoji_b = session.message, session.emoji_a, session.emoji_b
+    option_a, option_b = session.option_a, session.option_b
+    speculation, session.speculation = session.speculation, None
+    vote_seconds.observe(asyncio.get_event_loop().time() - session.opened, session.close_reason)
     
-    # Track custom emoji reactions from users
-    custom_reactions = {}
-    
-    # Process all reactions on the message
-    for reaction in message.reactions:
-        # Skip the bot's own A/B option reactions
-        if str(reaction.emoji) == str(emoji_a) or str(reaction.emoji) == str(emoji_b):
-            if reaction.emoji == emoji_a:
-                async for user in reaction.users():
-                    if user != bot.user:
-                        voters_a.append(user)
-            elif reaction.emoji == emoji_b:
-                async for user in reaction.users():
-                    if user != bot.user:
-                        voters_b.append(user)
-        # Process custom user reactions
-        else:
-            users_for_emoji = []
-            async for user in reaction.users():
-                if user != bot.user:
-                    users_for_emoji.append(user)
-            
-            if users_for_emoji:  # Only add emojis that users actually reacted with
-                custom_reactions[str(reaction.emoji)] = users_for_emoji
+    # Read the live tally (or scrape the message if the tally may have missed events)
+    with metrics.tally_seconds.time(), tracing.span("tally"):
+        voters_a, voters_b, custom_reactions = await collect_votes(channel, message, emoji_a, emoji_b)
     
     # Check if there are any votes or custom reactions
-    total_interactions = len(voters_a) + len(voters_b) + sum(len(users) for users in custom_reactions.values())
+    total_interactions = len(voters_a) + len(voters_b) + sum(custom_reactions.values())
     
     # End story only if there are no interactions at all
     if total_interactions == 0:
-        await ctx.send("No one interacted with the story. The story ends here...")
-        if channel_id in story_history:
-            del story_history[channel_id]
-        return
+        await outbox.send("No one interacted with the story. The story ends here...")
+        if speculation is not None:
+            speculation.discard()
+        return False
     
     # Determine winning option (if no votes for A or B, generate a neutral continuation)
     if len(voters_a) + len(voters_b) == 0:
         # No votes for main options, but custom reactions exist
         winning_option = "Neither option was chosen, but the story continues..."
         winning_emoji = "🔄"
-        winning_voters = []
+        winning_voters = set()
         
         # For story continuity, choose a random option
         import random
@@ -206,136 +550,335 @@ async def continue_story(ctx, message, emoji_a, emoji_b, option_a, option_b):
         winning_voters = voters_b
         chosen_option = winning_option
     
-    # Award karma to users who voted for the winning option
-    for user in winning_voters:
-        user_id = str(user.id)
-        karma[user_id] = karma.get(user_id, 0) + 1
-    
-    # Add chosen option to history
-    if channel_id in story_history and story_history[channel_id]:
-        story_history[channel_id][-1]["chosen_option"] = chosen_option
-    
-    # Create full story context for AI
-    full_context = ""
-    for segment in story_history[channel_id]:
-        full_context += segment["narrative"] + "\n\n"
-        if segment["chosen_option"]:
-            full_context += f"**The group chose: {segment['chosen_option']}**\n\n"
+    # Build the story context for AI: a summary of older rounds plus the recent ones, within budget.
+    # Everything before the latest segment is settled, so that part of the prompt can be cached.
+    # The choice is only recorded once the round has been posted, so a failed round can't log it twice
+    context = story_history[channel_id]
+    settled, latest = context.build_split(chosen_option)
+    full_context = settled + latest
+    stable_chars = len(CONTINUE_GUIDELINES) + len(settled)
     
     # Prepare custom elements text from user reactions
     custom_elements_text = ""
+    with tracing.span("emoji"):
+        emoji_descriptions = describe_many(custom_reactions)
     if custom_reactions:
         custom_elements = []
-        for emoji, users in custom_reactions.items():
-            emoji_desc = emoji_to_text(emoji)
+        for emoji, count in custom_reactions.items():
+            emoji_desc = emoji_descriptions[emoji]
             if emoji_desc:
-                custom_elements.append(f"{emoji_desc} (added by {len(users)} {'user' if len(users) == 1 else 'users'})")
+                custom_elements.append(f"{emoji_desc} (added by {count} {'user' if count == 1 else 'users'})")
         
         if custom_elements:
             custom_elements_text = "Additionally, incorporate these elements into the next part of the story in a meaningful way: " + ", ".join(custom_elements) + "."
     
     # Generate next part of the story with improved formatting instructions
-    prompt = (
-        f"{full_context}\n\n"
-        "Continue the story based on the chosen option, following these advanced formatting guidelines:\n"
-        "1. **Transition**: Begin with a brief *italic* summary connecting to the previous choice.\n"
-        "2. **Consequences**: Detail the immediate effects of the choice using vivid sensory descriptions.\n"
-        "3. **Character Development**: Use **bold** for character names and show emotional/physical reactions to events.\n"
-        "4. **Dramatic Moments**: Emphasize key revelations or shocking moments with *italic* or **bold** formatting.\n"
-        "5. **Environmental Changes**: Describe how the setting evolves or responds to the characters' actions.\n"
-        "6. **Dialogue**: Format dialogue with quotation marks, including tone indicators, e.g., \"*We need to hurry,*\" she urged.\n"
-        "7. **Pacing**: Vary paragraph length – short for tension, longer for description and reflection.\n"
-    )
-    
-    # Add custom elements if any
-    if custom_elements_text:
-        prompt += f"\n8. **Special Elements**: {custom_elements_text}\n"
-    
-    prompt += (
-        "\nEnd with exactly two distinct choices labeled as:\n\n"
-        "**A)** [first option] - Make this option carry significant weight and consequences\n"
-        "**B)** [second option] - Make this option provide a completely different direction\n\n"
-        "Ensure each choice creates a meaningful branch in the narrative and maintains emotional investment."
-    )
+    prompt = build_continue_prompt(full_context, custom_elements_text, session.length_instruction)
+    context.record_prompt(prompt)
 
+    session.state = GENERATING
     try:
-        next_segment = await generate_text(prompt)
-        
-        # Check if response has the expected format with bold markdown
-        option_pattern = r'\*\*A\)\*\*(.*?)(?:\n|$).*?\*\*B\)\*\*(.*?)(?:\n|$)'
-        options_match = re.search(option_pattern, next_segment, re.DOTALL)
-        
-        if options_match:
-            new_option_a = options_match.group(1).strip()
-            new_option_b = options_match.group(2).strip()
-        else:
-            # Try alternate pattern without bold formatting
-            alt_pattern = r'A\)(.*?)(?:\n|$).*?B\)(.*?)(?:\n|$)'
-            alt_match = re.search(alt_pattern, next_segment, re.DOTALL)
-            
-            if alt_match:
-                new_option_a = alt_match.group(1).strip()
-                new_option_b = alt_match.group(2).strip()
-                
-                # Add proper formatting if the AI didn't use it
-                narrative_parts = next_segment.split('A)')
-                if len(narrative_parts) > 1:
-                    narrative = narrative_parts[0].strip()
-                    options_part = 'A)' + narrative_parts[1]
-                    formatted_options = options_part.replace('A)', '**A)**').replace('B)', '**B)**')
-                    next_segment = f"{narrative}\n\n{formatted_options}"
-            else:
-                # Fallback if AI didn't format options correctly
-                split_text = next_segment.split('\n\n')
-                narrative = '\n\n'.join(split_text[:-1]) if len(split_text) > 1 else next_segment
-                new_option_a = "Continue cautiously"
-                new_option_b = "Take a risk"
-                next_segment = f"{narrative}\n\n**A)** {new_option_a}\n**B)** {new_option_b}"
-        
-        # Add to story history
-        story_history[channel_id].append({"narrative": next_segment, "chosen_option": None})
-        
-        # Let users know which option won
-        await ctx.send(f"Option {winning_emoji} won with {len(winning_voters)} votes!\n**{winning_option}**")
+        # Let users know which option won, at the top of the new segment's first message
+        outbox.note(f"Option {winning_emoji} won with {len(winning_voters)} votes!\n**{winning_option}**")
         
         # If there were custom reactions, acknowledge them
         if custom_reactions:
-            custom_elements = [emoji_to_text(emoji) for emoji in custom_reactions.keys() if emoji_to_text(emoji)]
+            custom_elements = [desc for desc in emoji_descriptions.values() if desc]
             if custom_elements:
                 elements_text = ", ".join(custom_elements)
-                await ctx.send(f"*The story will also incorporate: {elements_text}*")
+                outbox.note(f"*The story will also incorporate: {elements_text}*")
         
-        # Split and send the new story segment
-        messages = split_message(next_segment)
-        sent_messages = []
-        for message in messages:
-            sent_message = await ctx.send(message)
-            sent_messages.append(sent_message)
+        # Serve the winning branch if it was generated during the vote
+        next_segment = None
+        stream = None
+        if speculation is not None:
+            with tracing.span("speculation"):
+                next_segment = await speculation.take(chosen_option, prompt)
+        
+        if next_segment is None:
+            # A streamed segment is posted as it arrives, so its sends fall inside this span
+            with tracing.span("generate"):
+                if STREAM_RESPONSES and not STRUCTURED_OUTPUT:
+                    next_segment, stream = await stream_segment(outbox, prompt, channel_id, stable_chars, lane_for(channel, CONTINUE))
+                else:
+                    next_segment = await generate_segment(prompt, channel_id, stable_chars, lane_for(channel, CONTINUE))
+        
+        # Pull out the new options, putting them in the expected format if the AI didn't
+        with tracing.span("parse"):
+            next_segment, new_option_a, new_option_b = parse_segment(next_segment, STRUCTURED_OUTPUT)
+        
+        with tracing.span("send"):
+            if stream is not None:
+                # Bring the streamed messages in line with any reformatted options
+                sent_messages = await stream.finish(next_segment)
+            else:
+                # Split and send the new story segment
+                sent_messages = await send_segment(outbox, next_segment)
         
         # Add reactions to the last message with NEW emojis based on the NEW options
         last_message = sent_messages[-1]
-        new_emoji_a, new_emoji_b = get_relevant_emojis(new_option_a, new_option_b)
-        await last_message.add_reaction(new_emoji_a)
-        await last_message.add_reaction(new_emoji_b)
+        with tracing.span("emoji"):
+            new_emoji_a, new_emoji_b = get_relevant_emojis(new_option_a, new_option_b)
+        vote_tally.open_tally(last_message, new_emoji_a, new_emoji_b)
+        with tracing.span("react"):
+            await outbox.react(last_message, new_emoji_a, new_emoji_b)
+        
+        # Players have the new segment, so it joins the history (a round that failed to post is retried without it)
+        context.record_choice(chosen_option)
+        story_log.append(channel_id, CHOICE, chosen_option)
+        context.add_segment(next_segment)
+        story_log.append(channel_id, SEGMENT, next_segment)
+        session.participants.append(set(voters_a) | set(voters_b))
+        
+        # Open the next vote with the NEW options and NEW emojis; the engine closes it
+        length_instruction = output_budget.instruction()
+        next_speculation = start_speculation(channel, context, new_option_a, new_option_b, length_instruction)
+        session.begin_vote(last_message, new_emoji_a, new_emoji_b, new_option_a, new_option_b, next_speculation,
+                           length_instruction)
+        session.failures = 0
+        metrics.rounds.inc()
         
-        # Wait for votes and continue the story with the NEW options and NEW emojis
-        await asyncio.sleep(VOTING_DURATION)
-        await continue_story(ctx, last_message, new_emoji_a, new_emoji_b, new_option_a, new_option_b)
+        # Award karma to users who voted for the winning option, once the round has gone through
+        guild_id = str(channel.guild.id) if getattr(channel, 'guild', None) else None
+        karma.award((str(voter_id) for voter_id in winning_voters), guild_id=guild_id)
+        return True
         
     except Exception as e:
-        await ctx.send(f"An error occurred while continuing the story: {str(e)}")
-        if channel_id in story_history:
-            del story_history[channel_id]
+        metrics.error('continue_story', e)
+        if speculation is not None:
+            speculation.discard()
+        session.failures += 1
+        if session.failures >= MAX_ROUND_FAILURES:
+            await channel.send(f"An error occurred while continuing the story: {str(e)}\nThe story ends here...")
+            return False
+        
+        # One bad round shouldn't end the story: reopen the same vote and try again when it closes.
+        # Its reactions are recounted from Discord then, so votes already cast still count
+        outbox.take_notes()
+        await outbox.send("The storyteller lost the thread for a moment. Voting stays open, and the story continues when it closes.")
+        vote_tally.open_tally(message, emoji_a, emoji_b).stale = True
+        return True
+
+def end_story(session):
+    """Release everything a finished session was holding"""
+    if session.speculation is not None:
+        session.speculation.discard()
+    vote_tally.close_channel(session.channel.id)
+    release_outbox(session.channel.id)
+    gemini_api.release_prompt_cache(session.channel_id)
+    if session.channel_id in story_history:
+        story_history.pop(session.channel_id).close()
+    session_store.delete_later(session.channel_id)
+
+def evict_idle():
+    """
+    Release stories that were abandoned without ending properly
+
+    A context or outbox without a running session is left over from a story
+    that never reached end_story (e.g. its task was cancelled mid-round), and
+    a session that has sat outside a vote for STORY_IDLE_TIMEOUT is stuck.
+    Either way its memory is released; the full story stays in the log.
+
+    Returns:
+        int: Stories evicted
+    """
+    now = time.monotonic()
+    evicted = 0
+    for channel_id, context in list(story_history.items()):
+        session = engine.sessions.get(channel_id)
+        if session is None:
+            story_history.pop(channel_id).close()
+        elif session.state != VOTING and now - context.last_active > STORY_IDLE_TIMEOUT:
+            print(f"Ending abandoned story in channel {channel_id}")
+            engine.end(session)
+        else:
+            continue
+        evicted += 1
+    for channel_id in list(outbound.outboxes):
+        if not engine.is_active(str(channel_id)):
+            release_outbox(channel_id)
+    return evicted
+
+async def sweep_idle():
+    """Evict abandoned stories and prune old story logs, for as long as the bot runs"""
+    while True:
+        await asyncio.sleep(min(STORY_IDLE_TIMEOUT / 4, 300))
+        try:
+            evict_idle()
+            story_log.prune()
+        except Exception as e:
+            metrics.error('sweep_idle', e)
+            print(f"Failed to evict idle stories: {str(e)}")
+
+def checkpoint_session(session):
+    """Save a session's open vote to the shared store so it survives a crash"""
+    context = story_history.get(session.channel_id)
+    if context is None:
+        return
+    
+    state = {
+        "rounds": session.rounds,
+        "message_id": session.message.id,
+        "emoji_a": session.emoji_a,
+        "emoji_b": session.emoji_b,
+        "option_a": session.option_a,
+        "option_b": session.option_b,
+        "deadline": time.time() + engine.time_left(session),
+        "story": context.to_dict(),
+    }
+    guild = getattr(session.channel, 'guild', None)
+    session_store.save_later(session.channel_id, guild.id if guild else None, state)
+
+async def resume_sessions():
+    """Pick up saved stories left behind by a worker that stopped, including this one before a restart"""
+    for channel_id, state in await session_store.claim(SHARD_IDS, SHARD_COUNT):
+        if engine.is_active(channel_id):
+            continue
+        
+        channel = bot.get_channel(int(channel_id))
+        if channel is None:
+            await session_store.delete(channel_id)
+            continue
+        
+        story_history[channel_id] = StoryContext.from_dict(state["story"], summarize=summarizer_for(channel))
+        session = engine.open(channel_id, channel)
+        message = channel.get_partial_message(state["message_id"])
+        session.begin_vote(message, state["emoji_a"], state["emoji_b"], state["option_a"], state["option_b"])
+        session.rounds = state["rounds"]
+        
+        # Reactions made while no worker was listening only exist on Discord, so recount at close
+        vote_tally.open_tally(message, state["emoji_a"], state["emoji_b"]).stale = True
+        engine.schedule_vote(session, max(0, state["deadline"] - time.time()))
+        print(f"Resumed story in channel {channel_id} at round {session.rounds}")
+
+# Openers for popular themes, generated ahead of time (None when disabled)
+opener_cache = OpenerCache(
+    lambda theme: generate_segment(build_opening_prompt(theme), lane=lane_for(None, BACKGROUND))
+) if OPENER_CACHE else None
+
+# Runs every channel's story rounds from a single voting timer
+engine = SessionEngine(
+    continue_story,
+    on_end=end_story,
+    on_vote_open=checkpoint_session,
+    voting_duration=VOTING_DURATION,
+)
+
+metrics.gauge('storybot_active_sessions', "Stories currently running", lambda: len(engine))
+metrics.gauge('storybot_karma_pending', "Karma awards (per guild and user) not yet written to disk", lambda: karma.pending)
+
+if opener_cache is not None:
+    metrics.gauge('storybot_opener_cache_requests', "Opener requests since startup, by whether a ready opener was found",
+                  lambda: {("hit",): opener_cache.hits, ("miss",): opener_cache.misses}, labels=("result",))
+    metrics.gauge('storybot_opener_cache_hit_rate', "Share of opener requests served from the cache",
+                  lambda: opener_cache.report()["hit_rate"])
+    metrics.gauge('storybot_opener_cache_ready', "Pre-generated openers waiting to be used",
+                  lambda: opener_cache.report()["ready"])
+    metrics.gauge('storybot_opener_cache_memory_bytes', "Memory taken up by pre-generated openers",
+                  lambda: opener_cache.report()["memory_bytes"])
 
 @bot.command(name='karma')
 async def check_karma(ctx, member: discord.Member = None):
     """Check karma points for yourself or another user"""
     target = member or ctx.author
     user_id = str(target.id)
-    points = karma.get(user_id, 0)
+    await karma.ready()
+    points = karma.get(user_id)
     
-    await ctx.send(f"{target.display_name} has {points} karma points.")
+    message = f"{target.display_name} has {points} karma points."
+    standing = karma.rank(str(ctx.guild.id), user_id) if ctx.guild else None
+    if standing:
+        rank, guild_points, ranked = standing
+        message += f" Rank #{rank} of {ranked} in this server with {guild_points} points."
+    await ctx.send(message)
+
+# Most entries !leaderboard will show
+LEADERBOARD_MAX = 25
+
+@bot.command(name='leaderboard')
+async def leaderboard(ctx, n: int = 10):
+    """Show the server's top karma earners"""
+    if ctx.guild is None:
+        await ctx.send("Leaderboards are kept per server; try this in a server channel.")
+        return
+    
+    await karma.ready()
+    entries = karma.top(str(ctx.guild.id), max(1, min(n, LEADERBOARD_MAX)))
+    if not entries:
+        await ctx.send("Nobody has earned karma in this server yet.")
+        return
+    
+    lines = []
+    for position, (user_id, points) in enumerate(entries, 1):
+        member = ctx.guild.get_member(int(user_id))
+        name = member.display_name if member else f"User {user_id}"
+        lines.append(f"**{position}.** {name} - {points} points")
+    await ctx.send("**Karma leaderboard**\n" + "\n".join(lines))
+
+@bot.command(name='recap')
+async def recap(ctx):
+    """Replay this channel's story from the beginning"""
+    channel_id = str(ctx.channel.id)
+    if not story_log.exists(channel_id):
+        await ctx.send("There's no story on record for this channel yet. Start one with `!roleplay`.")
+        return
+    
+    # Records are read a few at a time and posted as each message fills up, so long stories never sit in memory
+    outbox = get_outbox(ctx.channel)
+    splitter = MessageSplitter()
+    records = 0
+    try:
+        async for kind, text in story_log.replay(channel_id):
+            if not records:
+                text = f"**The story so far**\n\n{text}"
+            records += 1
+            text = f"{text}\n\n" if kind == SEGMENT else f"**The group chose: {text}**\n\n"
+            for chunk in splitter.feed(text):
+                await outbox.send(chunk)
+        for chunk in splitter.close():
+            await outbox.send(chunk)
+    finally:
+        if not engine.is_active(channel_id):
+            release_outbox(ctx.channel.id)
+    if not records:
+        await ctx.send("There's no story on record for this channel yet. Start one with `!roleplay`.")
+
+@bot.command(name='profile')
+@commands.is_owner()
+async def profile(ctx, seconds: float = 30):
+    """Capture a CPU profile and memory snapshot of the bot for a while (bot owner only)"""
+    await ctx.send(f"Profiling for {min(seconds, profiler.PROFILE_MAX_SECONDS):g} seconds...")
+    try:
+        result = await profiler.capture(seconds)
+    except profiler.ProfileInProgress as e:
+        await ctx.send(str(e))
+        return
+    
+    await ctx.send(
+        f"Wrote `{result['profile']}` (pstats: snakeviz, gprof2dot or `python -m pstats`) and "
+        f"`{result['snapshot']}` (`tracemalloc.Snapshot.load`).\n"
+        f"**Most cumulative time**\n```\n{result['cpu'][:800]}\n```"
+        f"**Largest allocation growth**\n```\n{result['memory'][:800]}\n```"
+    )
+
+@profile.error
+async def profile_error(ctx, error):
+    if isinstance(error, commands.NotOwner):
+        await ctx.send("Only the bot's owner can profile it.")
+    elif isinstance(error, commands.BadArgument):
+        await ctx.send("Usage: `!profile [seconds]`")
+    else:
+        print(f"Profiling failed: {str(error)}")
 
 # Run the bot
 if __name__ == "__main__":
-    bot.run(TOKEN)
+    startup.mark("config")
+    try:
+        bot.run(TOKEN)
+    finally:
+        # Write out any karma awarded since the last flush
+        karma.close()
+        session_store.close()
+        story_log.close()
+        tracing.close()
+        gemini_api.close()
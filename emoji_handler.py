@@ -1,4 +1,6 @@
 import re
+import unicodedata
+from functools import lru_cache
 
 # Dictionary mapping keywords to appropriate emojis
 EMOJI_KEYWORDS = {
@@ -66,184 +68,246 @@ EMOJI_KEYWORDS = {
 # Default emojis if no keywords match
 DEFAULT_EMOJIS = ["🅰️", "🅱️"]
 
-def get_relevant_emojis(option_a, option_b):
+class KeywordMatcher:
+    """
+    Finds emoji keywords in text using a prebuilt index
+
+    Text is tokenized once into whole words and each word (or run of words,
+    for multi-word keywords) is looked up in a dict, so matching never fires
+    inside a longer word and the cost per call doesn't grow with the size of
+    the keyword table.
+    """
+
+    _WORD_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, keywords):
+        """
+        Args:
+            keywords (dict): Mapping of keyword or phrase to emoji
+        """
+        self.index = {}
+        self.max_words = 1
+        for keyword, emoji in keywords.items():
+            words = tuple(self._WORD_PATTERN.findall(keyword.lower()))
+            if words:
+                self.index[words] = emoji
+                self.max_words = max(self.max_words, len(words))
+
+    def candidates(self, text):
+        """
+        List the distinct emojis whose keywords appear in a text
+
+        Args:
+            text (str): The text to search
+
+        Returns:
+            list: Emojis in order of their keyword's first appearance
+        """
+        words = self._WORD_PATTERN.findall(text.lower())
+        found = []
+        seen = set()
+        for start in range(len(words)):
+            # Prefer the longest phrase starting at this word
+            for length in range(min(self.max_words, len(words) - start), 0, -1):
+                emoji = self._lookup(tuple(words[start:start + length]))
+                if emoji is not None:
+                    if emoji not in seen:
+                        seen.add(emoji)
+                        found.append(emoji)
+                    break
+        return found
+
+    def _lookup(self, words):
+        emoji = self.index.get(words)
+        if emoji is None and words[-1].endswith('s'):
+            # Fall back to the singular form ("trees" -> "tree")
+            emoji = self.index.get(words[:-1] + (words[-1][:-1],))
+        return emoji
+
+    def pick(self, options, defaults=None):
+        """
+        Choose one distinct emoji for each of a batch of options
+
+        Each option gets its earliest-mentioned keyword emoji that no earlier
+        option has taken; options without a usable match get a default.
+
+        Args:
+            options (list): The option texts, in display order
+            defaults (list): Fallback emojis, by option position
+
+        Returns:
+            list: One emoji per option, all different
+        """
+        defaults = DEFAULT_EMOJIS if defaults is None else defaults
+        chosen = []
+        for position, option in enumerate(options):
+            emoji = next((e for e in self.candidates(option) if e not in chosen), None)
+            if emoji is None:
+                fallbacks = defaults[position:] + defaults[:position]
+                emoji = next((e for e in fallbacks if e not in chosen), f"{position + 1}\ufe0f\u20e3")
+            chosen.append(emoji)
+        return chosen
+
+# Matcher for the built-in keyword table, built once at import
+keyword_matcher = KeywordMatcher(EMOJI_KEYWORDS)
+
+def get_relevant_emojis(option_a, option_b, matcher=None):
     """
     Get relevant emojis for the two options based on keywords
-    
+
     Args:
         option_a (str): The text for option A
         option_b (str): The text for option B
-        
+        matcher (KeywordMatcher): Matcher to use instead of the built-in table
+
     Returns:
-        tuple: Two emojis (emoji_a, emoji_b) for the options
+        tuple: Two different emojis (emoji_a, emoji_b) for the options
     """
-    emoji_a = None
-    emoji_b = None
-    
-    # Process option A - check entire option text first
-    option_a_lower = option_a.lower()
-    for keyword, emoji in EMOJI_KEYWORDS.items():
-        if keyword in option_a_lower and not emoji_a:
-            emoji_a = EMOJI_KEYWORDS[keyword]
-            break
-    
-    # If no match found, try with individual words
-    if not emoji_a:
-        words_a = re.findall(r'\b\w+\b', option_a_lower)
-        for word in words_a:
-            if word in EMOJI_KEYWORDS and not emoji_a:
-                emoji_a = EMOJI_KEYWORDS[word]
-                break
-    
-    # Process option B - check entire option text first
-    option_b_lower = option_b.lower()
-    for keyword, emoji in EMOJI_KEYWORDS.items():
-        if keyword in option_b_lower and not emoji_b:
-            emoji_b = EMOJI_KEYWORDS[keyword]
-            break
-    
-    # If no match found, try with individual words
-    if not emoji_b:
-        words_b = re.findall(r'\b\w+\b', option_b_lower)
-        for word in words_b:
-            if word in EMOJI_KEYWORDS and not emoji_b:
-                emoji_b = EMOJI_KEYWORDS[word]
-                break
-    
-    # Use default emojis if no matches found
-    if not emoji_a:
-        emoji_a = DEFAULT_EMOJIS[0]
-    if not emoji_b:
-        emoji_b = DEFAULT_EMOJIS[1]
-        
+    emoji_a, emoji_b = (matcher or keyword_matcher).pick([option_a, option_b])
     return emoji_a, emoji_b
 
+# Curated descriptions for common emojis, preferred over Unicode names
+SPECIAL_EMOJIS = {
+    "🔥": "fire", "💧": "water", "🌍": "earth", "💨": "air",
+    "❤️": "love", "💕": "affection", "😂": "laughter", "😊": "happiness",
+    "😢": "sadness", "😡": "anger", "😱": "fear", "🤔": "thinking",
+    "👍": "approval", "👎": "disapproval", "👏": "applause", "🙏": "prayer",
+    "💪": "strength", "🧠": "intelligence", "👁️": "vision", "👂": "hearing",
+    "💰": "wealth", "⚡": "energy", "🎭": "deception", "🎯": "accuracy",
+    "🎮": "game", "🎵": "music", "🎬": "movie", "📚": "knowledge",
+    "🕰️": "time", "🧩": "puzzle", "🧪": "experiment", "🪄": "magic",
+    "🦸": "hero", "🧟": "zombie", "👽": "alien", "🤖": "robot",
+    "🐺": "wolf", "🦊": "fox", "🐉": "dragon", "🦁": "lion",
+    "🌟": "star", "🌈": "rainbow", "🌊": "wave", "🌪️": "tornado",
+    "🏰": "castle", "⚔️": "sword", "🛡️": "shield", "🧙": "wizard",
+    "🔮": "crystal ball", "📜": "scroll", "🧪": "potion", "💎": "gem",
+    "🔫": "gun", "💣": "bomb", "🧨": "dynamite", "🪓": "axe",
+    "🏹": "bow", "🗡️": "dagger", "🪄": "wand", "🧬": "dna",
+    "👑": "crown", "👸": "princess", "🤴": "prince", "👻": "ghost",
+    "💀": "skull", "☠️": "death", "👹": "monster", "👺": "goblin",
+    "🧙‍♂️": "wizard", "🧙‍♀️": "witch", "🧚": "fairy", "🧜": "mermaid",
+    "🐲": "dragon", "🦄": "unicorn", "🦇": "bat", "🦂": "scorpion"
+}
+
+# Generic categories, matched on an emoji's first character
+EMOJI_CATEGORIES = {
+    "😀": "emotion", "🐶": "animal", "🍎": "food", "🏠": "place",
+    "🚗": "vehicle", "👕": "clothing", "💻": "technology", "🎮": "entertainment",
+    "🏆": "achievement", "🌈": "phenomenon", "🔮": "mystical object",
+    "🌿": "plant", "🌋": "natural disaster", "🏛️": "building", "🎭": "performance",
+    "⚽": "sport", "🔧": "tool", "🎁": "gift", "💍": "jewelry", "🎨": "art"
+}
+
+# Words that summarize a "face" emoji better than its full Unicode name
+EMOTION_WORDS = [
+    "happy", "sad", "angry", "surprised", "scared", "laughing", "crying", "winking",
+    "thinking", "confused", "tired", "sleeping", "cool", "nerdy", "sick", "injured",
+    "dead", "shocked", "crazy", "silly", "love", "kiss"
+]
+
+# Prefixes stripped from Unicode names
+NAME_PREFIXES = ["face with", "face", "person", "building", "house", "flag"]
+
+# Discord custom emojis: <:name:id> or animated <a:name:id>
+CUSTOM_EMOJI_PATTERN = re.compile(r'<a?:(\w+):\d+>')
+
+# Variation selectors and skin tone modifiers don't change what an emoji depicts
+_PRESENTATION_MARKS = dict.fromkeys(
+    [0xFE0E, 0xFE0F] + list(range(0x1F3FB, 0x1F400))
+)
+
+def _normalize(emoji):
+    return emoji.translate(_PRESENTATION_MARKS)
+
+def _build_description_table():
+    # Later sources take precedence: categories < keyword table < curated descriptions
+    table = {}
+    for emoji, keyword in {v: k for k, v in EMOJI_KEYWORDS.items()}.items():
+        table[_normalize(emoji)] = keyword
+    for emoji, description in SPECIAL_EMOJIS.items():
+        table[_normalize(emoji)] = description
+    return table
+
+# Descriptions for every known emoji, keyed by normalized sequence
+EMOJI_DESCRIPTIONS = _build_description_table()
+
+# Category for each category emoji's first character
+_CATEGORY_BY_FIRST_CHAR = {emoji[0]: category for emoji, category in EMOJI_CATEGORIES.items()}
+
+def _describe_by_name(char):
+    """Describe one character from its Unicode name, or return None"""
+    name = unicodedata.name(char, "").lower()
+    if not name:
+        return None
+
+    # Clean up the name - remove 'emoji' suffix and convert to a simple description
+    name = name.replace("emoji", "").strip().replace("_", " ").replace("-", " ")
+
+    # If it's a "face" emoji, simplify
+    if "face" in name:
+        for emotion in EMOTION_WORDS:
+            if emotion in name:
+                return emotion
+
+    for prefix in NAME_PREFIXES:
+        if name.startswith(prefix):
+            name = name[len(prefix):].strip()
+
+    # Letters and symbols (like 🅰️, 🅱️) don't describe anything
+    if "letter" in name or "symbol" in name:
+        return None
+
+    return name if len(name) > 1 else None
+
+@lru_cache(maxsize=4096)
+def _describe(emoji):
+    custom_emoji_match = CUSTOM_EMOJI_PATTERN.fullmatch(emoji)
+    if custom_emoji_match:
+        # Use the custom emoji's name, with underscores as spaces
+        return custom_emoji_match.group(1).replace('_', ' ')
+
+    normalized = _normalize(emoji)
+    if normalized in EMOJI_DESCRIPTIONS:
+        return EMOJI_DESCRIPTIONS[normalized]
+
+    # For ZWJ sequences and other combinations, fall back to the parts in order
+    for part in normalized.split('\u200d'):
+        if part in EMOJI_DESCRIPTIONS:
+            return EMOJI_DESCRIPTIONS[part]
+        for char in part:
+            description = _describe_by_name(char)
+            if description:
+                return description
+
+    if emoji and emoji[0] in _CATEGORY_BY_FIRST_CHAR:
+        return _CATEGORY_BY_FIRST_CHAR[emoji[0]]
+
+    if len(emoji) == 1:
+        return "mysterious symbol"
+    return "mysterious element"
+
 def emoji_to_text(emoji):
     """
     Convert an emoji to a descriptive text that can be used in the story generation.
-    Uses a combination of predefined mappings and Unicode character analysis.
-    
+    Known emojis are resolved from a table built at import; anything else is
+    described from its Unicode name and cached.
+
     Args:
         emoji (str): The emoji to convert
-        
+
     Returns:
-        str: Descriptive text for the emoji, or None if not found
+        str: Descriptive text for the emoji
     """
-    # Create reverse mapping from emoji to keyword (use existing predefined keywords)
-    emoji_to_keyword = {v: k for k, v in EMOJI_KEYWORDS.items()}
-    
-    # Check if emoji exists in our mapping
-    if emoji in emoji_to_keyword:
-        return emoji_to_keyword[emoji]
-    
-    # Handle Discord custom emojis (format: <:name:id>)
-    custom_emoji_match = re.match(r'<:(.+):\d+>', emoji)
-    if custom_emoji_match:
-        # Extract the name of the custom emoji, replace underscores with spaces
-        return custom_emoji_match.group(1).replace('_', ' ')
-    
-    # Try unicode emoji description approach - get the Unicode name which usually has descriptive text
-    try:
-        import unicodedata
-        
-        # Split the emoji (might be multiple Unicode characters)
-        for char in emoji:
-            try:
-                # Get the Unicode name - often descriptive
-                name = unicodedata.name(char).lower()
-                
-                # Clean up the name - remove 'emoji' suffix and convert to a simple description
-                if "emoji" in name:
-                    name = name.replace("emoji", "").strip()
-                
-                # Replace underscores and dashes with spaces
-                name = name.replace("_", " ").replace("-", " ")
-                
-                # If it's a "face" emoji, simplify
-                if "face" in name:
-                    emotion_words = ["happy", "sad", "angry", "surprised", 
-                                    "scared", "laughing", "crying", "winking",
-                                    "thinking", "confused", "tired", "sleeping",
-                                    "cool", "nerdy", "sick", "injured", "dead",
-                                    "shocked", "crazy", "silly", "love", "kiss"]
-                    
-                    for emotion in emotion_words:
-                        if emotion in name:
-                            return emotion
-                
-                # Remove common prefixes from Unicode names
-                prefixes_to_remove = ["face with", "face", "person", "building", "house", "flag"]
-                for prefix in prefixes_to_remove:
-                    if name.startswith(prefix):
-                        name = name[len(prefix):].strip()
-                
-                # Special handling for letter/symbol emojis (like 🅰️, 🅱️, etc.)
-                if "letter" in name or "symbol" in name:
-                    continue
-                
-                # If we found a valid description, return it
-                if name and len(name) > 1:
-                    return name.strip()
-                
-            except (ValueError, TypeError):
-                continue
-    except ImportError:
-        pass
-    
-    # Special handling for some common emojis not in our keyword list
-    special_emojis = {
-        "🔥": "fire", "💧": "water", "🌍": "earth", "💨": "air",
-        "❤️": "love", "💕": "affection", "😂": "laughter", "😊": "happiness",
-        "😢": "sadness", "😡": "anger", "😱": "fear", "🤔": "thinking",
-        "👍": "approval", "👎": "disapproval", "👏": "applause", "🙏": "prayer",
-        "💪": "strength", "🧠": "intelligence", "👁️": "vision", "👂": "hearing",
-        "💰": "wealth", "⚡": "energy", "🎭": "deception", "🎯": "accuracy",
-        "🎮": "game", "🎵": "music", "🎬": "movie", "📚": "knowledge",
-        "🕰️": "time", "🧩": "puzzle", "🧪": "experiment", "🪄": "magic",
-        "🦸": "hero", "🧟": "zombie", "👽": "alien", "🤖": "robot",
-        "🐺": "wolf", "🦊": "fox", "🐉": "dragon", "🦁": "lion",
-        "🌟": "star", "🌈": "rainbow", "🌊": "wave", "🌪️": "tornado",
-        "🏰": "castle", "⚔️": "sword", "🛡️": "shield", "🧙": "wizard",
-        "🔮": "crystal ball", "📜": "scroll", "🧪": "potion", "💎": "gem",
-        "🔫": "gun", "💣": "bomb", "🧨": "dynamite", "🪓": "axe",
-        "🏹": "bow", "🗡️": "dagger", "🪄": "wand", "🧬": "dna",
-        "👑": "crown", "👸": "princess", "🤴": "prince", "👻": "ghost",
-        "💀": "skull", "☠️": "death", "👹": "monster", "👺": "goblin",
-        "🧙‍♂️": "wizard", "🧙‍♀️": "witch", "🧚": "fairy", "🧜": "mermaid",
-        "🐲": "dragon", "🦄": "unicorn", "🦇": "bat", "🦂": "scorpion"
-    }
-    
-    if emoji in special_emojis:
-        return special_emojis[emoji]
-    
-    # Try to match emoji partially (for emoji variations)
-    for known_emoji, keyword in emoji_to_keyword.items():
-        if emoji in known_emoji or known_emoji in emoji:
-            return keyword
-    
-    # Generic emoji category detection
-    emoji_categories = {
-        "😀": "emotion", "🐶": "animal", "🍎": "food", "🏠": "place",
-        "🚗": "vehicle", "👕": "clothing", "💻": "technology", "🎮": "entertainment",
-        "🏆": "achievement", "🌈": "phenomenon", "🔮": "mystical object",
-        "🌿": "plant", "🌋": "natural disaster", "🏛️": "building", "🎭": "performance",
-        "⚽": "sport", "🔧": "tool", "🎁": "gift", "💍": "jewelry", "🎨": "art"
-    }
-    
-    # Try to match by first character to identify category
-    if emoji and len(emoji) > 0:
-        first_char = emoji[0]
-        for category_emoji, category in emoji_categories.items():
-            if first_char == category_emoji[0]:
-                return category
-    
-    # Last resort - if it's a single character, just use a simple description
-    if len(emoji) == 1:
-        try:
-            # Use the most basic category or just "symbol" as fallback
-            return "mysterious symbol"
-        except:
-            pass
-    
-    # If nothing else works, at least make an attempt with a generic description
-    return "mysterious element"
+    return _describe(str(emoji))
+
+def describe_many(emojis):
+    """
+    Describe a whole set of emojis at once
+
+    Args:
+        emojis: Iterable of emojis (e.g. the custom reactions on a message)
+
+    Returns:
+        dict: Mapping of each distinct emoji to its description
+    """
+    return {emoji: _describe(str(emoji)) for emoji in emojis}
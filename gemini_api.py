@@ -1,41 +1,484 @@
 import os
+import time
 import asyncio
-from dotenv import load_dotenv
-import google.generativeai as genai
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from prompt_cache import PromptCache
+from story_context import estimate_tokens, CHARS_PER_TOKEN
+import metrics
+import tracing
+from reliability import CallPolicy
+from scheduler import Scheduler, Lane, OUTPUT_ESTIMATE
 
-# Load environment variables
-load_dotenv()
 API_KEY = os.getenv('GEMINI_API_KEY')
 
-# Configure the Gemini API
-genai.configure(api_key=API_KEY)
+# Model used for every story generation
+MODEL_NAME = 'gemini-2.0-flash'
 
-async def generate_text(prompt, max_tokens=2000):
+# Maximum number of Gemini requests allowed in flight at once (per process)
+MAX_IN_FLIGHT = int(os.getenv('GEMINI_MAX_IN_FLIGHT', '8'))
+
+# Send requests somewhere other than Google's API, e.g. "http://127.0.0.1:8765" for a local fake Gemini server
+API_ENDPOINT = os.getenv('GEMINI_API_ENDPOINT')
+
+# SDK transport: "grpc" (the default) or "rest"; a local fake server needs "rest"
+TRANSPORT = os.getenv('GEMINI_TRANSPORT') or None
+
+# Cache the stable prefix of each story's prompts with Gemini context caching
+PROMPT_CACHE = os.getenv('PROMPT_CACHE', 'false').lower() == 'true'
+
+# Sampling temperature for every request (0-2); unset uses the model's default
+TEMPERATURE = float(os.getenv('GEMINI_TEMPERATURE')) if os.getenv('GEMINI_TEMPERATURE') else None
+
+output_budget_used = metrics.histogram('storybot_output_budget_used', "Output tokens as a share of the request's max_output_tokens",
+                                       buckets=(0.25, 0.5, 0.75, 0.9, 1.0))
+truncated = metrics.counter('storybot_output_truncated_total', "Responses cut off at max_output_tokens")
+
+# Open the connection to Gemini in the background at startup instead of on the first request
+GEMINI_WARMUP = os.getenv('GEMINI_WARMUP', 'true').lower() == 'true'
+
+# The google.generativeai module, imported and configured on first use
+_genai = None
+
+def sdk():
+    """
+    Import and configure the Gemini SDK, the first time it is needed
+
+    The SDK pulls in a large dependency tree (protobuf, gRPC, google-auth),
+    so it is kept out of the bot's import path and loaded by the startup
+    warm-up or the first request, whichever comes first.
+
+    Returns:
+        module: The configured google.generativeai module
+    """
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        genai.configure(
+            api_key=API_KEY,
+            transport=TRANSPORT,
+            client_options={"api_endpoint": API_ENDPOINT} if API_ENDPOINT else None,
+        )
+        _genai = genai
+    return _genai
+
+class GeminiClient:
+    """
+    Long-lived Gemini client shared by every story in the process.
+
+    The model object is built once and requests go through the SDK's native
+    async path, so generation never touches the event loop's default executor.
+    Every attempt waits for the scheduler, which caps the requests in flight,
+    keeps within the RPM/TPM quota and shares capacity fairly across guilds.
+    """
+
+    def __init__(self, model_name=MODEL_NAME, max_in_flight=MAX_IN_FLIGHT, prompt_cache=None, policy=None,
+                 scheduler=None):
+        """
+        Args:
+            model_name (str): The model to generate with
+            max_in_flight (int): Maximum requests in flight at once
+            prompt_cache (PromptCache): Caches prompt prefixes for requests
+                that pass a cache key; None disables caching
+            policy (CallPolicy): Deadlines, retries, circuit breaker and
+                hedging for every request; the environment's settings by default
+            scheduler (Scheduler): Admits requests; the environment's quota by default
+        """
+        self.model_name = model_name
+        self.max_in_flight = max_in_flight
+        self.prompt_cache = prompt_cache
+        self.policy = policy or CallPolicy()
+        self.scheduler = scheduler or Scheduler(max_in_flight)
+        self._model = None
+        self._rest_executor = None
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def model(self):
+        """The underlying GenerativeModel, created on first use"""
+        if self._model is None:
+            self._model = sdk().GenerativeModel(self.model_name)
+        return self._model
+
+    @property
+    def in_flight(self):
+        """Requests currently in flight"""
+        return self.scheduler.in_flight
+
+    @property
+    def queued(self):
+        """Requests waiting for the scheduler"""
+        return self.scheduler.queued
+
+    async def generate(self, prompt, generation_config=None, cache_key=None, stable_chars=0, lane=None):
+        """
+        Generate a response for a prompt, waiting for the scheduler if needed
+
+        Args:
+            prompt (str): The prompt to send to the API
+            generation_config (dict): Optional generation settings for this request
+            cache_key (str): The story the prompt belongs to, if its prefix may be cached
+            stable_chars (int): Length of the prompt's stable prefix (see PromptCache.resolve)
+            lane (Lane): Priority, guild and channel the request is scheduled
+                under; unattributed background work by default
+
+        Returns:
+            str: The generated text response
+        """
+        text, _ = await self.generate_with_usage(prompt, generation_config, cache_key, stable_chars, lane)
+        return text
+
+    async def generate_with_usage(self, prompt, generation_config=None, cache_key=None, stable_chars=0, lane=None):
+        """
+        Generate a response for a prompt and report the tokens it used
+
+        Args:
+            As for generate()
+
+        Returns:
+            tuple: The generated text, and a dict of prompt_tokens,
+                cached_tokens and output_tokens
+        """
+        model, contents = await self._resolve(prompt, cache_key, stable_chars)
+        lane = lane or Lane()
+        estimated = estimate_tokens(prompt) + _output_estimate(generation_config)
+        started = time.monotonic()
+        try:
+            response, text = await self.policy.run(partial(self._attempt, model, contents, generation_config, lane, estimated))
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            metrics.error('generate', e)
+            if model is not self.model:
+                self.prompt_cache.invalidate(cache_key, model)
+            raise
+
+        latency = time.monotonic() - started
+        usage = _usage(response)
+        _observe('generate', prompt, len(text), latency, _cache_label(model is not self.model, usage))
+        self.scheduler.settle(estimated, usage["prompt_tokens"] + usage["output_tokens"])
+        _check_budget(generation_config, response, usage)
+        if model is not self.model:
+            self.prompt_cache.record(cache_key, usage, latency)
+        return text, usage
+
+    async def stream(self, prompt, generation_config=None, cache_key=None, stable_chars=0, lane=None):
+        """
+        Generate a response for a prompt, yielding text as it arrives
+
+        The in-flight slot is held until the stream is exhausted or closed.
+        Failures are retried under the call policy until the first fragment
+        has been yielded; after that they are raised to the caller.
+
+        Args:
+            prompt (str): The prompt to send to the API
+            generation_config (dict): As for generate()
+            cache_key (str): As for generate()
+            stable_chars (int): As for generate()
+            lane (Lane): As for generate()
+
+        Yields:
+            str: Successive fragments of the generated text
+        """
+        model, contents = await self._resolve(prompt, cache_key, stable_chars)
+        lane = lane or Lane()
+        estimated = estimate_tokens(prompt) + _output_estimate(generation_config)
+        started = time.monotonic()
+        output_chars = 0
+        chunks = []
+        try:
+            self.policy.check()
+            number = 0
+            while True:
+                try:
+                    async with self.scheduler.slot(lane, estimated):
+                        async for chunk in self._stream_chunks(model, contents, generation_config):
+                            chunks.append(chunk)
+                            text = _chunk_text(chunk)
+                            if text:
+                                output_chars += len(text)
+                                yield text
+                    break
+                except Exception as e:
+                    # Text already shown can't be taken back, so only a stream that hasn't started is retried
+                    if output_chars:
+                        self.policy.record_error(e)
+                        raise
+                    if not await self.policy.retry_after(e, number):
+                        raise
+                    number += 1
+                    chunks = []
+            self.policy.breaker.record_success()
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            metrics.error('stream', e)
+            if model is not self.model:
+                self.prompt_cache.invalidate(cache_key, model)
+            raise
+
+        latency = time.monotonic() - started
+        # Usage is reported on the last chunk of a stream
+        usage = _usage(chunks[-1]) if chunks else None
+        _observe('stream', prompt, output_chars, latency, _cache_label(model is not self.model, usage))
+        if usage is not None:
+            self.scheduler.settle(estimated, usage["prompt_tokens"] + usage["output_tokens"])
+            _check_budget(generation_config, chunks[-1], usage)
+        if model is not self.model and usage is not None:
+            self.prompt_cache.record(cache_key, usage, latency)
+
+    async def _attempt(self, model, contents, generation_config, lane, estimated):
+        # One try at a complete response; the deadline starts once the scheduler lets it through
+        queued = time.monotonic()
+        async with self.scheduler.slot(lane, estimated):
+            started = time.monotonic()
+            tracing.record("gemini:queue", queued, started - queued)
+            try:
+                response = await self.policy.timed(self._request(model, contents, generation_config=generation_config))
+            except asyncio.CancelledError:
+                # E.g. the losing copy of a hedged request: the prompt was sent, but the output reserved for it won't come
+                self.scheduler.settle(estimated, estimated - _output_estimate(generation_config))
+                raise
+            finally:
+                tracing.record("gemini:request", started, time.monotonic() - started)
+            return response, response.text.strip()
+
+    async def _stream_chunks(self, model, contents, generation_config):
+        if TRANSPORT == 'rest':
+            # Streaming needs the async client, so over REST the response comes in one piece
+            yield await self.policy.timed(self._request(model, contents, generation_config=generation_config))
+            return
+        response = await self.policy.timed(
+            model.generate_content_async(contents, generation_config=generation_config, stream=True)
+        )
+        chunks = response.__aiter__()
+        while True:
+            # Each chunk gets the full deadline, so a stream that stalls midway still fails
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), self.policy.deadline)
+            except StopAsyncIteration:
+                return
+            yield chunk
+
+    async def _resolve(self, prompt, cache_key, stable_chars):
+        # Pick the model (plain or bound to a cached prefix) and what is left of the prompt to send
+        if self.prompt_cache is None or cache_key is None:
+            return self.model, prompt
+        model, contents = await self.prompt_cache.resolve(cache_key, prompt, stable_chars)
+        if model is None:
+            return self.model, prompt
+        return model, contents
+
+    async def warm_up(self):
+        """
+        Load the SDK, build the model and open the connection to Gemini
+
+        Sends a token count, which is free and quick, over the same transport
+        generation uses, so the first real request finds the connection (and
+        the TLS session) already established.
+        """
+        loop = asyncio.get_event_loop()
+        # The SDK import is slow and holds up whatever thread runs it, so keep it off the event loop
+        model = await loop.run_in_executor(self._executor(), lambda: self.model)
+        if TRANSPORT == 'rest':
+            await loop.run_in_executor(self._executor(), model.count_tokens, "warm-up")
+        else:
+            await model.count_tokens_async("warm-up")
+
+    def _executor(self):
+        # Worker threads for the SDK's blocking calls: its setup, and every request over REST
+        # (the SDK's async client doesn't support REST)
+        if self._rest_executor is None:
+            self._rest_executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='gemini-rest')
+        return self._rest_executor
+
+    async def _request(self, model, contents, **kwargs):
+        if TRANSPORT == 'rest':
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._executor(), partial(model.generate_content, contents, **kwargs))
+        return await model.generate_content_async(contents, **kwargs)
+
+    def stats(self):
+        """
+        Report the current load on the client
+
+        Returns:
+            dict: In-flight and queued request counts plus lifetime totals
+        """
+        return dict(
+            self.scheduler.stats(),
+            max_in_flight=self.max_in_flight,
+            completed=self.completed,
+            failed=self.failed,
+        )
+
+def _observe(mode, prompt, output_chars, latency, cache):
+    # One request's latency and sizes, for the /metrics endpoint
+    metrics.generation_seconds.observe(latency, mode, cache)
+    metrics.prompt_tokens.observe(estimate_tokens(prompt))
+    metrics.response_tokens.observe((output_chars + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN)
+
+def _cache_label(cached_model, usage):
+    # Whether a request went through the prompt cache and had part of its input served from it
+    if not cached_model:
+        return "off"
+    return "hit" if usage is not None and usage["cached_tokens"] else "miss"
+
+def _output_estimate(generation_config):
+    # Output tokens to reserve with the scheduler: the usual estimate, unless the request is capped lower
+    cap = (generation_config or {}).get("max_output_tokens")
+    return min(OUTPUT_ESTIMATE, cap) if cap else OUTPUT_ESTIMATE
+
+def _check_budget(generation_config, response, usage):
+    # How much of its max_output_tokens a response used, and whether it was cut off
+    cap = (generation_config or {}).get("max_output_tokens")
+    if cap and usage["output_tokens"]:
+        output_budget_used.observe(usage["output_tokens"] / cap)
+    if _finish_reason(response) == 'MAX_TOKENS':
+        truncated.inc()
+
+def _finish_reason(response):
+    candidates = getattr(response, 'candidates', None)
+    reason = getattr(candidates[0], 'finish_reason', None) if candidates else None
+    return getattr(reason, 'name', reason)
+
+def build_generation_config(max_tokens=None, temperature=TEMPERATURE, stop_sequences=None, json_output=False):
+    """
+    Build the generation config for a request
+
+    Args:
+        max_tokens (int): Most tokens the response may contain
+        temperature (float): Sampling temperature; None for the model's default
+        stop_sequences (list): Strings that end the response where they appear
+            (up to 5; the sequence itself isn't included)
+        json_output (bool): Ask the model to respond with a JSON object
+
+    Returns:
+        dict: The config, or None if nothing is set
+    """
+    config = {}
+    if max_tokens:
+        config["max_output_tokens"] = max_tokens
+    if temperature is not None:
+        config["temperature"] = temperature
+    if stop_sequences:
+        config["stop_sequences"] = list(stop_sequences)
+    if json_output:
+        config["response_mime_type"] = "application/json"
+    return config or None
+
+def _usage(response):
+    # Token counts from the response's usage metadata (missing fields count as 0)
+    metadata = getattr(response, 'usage_metadata', None)
+    return {
+        "prompt_tokens": getattr(metadata, 'prompt_token_count', 0) or 0,
+        "cached_tokens": getattr(metadata, 'cached_content_token_count', 0) or 0,
+        "output_tokens": getattr(metadata, 'candidates_token_count', 0) or 0,
+    }
+
+def _chunk_text(chunk):
+    # Streamed chunks that carry only metadata (e.g. the finish reason) have no text parts
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+# Process-wide client, created on first use
+_client = None
+
+def get_client():
+    """Return the shared GeminiClient, creating it if necessary"""
+    global _client
+    if _client is None:
+        _client = GeminiClient(prompt_cache=PromptCache() if PROMPT_CACHE else None)
+    return _client
+
+# Load on the shared client, read whenever metrics are collected
+metrics.gauge('storybot_generation_in_flight', "Gemini requests in flight", lambda: _client.in_flight if _client else 0)
+metrics.gauge('storybot_generation_queued', "Gemini requests waiting for the scheduler", lambda: _client.queued if _client else 0)
+
+async def warm_up():
+    """
+    Get the shared client ready for its first request, if GEMINI_WARMUP is on
+
+    Failures are logged rather than raised: the first real request will
+    simply pay the setup cost instead.
+
+    Returns:
+        float: Seconds the warm-up took, or None if it was skipped or failed
+    """
+    if not GEMINI_WARMUP or not API_KEY:
+        return None
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(get_client().warm_up(), get_client().policy.deadline)
+    except Exception as e:
+        metrics.error('warm_up', e)
+        print(f"Gemini warm-up failed, the first request will connect instead: {e}")
+        return None
+    return time.monotonic() - started
+
+def release_prompt_cache(cache_key):
+    """Drop a story's cached prompt prefix once the story is over"""
+    if _client is not None and _client.prompt_cache is not None:
+        _client.prompt_cache.release(cache_key)
+
+def close():
+    """Delete any cached prompt prefixes; call once the event loop has stopped"""
+    if _client is not None and _client.prompt_cache is not None:
+        _client.prompt_cache.close()
+
+async def generate_text(prompt, max_tokens=2000, json_output=False, cache_key=None, stable_chars=0, lane=None,
+                        temperature=TEMPERATURE, stop_sequences=None):
     """
     Generate text using Google's Gemini 2.0 Flash API
-    
+
     Args:
         prompt (str): The prompt to send to the API
         max_tokens (int): Maximum number of tokens to generate
-        
+        json_output (bool): Ask the model to respond with a JSON object
+        cache_key (str): The story the prompt belongs to, if its prefix may be cached
+        stable_chars (int): Length of the prompt's prefix that stays the same between rounds
+        lane (Lane): Priority, guild and channel to schedule the request under
+        temperature (float): Sampling temperature; GEMINI_TEMPERATURE by default
+        stop_sequences (list): Strings that end the response where they appear
+
     Returns:
         str: The generated text response
     """
     if not API_KEY:
         raise ValueError("GEMINI_API_KEY not found in environment variables")
-    
+
+    generation_config = build_generation_config(max_tokens, temperature, stop_sequences, json_output)
     try:
-        # Set up the model
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        # Run the API call in a thread pool to avoid blocking the event loop
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: model.generate_content(prompt)
-        )
-        
-        # Extract the text from the response
-        return response.text.strip()
+        return await get_client().generate(prompt, generation_config, cache_key, stable_chars, lane)
+    except Exception as e:
+        raise Exception(f"Failed to generate text: {str(e)}") from e
+
+async def stream_text(prompt, max_tokens=2000, cache_key=None, stable_chars=0, lane=None, temperature=TEMPERATURE,
+                      stop_sequences=None):
+    """
+    Stream text from Google's Gemini 2.0 Flash API as it is generated
+
+    Args:
+        prompt (str): The prompt to send to the API
+        max_tokens (int): Maximum number of tokens to generate
+        cache_key (str): The story the prompt belongs to, if its prefix may be cached
+        stable_chars (int): Length of the prompt's prefix that stays the same between rounds
+        lane (Lane): Priority, guild and channel to schedule the request under
+        temperature (float): Sampling temperature; GEMINI_TEMPERATURE by default
+        stop_sequences (list): Strings that end the response where they appear
+
+    Yields:
+        str: Successive fragments of the generated text
+    """
+    if not API_KEY:
+        raise ValueError("GEMINI_API_KEY not found in environment variables")
+
+    generation_config = build_generation_config(max_tokens, temperature, stop_sequences)
+    try:
+        async for fragment in get_client().stream(prompt, generation_config, cache_key, stable_chars, lane):
+            yield fragment
     except Exception as e:
-        raise Exception(f"Failed to generate text: {str(e)}")
+        raise Exception(f"Failed to generate text: {str(e)}") from e
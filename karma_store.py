@@ -0,0 +1,303 @@
+import os
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from leaderboard import Leaderboard
+
+# SQLite database holding karma totals
+KARMA_DB_PATH = os.getenv('KARMA_DB_PATH', 'karma.db')
+
+# Seconds between flushes of buffered karma awards to disk
+KARMA_FLUSH_INTERVAL = float(os.getenv('KARMA_FLUSH_INTERVAL', '5'))
+
+# Seconds between reloads of the cache from disk, to pick up other processes' awards (0 = never)
+KARMA_REFRESH_INTERVAL = float(os.getenv('KARMA_REFRESH_INTERVAL', '0'))
+
+class KarmaStore:
+    """
+    Karma totals persisted in SQLite with an in-memory cache in front
+
+    Reads are served from the cache. Awards update the cache immediately and
+    are buffered as per-user deltas, which are written in one transaction per
+    flush. Writes are increments rather than overwrites, so several processes
+    can share the same database file without losing each other's awards.
+
+    Besides each user's overall total, karma is tallied per guild, and each
+    guild's totals are held in a Leaderboard for top-N and rank queries.
+
+    Totals are loaded by start(), on the writer thread, so neither import nor
+    the event loop waits on a million users. A refresh doesn't rebuild
+    anything: SQLite compares the tables with a snapshot of what this
+    process last saw, and only the totals other processes changed are
+    applied, one Leaderboard.add() each.
+    """
+
+    def __init__(self, path=KARMA_DB_PATH):
+        """
+        Args:
+            path (str): Path of the SQLite database file
+        """
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS karma ("
+            "user_id TEXT PRIMARY KEY, "
+            "points INTEGER NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS guild_karma ("
+            "guild_id TEXT NOT NULL, "
+            "user_id TEXT NOT NULL, "
+            "points INTEGER NOT NULL, "
+            "PRIMARY KEY (guild_id, user_id))"
+        )
+        # The totals as this process last saw them, kept by this connection only, for finding others' changes
+        self._db.execute("CREATE TEMP TABLE IF NOT EXISTS seen_karma (user_id TEXT PRIMARY KEY, points INTEGER NOT NULL)")
+        self._db.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS seen_guild_karma ("
+            "guild_id TEXT NOT NULL, user_id TEXT NOT NULL, points INTEGER NOT NULL, "
+            "PRIMARY KEY (guild_id, user_id))"
+        )
+        self._db.commit()
+
+        # Empty until start() has loaded the totals on disk; awards made meanwhile are kept
+        self.cache = {}
+        self.boards = {}
+        # (guild id or None, user id) -> points not yet written
+        self._pending = {}
+        # All disk access after startup goes through this one thread so the event loop never blocks on it
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='karma-writer')
+        self._loading = None
+        self._flusher = None
+
+    def get(self, user_id):
+        """
+        Look up a user's karma
+
+        Args:
+            user_id (str): The user's id
+
+        Returns:
+            int: The user's karma points
+        """
+        return self.cache.get(user_id, 0)
+
+    def award(self, user_ids, points=1, guild_id=None):
+        """
+        Give karma to a group of users
+
+        Args:
+            user_ids: Iterable of user ids (str)
+            points (int): Points to add for each user
+            guild_id (str): The guild the karma was earned in, if any
+        """
+        board = self._board(guild_id) if guild_id is not None else None
+        for user_id in user_ids:
+            self.cache[user_id] = self.cache.get(user_id, 0) + points
+            key = (guild_id, user_id)
+            self._pending[key] = self._pending.get(key, 0) + points
+            if board is not None:
+                board.add(user_id, points)
+
+    def top(self, guild_id, n=10):
+        """
+        The guild's highest karma totals
+
+        Args:
+            guild_id (str): The guild's id
+            n (int): How many entries to return
+
+        Returns:
+            list: (user_id, points) tuples, best first
+        """
+        board = self.boards.get(guild_id)
+        return board.top(n) if board is not None else []
+
+    def rank(self, guild_id, user_id):
+        """
+        A user's standing in a guild
+
+        Args:
+            guild_id (str): The guild's id
+            user_id (str): The user's id
+
+        Returns:
+            tuple: (rank, points, users on the board), or None if the user
+                has no karma in the guild
+        """
+        board = self.boards.get(guild_id)
+        rank = board.rank(user_id) if board is not None else None
+        if rank is None:
+            return None
+        return rank, board.points[user_id], len(board)
+
+    @property
+    def pending(self):
+        """Number of (guild, user) awards not yet written to disk"""
+        return len(self._pending)
+
+    def flush(self):
+        """
+        Write buffered awards to disk in a single transaction
+
+        Returns:
+            int: Number of user rows written
+        """
+        batch, self._pending = self._pending, {}
+        try:
+            return self._write(batch)
+        except sqlite3.Error:
+            self._requeue(batch)
+            raise
+
+    async def flush_async(self):
+        """Like flush(), but runs the write on the store's writer thread"""
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        loop = asyncio.get_event_loop()
+        try:
+            written = await loop.run_in_executor(self._writer, self._write, batch)
+        except sqlite3.Error:
+            self._requeue(batch)
+            raise
+        metrics.karma_flushes.inc()
+        return written
+
+    async def load(self):
+        """Read every total from disk on the writer thread, keeping awards made in the meantime"""
+        loop = asyncio.get_event_loop()
+        totals, boards = await loop.run_in_executor(self._writer, self._load)
+        for (guild_id, user_id), points in self._pending.items():
+            totals[user_id] = totals.get(user_id, 0) + points
+            if guild_id is not None:
+                boards.setdefault(guild_id, Leaderboard()).add(user_id, points)
+        self.cache = totals
+        self.boards = boards
+
+    async def ready(self):
+        """Wait until start() has loaded the totals on disk"""
+        if self._loading is not None:
+            await asyncio.shield(self._loading)
+
+    async def refresh(self):
+        """Pick up the awards other processes have written since this one last looked"""
+        loop = asyncio.get_event_loop()
+        totals, guild_totals = await loop.run_in_executor(self._writer, self._read_changes)
+        # Only other processes' awards show up here, so awards not yet flushed are already counted
+        for user_id, change in totals:
+            self.cache[user_id] = self.cache.get(user_id, 0) + change
+        for guild_id, user_id, change in guild_totals:
+            self._board(guild_id).add(user_id, change)
+
+    def start(self, interval=KARMA_FLUSH_INTERVAL, refresh_interval=KARMA_REFRESH_INTERVAL):
+        """
+        Load the totals on disk, then start flushing buffered awards in the background
+
+        Args:
+            interval (float): Seconds between flushes
+            refresh_interval (float): Seconds between refreshes, or 0 to never refresh
+        """
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self.load())
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_periodically(interval, refresh_interval))
+
+    def close(self):
+        """Stop the background flusher, write any remaining awards and close the database"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+        self._writer.shutdown(wait=True)
+        self.flush()
+        self._db.close()
+
+    async def _flush_periodically(self, interval, refresh_interval):
+        await self.ready()
+        loop = asyncio.get_event_loop()
+        last_refresh = loop.time()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_async()
+                if refresh_interval and loop.time() - last_refresh >= refresh_interval:
+                    await self.refresh()
+                    last_refresh = loop.time()
+            except sqlite3.Error as e:
+                metrics.error('karma', e)
+                print(f"Failed to save karma: {str(e)}")
+
+    def _write(self, batch):
+        if not batch:
+            return 0
+        totals = {}
+        for (_, user_id), points in batch.items():
+            totals[user_id] = totals.get(user_id, 0) + points
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO karma (user_id, points) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET points = points + excluded.points",
+                totals.items(),
+            )
+            guild_rows = [(guild_id, user_id, points) for (guild_id, user_id), points in batch.items() if guild_id is not None]
+            self._db.executemany(
+                "INSERT INTO guild_karma (guild_id, user_id, points) VALUES (?, ?, ?) "
+                "ON CONFLICT(guild_id, user_id) DO UPDATE SET points = points + excluded.points",
+                guild_rows,
+            )
+            # This process's own awards are already in its cache, so they mustn't look like changes at the next refresh
+            self._db.executemany(
+                "INSERT INTO seen_karma (user_id, points) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET points = points + excluded.points",
+                totals.items(),
+            )
+            self._db.executemany(
+                "INSERT INTO seen_guild_karma (guild_id, user_id, points) VALUES (?, ?, ?) "
+                "ON CONFLICT(guild_id, user_id) DO UPDATE SET points = points + excluded.points",
+                guild_rows,
+            )
+        return len(totals)
+
+    def _load(self):
+        # Snapshot the tables, then read the snapshot; guild rows come in rank order, so no board has to sort
+        with self._db:
+            self._db.execute("DELETE FROM seen_karma")
+            self._db.execute("DELETE FROM seen_guild_karma")
+            self._db.execute("INSERT INTO seen_karma SELECT user_id, points FROM karma")
+            self._db.execute("INSERT INTO seen_guild_karma SELECT guild_id, user_id, points FROM guild_karma")
+        totals = dict(self._db.execute("SELECT user_id, points FROM seen_karma"))
+        guild_totals = {}
+        for guild_id, user_id, points in self._db.execute(
+            "SELECT guild_id, user_id, points FROM seen_guild_karma ORDER BY guild_id, points DESC, user_id"
+        ):
+            guild_totals.setdefault(guild_id, {})[user_id] = points
+        return totals, {guild_id: Leaderboard(points) for guild_id, points in guild_totals.items()}
+
+    def _read_changes(self):
+        # Rows whose points differ from the snapshot, as (key..., change), with the snapshot brought up to date
+        totals = self._db.execute(
+            "SELECT k.user_id, k.points, k.points - COALESCE(s.points, 0) FROM karma k "
+            "LEFT JOIN seen_karma s ON s.user_id = k.user_id WHERE s.points IS NOT k.points"
+        ).fetchall()
+        guild_totals = self._db.execute(
+            "SELECT k.guild_id, k.user_id, k.points, k.points - COALESCE(s.points, 0) FROM guild_karma k "
+            "LEFT JOIN seen_guild_karma s ON s.guild_id = k.guild_id AND s.user_id = k.user_id "
+            "WHERE s.points IS NOT k.points"
+        ).fetchall()
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO seen_karma VALUES (?, ?)", (row[:2] for row in totals))
+            self._db.executemany("INSERT OR REPLACE INTO seen_guild_karma VALUES (?, ?, ?)", (row[:3] for row in guild_totals))
+        return [(row[0], row[2]) for row in totals], [(row[0], row[1], row[3]) for row in guild_totals]
+
+    def _board(self, guild_id):
+        board = self.boards.get(guild_id)
+        if board is None:
+            board = self.boards[guild_id] = Leaderboard()
+        return board
+
+    def _requeue(self, batch):
+        # Put a failed batch back so its awards are retried on the next flush
+        for key, points in batch.items():
+            self._pending[key] = self._pending.get(key, 0) + points
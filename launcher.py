@@ -0,0 +1,99 @@
+"""
+Run the bot as several worker processes, each connected to a range of Discord shards
+
+Workers share karma and running stories through SQLite files (KARMA_DB_PATH,
+SHARED_STATE_PATH). A worker that exits is restarted on the same shards and
+resumes the stories it was running; stories from a worker that stays down
+can be claimed by any worker serving their shard once its lease expires.
+
+Usage: SHARD_COUNT=4 WORKERS=2 python launcher.py
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Total number of Discord shards across all workers
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '2'))
+
+# Number of worker processes to split the shards between
+WORKERS = int(os.getenv('WORKERS', '2'))
+
+# Seconds to wait before restarting a worker that exited
+WORKER_RESTART_DELAY = float(os.getenv('WORKER_RESTART_DELAY', '5'))
+
+# Discord allows one shard to identify every 5 seconds, so stagger worker startups
+IDENTIFY_DELAY = 5
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+def shard_ranges(shard_count, workers):
+    """
+    Split shard ids into contiguous, nearly equal ranges
+
+    Args:
+        shard_count (int): Total number of shards
+        workers (int): Number of worker processes
+
+    Returns:
+        list: One list of shard ids per worker (workers beyond shard_count get none)
+    """
+    base, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for worker in range(workers):
+        size = base + (1 if worker < extra else 0)
+        if size:
+            ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+def spawn(worker, shard_ids):
+    """Start one worker process for the given shards"""
+    env = dict(
+        os.environ,
+        SHARD_COUNT=str(SHARD_COUNT),
+        SHARD_IDS=",".join(str(shard_id) for shard_id in shard_ids),
+        WORKER_ID=f"worker-{worker}",
+    )
+    # Workers award karma independently, so each one reloads the others' totals
+    env.setdefault('KARMA_REFRESH_INTERVAL', '60')
+    print(f"Starting worker {worker} on shards {shard_ids}")
+    return subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+
+def main():
+    ranges = shard_ranges(SHARD_COUNT, WORKERS)
+    processes = {}
+    restart_at = {}
+
+    for worker, shard_ids in enumerate(ranges):
+        processes[worker] = spawn(worker, shard_ids)
+        time.sleep(IDENTIFY_DELAY * len(shard_ids))
+
+    try:
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            for worker, process in processes.items():
+                if worker in restart_at:
+                    if now >= restart_at[worker]:
+                        del restart_at[worker]
+                        processes[worker] = spawn(worker, ranges[worker])
+                    continue
+                code = process.poll()
+                if code is not None:
+                    print(f"Worker {worker} exited with code {code}; restarting in {WORKER_RESTART_DELAY}s")
+                    restart_at[worker] = now + WORKER_RESTART_DELAY
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # SIGINT lets each worker shut down cleanly and flush its karma
+        for process in processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes.values():
+            process.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+from sortedcontainers import SortedList
+
+class Leaderboard:
+    """
+    Karma totals for one guild, kept in rank order
+
+    Totals live in a dict and, alongside it, in a sorted list of
+    (-points, user_id) pairs, so an award is one removal and one insertion
+    and top-N or rank queries are a slice or a bisect - all O(log n).
+    """
+
+    def __init__(self, totals=None):
+        """
+        Args:
+            totals (dict): Initial user id -> points
+        """
+        self.points = dict(totals or {})
+        self._order = SortedList((-points, user_id) for user_id, points in self.points.items())
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, user_id, points):
+        """
+        Change a user's total
+
+        Args:
+            user_id (str): The user's id
+            points (int): Points to add (may be negative)
+        """
+        old = self.points.get(user_id)
+        if old is not None:
+            self._order.remove((-old, user_id))
+        new = (old or 0) + points
+        self.points[user_id] = new
+        self._order.add((-new, user_id))
+
+    def top(self, n):
+        """
+        The highest totals, best first
+
+        Args:
+            n (int): How many entries to return
+
+        Returns:
+            list: (user_id, points) tuples; ties are ordered by user id
+        """
+        return [(user_id, -negated) for negated, user_id in self._order.islice(0, n)]
+
+    def rank(self, user_id):
+        """
+        A user's position on the board
+
+        Users with equal totals share a rank, so this is one more than the
+        number of users with strictly more points.
+
+        Args:
+            user_id (str): The user's id
+
+        Returns:
+            int: The 1-based rank, or None if the user has no karma here
+        """
+        points = self.points.get(user_id)
+        if points is None:
+            return None
+        # "" sorts before every user id, so this lands ahead of everyone on the same total
+        return self._order.bisect_left((-points, "")) + 1
@@ -1,3 +1,427 @@
+import re
+import time
+from collections import deque
+
+# Newlines and runs of asterisks are the only characters that change markdown state
+_RUNS = re.compile(r'\n|\*+')
+
+# The same, but a stretch of plain text and complete **bold** or *italic* spans (with no markup
+# inside) is matched whole: it leaves the state as it found it, so it needs no handling of its own
+# (a span holds no asterisks, so it can only close at the next run and is matched without backtracking)
+_MARKUP = re.compile(
+    r'\n|(?P<clean>(?:[^*\n]+'
+    r'|\*\*[^\s*][^*\n]*(?<=[^\s*])\*\*(?!\*)'
+    r'|\*[^\s*][^*\n]*(?<=[^\s*])\*(?!\*))+)'
+    r'|\*+'
+)
+
+# What can close a bold or an italic span: asterisks right after text
+_BOLD_CLOSER = re.compile(r'(?<=[^\s*])\*\*')
+_ITALIC_CLOSER = re.compile(r'(?<=[^\s*])\*')
+
+# The end of a sentence is one of these followed by a space
+_SENTENCE_ENDS = ('.', '!', '?')
+
+# Longest markup a forced cut can add: closing "*" + "**" here, or reopening "> " + "**" + "*" next chunk
+_CLOSER_ROOM = 3
+
+# Characters past the window needed to recognize a boundary at its edge ("\n\n", "***" and what follows)
+_LOOKAHEAD = 4
+
+class MessageSplitter:
+    """
+    Incrementally split text into chunks that fit Discord's character limit
+
+    Text can be fed in fragments as it arrives; each call returns the chunks
+    that are finished. Chunks end at the last paragraph break that fits,
+    otherwise at a line break, a sentence end or a space, in that order.
+    A chunk never ends inside a **bold** or *italic* span or partway through
+    a "> " quoted line unless a single span is longer than the limit; then
+    the span is closed at the end of the chunk and reopened in the next one.
+    Asterisks that nothing closes before the paragraph ends are plain text,
+    as Discord shows them, so while text is still arriving a chunk waits
+    until it is clear whether they open a span.
+
+    Paragraph breaks are found with rfind and need no further checks, since
+    spans never continue past one. Only when a chunk has to end inside a
+    paragraph is it scanned for markup, and then plain text and complete
+    spans are skipped over in one regex match; only line breaks and
+    unbalanced asterisks are handled one by one. Whether a cut would land
+    inside one of the skipped spans is worked out when a cut is tried, by
+    counting asterisk runs. Scans stop a few characters past the chunk being
+    cut, so each character is scanned a bounded number of times and
+    splitting is linear in the length of the text; the chunks are the same
+    however the text is fragmented.
+    """
+
+    def __init__(self, char_limit=2000):
+        """
+        Args:
+            char_limit (int): The character limit for each chunk
+        """
+        self.char_limit = char_limit
+        self._buffer = ""
+        self._start = 0
+        self._carry = ""
+        self._scan = 0
+        self._window_end = 0
+        self._bold = False
+        self._italic = False
+        self._quote = False
+        # Offsets of line breaks outside any span
+        self._lines = deque()
+        # Disjoint (begin, end) ranges where a span or quoted line is open, plus the one still open
+        self._blocked = deque()
+        self._blocked_since = None
+        # [begin, end] stretches scanned while nothing was open, holding complete spans not listed in _blocked
+        self._clean = deque()
+        # Offsets of asterisk runs found to be plain text, and per kind of closer a stretch known to hold none
+        self._literal = set()
+        self._searched = {}
+        # Closers a chunk is waiting on, with text that arrived meanwhile and its last two characters
+        self._waiting = None
+        self._queued = []
+        self._tail = ""
+
+    @property
+    def pending(self):
+        """The text of the chunk that is still being filled, up to char_limit characters"""
+        text = self._carry + self._buffer[self._start:self._start + self.char_limit].lstrip()
+        return text[:self.char_limit]
+
+    def feed(self, fragment):
+        """
+        Add text to the splitter
+
+        Args:
+            fragment (str): The next piece of text
+
+        Returns:
+            list: Chunks completed by this fragment, in order
+        """
+        if self._waiting is not None:
+            # Nothing is cut until a closer or paragraph break turns up, so hold text back until one might have
+            text = self._tail + fragment
+            self._tail = text[-2:]
+            self._queued.append(fragment)
+            if '\n\n' not in text and not any(pattern.search(text) for pattern in self._waiting):
+                return []
+            fragment = "".join(self._queued)
+            self._queued.clear()
+            self._waiting = None
+        self._buffer += fragment
+        chunks = self._drain(final=False)
+        if self._start > len(self._buffer) // 2 + 1:
+            self._compact()
+        return chunks
+
+    def close(self):
+        """
+        Finish the text
+
+        Returns:
+            list: The remaining chunks, in order
+        """
+        self._buffer += "".join(self._queued)
+        chunks = self._drain(final=True)
+        rest = self.pending.strip()
+        if rest:
+            chunks.append(rest)
+        # Start over, ready for another text
+        self.__init__(self.char_limit)
+        return chunks
+
+    def _drain(self, final):
+        chunks = []
+        while True:
+            budget = self.char_limit - len(self._carry)
+            if len(self._buffer) - self._start <= budget:
+                return chunks
+            self._window_end = self._start + budget
+            if not final and len(self._buffer) <= self._window_end + _LOOKAHEAD:
+                return chunks
+            index = self._buffer.rfind('\n\n', self._start + 1, self._window_end + 2)
+            if index >= 0:
+                chunk = self._emit(index, "", "")
+                if index >= self._scan:
+                    # Nothing after a paragraph break is open yet, so skip scanning up to it
+                    self._reset_markup(index)
+            else:
+                self._advance(self._window_end, final=final)
+                chunk = None if self._scan <= self._window_end else self._cut(final)
+                if chunk is None:
+                    # Waiting to see whether an opener in the window is ever closed
+                    return chunks
+            if chunk:
+                chunks.append(chunk)
+
+    def _reset_markup(self, offset):
+        self._scan = offset
+        self._bold = self._italic = self._quote = False
+        self._lines.clear()
+        self._blocked.clear()
+        self._blocked_since = None
+        self._clean.clear()
+        self._literal.clear()
+
+    def _advance(self, until, pattern=_MARKUP, final=True):
+        buffer = self._buffer
+        scan = self._scan
+        if buffer.startswith('>', scan) and (scan == 0 or buffer[scan - 1] == '\n'):
+            self._update(scan, False, False, True)
+        for match in pattern.finditer(buffer, scan, _scan_end(buffer, until)):
+            index = match.start()
+            if index > until:
+                break
+            self._scan = match.end()
+            if match.lastgroup == 'clean':
+                if self._scan == len(buffer) and buffer.endswith('*'):
+                    # A span closing at the very end of the text so far may not be one once more
+                    # arrives; past the window it isn't needed yet, so leave it for the next scan
+                    opener = buffer.rfind('*', index, _run_start(buffer, self._scan - 1, index))
+                    opener = _run_start(buffer, opener, index)
+                    if opener > until:
+                        self._scan = opener
+                # Leaves the state unchanged; spans inside only matter when nothing else is open
+                if not (self._bold or self._italic or self._quote) and self._scan > index:
+                    if self._clean and self._clean[-1][1] == index:
+                        self._clean[-1][1] = self._scan
+                    else:
+                        self._clean.append([index, self._scan])
+                continue
+            if match.group() == '\n':
+                bold, italic = self._bold, self._italic
+                if buffer.startswith('\n', index + 1):
+                    # Spans never continue past a paragraph
+                    bold = italic = False
+                elif not (bold or italic):
+                    self._lines.append(index)
+                self._update(index, bold, italic, False)
+                if buffer.startswith('>', index + 1):
+                    self._update(index + 1, bold, italic, True)
+                continue
+
+            # A run can only open before text and close after it, so "5 * 3" is left alone
+            run = match.end() - index
+            before = buffer[index - 1] if index > 0 else ' '
+            after = buffer[match.end()] if match.end() < len(buffer) else ' '
+            opens = not after.isspace()
+            closes = not before.isspace()
+            bold, italic = self._bold, self._italic
+            if run >= 2:
+                bold = (not closes) if bold else opens
+            if run % 2 == 1:
+                italic = (not closes) if italic else opens
+            if (bold and not self._bold) or (italic and not self._italic):
+                closable = self._closable(index, match.end(), bold and not self._bold, italic and not self._italic, final)
+                if closable is None:
+                    self._scan = index
+                    return
+                if not closable:
+                    bold, italic = self._bold, self._italic
+            closing = (self._bold and not bold) or (self._italic and not italic)
+            self._update(match.end() if closing else index, bold, italic, self._quote)
+        self._scan = max(self._scan, until + 1)
+
+    def _closable(self, index, offset, bold, italic, final):
+        # Whether the run at index can be closed before its paragraph ends, or None if that isn't known yet
+        if index in self._literal:
+            return False
+        patterns = [pattern for pattern, wanted in ((_BOLD_CLOSER, bold), (_ITALIC_CLOSER, italic)) if wanted]
+        found = [self._closer_after(pattern, offset) for pattern in patterns]
+        if True in found:
+            return True
+        if None in found and not final:
+            self._waiting = patterns
+            self._tail = self._buffer[-2:]
+            return None
+        self._literal.add(index)
+        return False
+
+    def _closer_after(self, pattern, offset):
+        # Whether a closer follows offset in its paragraph, or None if the paragraph hasn't ended yet
+        buffer = self._buffer
+        begin, end = self._searched.get(pattern, (0, -1))
+        if begin <= offset <= end:
+            # Nothing closes in [begin, end), so resume there, less enough to catch a closer or break it straddled
+            start = max(offset, end - 2)
+        else:
+            begin = start = offset
+        stop = buffer.find('\n\n', start)
+        if stop < 0:
+            stop = len(buffer)
+        if pattern.search(buffer, start, stop):
+            return True
+        self._searched[pattern] = (begin, stop)
+        return None if stop == len(buffer) else False
+
+    def _update(self, offset, bold, italic, quote):
+        was_blocked = self._bold or self._italic or self._quote
+        blocked = bold or italic or quote
+        if blocked and not was_blocked:
+            self._blocked_since = offset
+        elif was_blocked and not blocked:
+            self._blocked.append((self._blocked_since, offset))
+            self._blocked_since = None
+        self._bold, self._italic, self._quote = bold, italic, quote
+
+    def _blocked_at(self, offset):
+        # Start of the open span or quoted line containing offset, or None
+        if self._blocked_since is not None and offset >= self._blocked_since:
+            return self._blocked_since
+        for begin, end in reversed(self._blocked):
+            if end <= offset:
+                break
+            if begin <= offset:
+                return begin
+        return self._span_at(offset)
+
+    def _span_at(self, offset):
+        # Start of the complete span in a clean stretch that contains offset, or None
+        for stretch in reversed(self._clean):
+            if stretch[1] <= offset:
+                return None
+            if stretch[0] <= offset:
+                break
+        else:
+            return None
+        buffer = self._buffer
+        begin = stretch[0]
+        on_run = buffer[offset] == '*'
+        run = _run_start(buffer, offset, begin) if on_run else offset
+        # Runs in a clean stretch are "*" or "**" and alternate between opening and closing
+        if (buffer.count('*', begin, run) - buffer.count('**', begin, run)) % 2 == 0:
+            # Outside every span, unless the run at offset opens one
+            return run if on_run else None
+        return _run_start(buffer, buffer.rfind('*', begin, run), begin)
+
+    def _state_at(self, offset, final=True):
+        # (bold, italic, quote) at offset, replayed from where the enclosing span began, or None if that waits on more text
+        begin = self._blocked_at(offset)
+        if begin is None:
+            return False, False, False
+        replay = MessageSplitter(self.char_limit)
+        replay._buffer = self._buffer
+        replay._literal = self._literal
+        replay._searched = self._searched
+        if begin < self._start:
+            # The span was cut at the start of this chunk; the reopened markup says what is open
+            begin = self._start
+            markup = self._carry
+            replay._quote = markup.startswith('> ')
+            markup = markup[2:] if replay._quote else markup
+            replay._bold = markup.startswith('**')
+            replay._italic = markup in ('*', '***')
+        replay._scan = begin
+        replay._advance(offset, _RUNS, final)
+        if replay._scan <= offset:
+            self._waiting, self._tail = replay._waiting, replay._tail
+            return None
+        return replay._bold, replay._italic, replay._quote
+
+    def _cut(self, final=True):
+        buffer = self._buffer
+        start = self._start
+        end = self._window_end
+
+        index = _last_within(self._lines, end)
+        if index is not None:
+            return self._emit(index, "", "")
+
+        # The last sentence end outside any span or quoted line, skipping back past each one in the way
+        high = end
+        while high > start:
+            index = max(buffer.rfind(f"{mark} ", start, high + 1) for mark in _SENTENCE_ENDS) + 1
+            if index <= 0:
+                break
+            blocked = self._blocked_at(index)
+            if blocked is None:
+                return self._emit(index, "", "")
+            high = blocked - 1
+
+        high = end
+        while high > start:
+            index = buffer.rfind(' ', start + 1, high + 1)
+            if index < 0:
+                break
+            blocked = self._blocked_at(index)
+            if blocked is None:
+                return self._emit(index, "", "")
+            high = blocked - 1
+
+        # No clean boundary fits: cut at the last whitespace that leaves room to close the open spans
+        high = end - _CLOSER_ROOM
+        index = max(buffer.rfind(' ', start + 1, high + 1), buffer.rfind('\n', start + 1, high + 1))
+        if index < 0:
+            # One unbroken word longer than the limit; cut it where it overflows
+            index = high
+        state = self._state_at(index, final)
+        if state is None:
+            return None
+        bold, italic, quote = state
+        closers = ("*" if italic else "") + ("**" if bold else "")
+        openers = ("> " if quote and buffer[index] != '\n' else "") + ("**" if bold else "") + ("*" if italic else "")
+        return self._emit(index, closers, openers)
+
+    def _emit(self, index, closers, openers):
+        chunk = (self._carry + self._buffer[self._start:index].strip()).rstrip()
+        if chunk and chunk != self._carry:
+            chunk += closers
+        self._carry = openers
+        self._start = index
+        while self._lines and self._lines[0] <= index:
+            self._lines.popleft()
+        while self._blocked and self._blocked[0][1] <= index:
+            self._blocked.popleft()
+        while self._clean and self._clean[0][1] <= index:
+            self._clean.popleft()
+        if self._clean and self._clean[0][0] < index:
+            # Move the stretch up to the cut, so asterisks before it are never counted again
+            span = self._span_at(index)
+            if span is None:
+                self._clean[0][0] = index
+            else:
+                # Cut inside a span: it is listed with the other open ranges, and the stretch resumes after it
+                run = 2 if self._buffer.startswith('**', span) else 1
+                close = self._buffer.find('*', span + run) + run
+                self._blocked.appendleft((span, close))
+                self._clean[0][0] = close
+        return chunk if chunk.strip() else ""
+
+    def _compact(self):
+        # Keep the character before the chunk, which tells whether it starts a line
+        shift = self._start - 1
+        self._buffer = self._buffer[shift:]
+        self._start -= shift
+        self._scan -= shift
+        self._lines = deque(offset - shift for offset in self._lines)
+        self._blocked = deque((begin - shift, end - shift) for begin, end in self._blocked)
+        self._clean = deque([begin - shift, end - shift] for begin, end in self._clean)
+        self._literal = {offset - shift for offset in self._literal if offset >= shift}
+        self._searched = {pattern: (max(begin - shift, 0), end - shift) for pattern, (begin, end) in self._searched.items() if end > shift}
+        if self._blocked_since is not None:
+            self._blocked_since -= shift
+
+def _scan_end(buffer, until):
+    # Where a scan up to until may stop: past the lookahead, and never partway through a run of asterisks
+    end = min(until + _LOOKAHEAD + 1, len(buffer))
+    while end < len(buffer) and buffer[end] == '*':
+        end += 1
+    return end
+
+def _run_start(buffer, offset, floor):
+    # Where the run of asterisks containing offset begins, looking no further back than floor
+    while offset > floor and buffer[offset - 1] == '*':
+        offset -= 1
+    return offset
+
+def _last_within(positions, limit):
+    # Positions are in increasing order and almost always all within the limit
+    for position in reversed(positions):
+        if position <= limit:
+            return position
+    return None
+
 def split_message(content, char_limit=2000):
     """
     Split a long message into multiple smaller messages to fit within Discord's character limit
@@ -12,47 +436,138 @@ def split_message(content, char_limit=2000):
     # If the content is already within the limit, return it as a single-item list
     if len(content) <= char_limit:
         return [content]
-    
-    # Split the message into chunks
-    chunks = []
-    current_chunk = ""
-    
-    # Try to split at paragraph breaks first
-    paragraphs = content.split('\n\n')
-    
-    for paragraph in paragraphs:
-        # If adding this paragraph would exceed the limit, add the current chunk to chunks
-        # and start a new chunk with this paragraph
-        if len(current_chunk) + len(paragraph) + 2 > char_limit:
-            # If the current chunk is not empty, add it to chunks
-            if current_chunk:
-                chunks.append(current_chunk)
-                current_chunk = paragraph
+    return list(iter_chunks([content], char_limit))
+
+def iter_chunks(fragments, char_limit=2000):
+    """
+    Split text that arrives in fragments, yielding each chunk once it is complete
+
+    Args:
+        fragments: Iterable of text fragments, e.g. a streaming generator
+        char_limit (int): The character limit for each chunk
+
+    Yields:
+        str: Successive chunks, each within the character limit
+    """
+    splitter = MessageSplitter(char_limit)
+    for fragment in fragments:
+        yield from splitter.feed(fragment)
+    yield from splitter.close()
+
+class StreamingMessage:
+    """
+    Post text to a channel while it is still being generated
+
+    The first fragment is sent as soon as it arrives and the message is then
+    edited in place (at most once per edit_interval) as more text comes in.
+    Text goes through a MessageSplitter, so when a chunk is finished it is
+    frozen and the stream rolls over into a new message, with the same
+    boundaries split_message would pick for the whole text. An optional prefix (such as
+    status lines) is posted straight away at the top of the first message.
+    """
+
+    def __init__(self, destination, prefix="", char_limit=2000, edit_interval=1.0):
+        """
+        Args:
+            destination: An Outbox, or anything with async send(content),
+                edit(message, content) and delete(message) methods
+            prefix (str): Text to show above the streamed text
+            char_limit (int): The character limit for each message
+            edit_interval (float): Minimum seconds between edits of the same message
+        """
+        self.destination = destination
+        self.char_limit = char_limit
+        self.edit_interval = edit_interval
+        self.messages = []
+        self.contents = []
+        self.first_send_latency = None
+        self._lead = f"{prefix}\n\n" if prefix else ""
+        self._raw = []
+        self._splitter = MessageSplitter(char_limit)
+        self._splitter.feed(self._lead)
+        self._current_open = False
+        self._last_edit = 0.0
+        self._started = time.monotonic()
+
+    async def begin(self):
+        """Post the prefix right away, so the channel isn't silent while generation starts"""
+        await self._show(self._splitter.pending)
+
+    @property
+    def text(self):
+        """All text received so far, exactly as it was streamed"""
+        return "".join(self._raw).strip()
+
+    async def feed(self, fragment):
+        """
+        Add a newly generated fragment to the channel
+
+        Args:
+            fragment (str): The next piece of generated text
+        """
+        self._raw.append(fragment)
+        for chunk in self._splitter.feed(fragment):
+            await self._show(chunk, force=True)
+            self._current_open = False
+        await self._show(self._splitter.pending)
+
+    async def finish(self, final_text=None):
+        """
+        Flush any buffered text and make the channel match the final text
+
+        Args:
+            final_text (str): The text as it should finally read, if it was
+                reformatted after streaming; defaults to the streamed text
+
+        Returns:
+            list: The sent messages, in order
+        """
+        chunks = self._splitter.close()
+        for index, chunk in enumerate(chunks):
+            if index:
+                self._current_open = False
+            await self._show(chunk, force=True)
+
+        if final_text is None or final_text == self.text:
+            return self.messages
+
+        # The text was rewritten after streaming; re-render only what changed
+        chunks = split_message(self._lead + final_text, self.char_limit)
+        for index, chunk in enumerate(chunks):
+            if index < len(self.messages):
+                if self.contents[index] != chunk:
+                    await self.destination.edit(self.messages[index], chunk)
+                    self.contents[index] = chunk
             else:
-                # If this single paragraph is too long, split it by sentences
-                sentences = paragraph.replace('. ', '.\n').split('\n')
-                for sentence in sentences:
-                    if len(current_chunk) + len(sentence) + 1 > char_limit:
-                        if current_chunk:
-                            chunks.append(current_chunk)
-                            current_chunk = sentence
-                        else:
-                            # If a single sentence is too long, split it by words
-                            words = sentence.split(' ')
-                            for word in words:
-                                if len(current_chunk) + len(word) + 1 > char_limit:
-                                    chunks.append(current_chunk)
-                                    current_chunk = word
-                                else:
-                                    current_chunk += ' ' + word if current_chunk else word
-                    else:
-                        current_chunk += '\n' + sentence if current_chunk else sentence
-        else:
-            # Add paragraph separator if current_chunk is not empty
-            current_chunk += '\n\n' + paragraph if current_chunk else paragraph
-    
-    # Add the last chunk if it's not empty
-    if current_chunk:
-        chunks.append(current_chunk)
-    
-    return chunks
+                self.messages.append(await self.destination.send(chunk))
+                self.contents.append(chunk)
+
+        for message in self.messages[len(chunks):]:
+            await self.destination.delete(message)
+        del self.messages[len(chunks):]
+        del self.contents[len(chunks):]
+
+        return self.messages
+
+    async def _show(self, content, force=False):
+        # Discord rejects empty messages, so wait until there is something to show
+        if not content.strip():
+            return
+
+        if not self._current_open:
+            self.messages.append(await self.destination.send(content))
+            self.contents.append(content)
+            self._current_open = True
+            self._last_edit = time.monotonic()
+            if self.first_send_latency is None:
+                self.first_send_latency = self._last_edit - self._started
+            return
+
+        if content == self.contents[-1]:
+            return
+
+        now = time.monotonic()
+        if force or now - self._last_edit >= self.edit_interval:
+            await self.destination.edit(self.messages[-1], content)
+            self.contents[-1] = content
+            self._last_edit = now
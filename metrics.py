@@ -0,0 +1,213 @@
+import os
+import asyncio
+import time
+from bisect import bisect_left
+
+# Port for the Prometheus /metrics endpoint; 0 disables it
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Address the endpoint listens on (keep it local unless a scraper needs it elsewhere)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Bucket bounds for latencies in seconds, from Discord calls up to slow generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Bucket bounds for prompt and response sizes in estimated tokens
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+# Every metric in the process, in registration order (name -> metric)
+registry = {}
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+class Counter:
+    """A count that only goes up, optionally split by labels"""
+
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        """Add to the count for the given label values"""
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, _label_text(self.labels, label_values), value
+
+class Gauge:
+    """
+    A value read from a callback each time metrics are collected
+
+    A gauge with labels reads a dict of label values (tuples) -> value from
+    its callback, so one gauge can cover e.g. every running channel.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, description, read=None, labels=()):
+        self.name = name
+        self.description = description
+        self.read = read
+        self.labels = labels
+        self.value = 0
+
+    def set(self, value):
+        """Set the value directly, for gauges without a callback"""
+        self.value = value
+
+    def samples(self):
+        value = self.read() if self.read is not None else self.value
+        if not self.labels:
+            yield self.name, "", value
+            return
+        for label_values, labelled in value.items():
+            yield self.name, _label_text(self.labels, label_values), labelled
+
+class Histogram:
+    """
+    Observations counted into fixed buckets, optionally split by labels
+
+    observe() is a bisect and two additions, so it is cheap enough for every
+    request; cumulative bucket counts are only worked out when collected.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.labels = labels
+        # label values -> [per-bucket counts (last is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        """Record one observation for the given label values"""
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def time(self, *label_values):
+        """Context manager observing the seconds spent inside it"""
+        return _Timer(self, label_values)
+
+    def samples(self):
+        for label_values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                names = self.labels + ("le",)
+                yield f"{self.name}_bucket", _label_text(names, label_values + (bound,)), cumulative
+            labels = _label_text(self.labels, label_values)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+class _Timer:
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+        return False
+
+def _register(metric):
+    registry[metric.name] = metric
+    return metric
+
+def counter(name, description, labels=()):
+    """Create and register a Counter"""
+    return _register(Counter(name, description, labels))
+
+def gauge(name, description, read=None, labels=()):
+    """Create and register a Gauge, optionally read from a callback"""
+    return _register(Gauge(name, description, read, labels))
+
+def histogram(name, description, buckets=LATENCY_BUCKETS, labels=()):
+    """Create and register a Histogram"""
+    return _register(Histogram(name, description, buckets, labels))
+
+# Metrics shared by the bot's modules
+generation_seconds = histogram('storybot_generation_seconds', "Time taken by Gemini requests, by whether the prompt cache served part of the input", labels=("mode", "cache"))
+prompt_tokens = histogram('storybot_prompt_tokens', "Estimated tokens per prompt sent to Gemini", SIZE_BUCKETS)
+response_tokens = histogram('storybot_response_tokens', "Estimated tokens per Gemini response", SIZE_BUCKETS)
+tally_seconds = histogram('storybot_tally_seconds', "Time taken to count a round's votes")
+send_seconds = histogram('storybot_send_seconds', "Discord request latency, including rate-limit waits", labels=("route",))
+rounds = counter('storybot_rounds_total', "Story rounds opened for voting")
+karma_flushes = counter('storybot_karma_flushes_total', "Karma batches written to disk")
+errors = counter('storybot_errors_total', "Errors by where they happened and exception type", labels=("where", "type"))
+
+def error(where, exception):
+    """Count an exception under the place it was caught"""
+    errors.inc(where, type(exception).__name__)
+
+def render():
+    """
+    Render every registered metric in the Prometheus text format
+
+    Returns:
+        str: The exposition text
+    """
+    lines = []
+    for metric in registry.values():
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        # Skip the headers; nothing in them matters here
+        while (await reader.readline()).strip():
+            pass
+        parts = request.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(port=METRICS_PORT, host=METRICS_HOST):
+    """
+    Serve /metrics on the running event loop
+
+    Args:
+        port (int): Port to listen on; 0 leaves the endpoint off
+        host (str): Address to listen on
+
+    Returns:
+        asyncio.AbstractServer: The server, or None if disabled
+    """
+    if not port:
+        return None
+    server = await asyncio.start_server(_handle, host, port)
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,182 @@
+import os
+import re
+import sys
+import time
+import asyncio
+from collections import OrderedDict, deque
+
+# Pre-generated openers kept per popular theme
+OPENER_POOL_SIZE = int(os.getenv('OPENER_POOL_SIZE', '3'))
+
+# A pool is topped up in the background once it holds this many openers or fewer
+OPENER_REFILL_AT = int(os.getenv('OPENER_REFILL_AT', '1'))
+
+# Requests for a theme before it gets a pool; rarer themes are always generated on demand
+OPENER_POPULAR_AFTER = int(os.getenv('OPENER_POPULAR_AFTER', '2'))
+
+# Most themes tracked at once; the least recently requested is evicted beyond this
+OPENER_MAX_THEMES = int(os.getenv('OPENER_MAX_THEMES', '200'))
+
+# Seconds a pre-generated opener stays usable
+OPENER_TTL = float(os.getenv('OPENER_TTL', '3600'))
+
+# Words that don't change what story a theme asks for
+STOPWORDS = frozenset((
+    "a", "an", "the", "of", "in", "on", "at", "to", "for", "with", "and", "about",
+    "some", "my", "our", "story", "roleplay", "secret",
+))
+
+_WORD = re.compile(r"[\w']+")
+
+def normalize_theme(theme):
+    """
+    Reduce a theme to the key its openers are cached under
+
+    Case, punctuation, extra whitespace, stopwords and the "secret" flag are
+    dropped, so "The Space Adventure" and "secret space  adventure!" share a pool.
+
+    Args:
+        theme (str): The theme given to !roleplay
+
+    Returns:
+        str: The normalized key, or "" if nothing meaningful is left
+    """
+    return " ".join(word for word in _WORD.findall(theme.lower()) if word not in STOPWORDS)
+
+class _Pool:
+    """Openers ready for one theme, oldest first"""
+
+    __slots__ = ('theme', 'variants', 'requests', 'refill')
+
+    def __init__(self, theme):
+        self.theme = theme
+        self.variants = deque()
+        self.requests = 0
+        self.refill = None
+
+class OpenerCache:
+    """
+    Pre-generated opening scenarios for popular themes
+
+    Themes are tracked by their normalized key in least-recently-requested
+    order. Once a theme has been asked for OPENER_POPULAR_AFTER times it gets a
+    pool of openers generated in the background; take() hands one out and
+    triggers a refill when the pool runs low. Openers expire after a TTL and
+    the least recently requested themes are evicted past max_themes.
+    """
+
+    def __init__(self, generate, pool_size=OPENER_POOL_SIZE, refill_at=OPENER_REFILL_AT,
+                 popular_after=OPENER_POPULAR_AFTER, max_themes=OPENER_MAX_THEMES, ttl=OPENER_TTL):
+        """
+        Args:
+            generate: Async callable taking a theme and returning a generated opener
+            pool_size (int): Openers kept per theme
+            refill_at (int): Pool size at or below which a refill starts
+            popular_after (int): Requests before a theme gets a pool
+            max_themes (int): Themes tracked at once
+            ttl (float): Seconds an opener stays usable
+        """
+        self.generate = generate
+        self.pool_size = pool_size
+        self.refill_at = refill_at
+        self.popular_after = popular_after
+        self.max_themes = max_themes
+        self.ttl = ttl
+        self.pools = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def take(self, theme):
+        """
+        Claim a ready opener for a theme, if there is one
+
+        Every call counts as a request for the theme and may start a refill,
+        so on a miss the caller should generate the opener itself as usual.
+
+        Args:
+            theme (str): The theme given to !roleplay
+
+        Returns:
+            str: A generated opener, or None on a miss
+        """
+        key = normalize_theme(theme)
+        if not key:
+            self.misses += 1
+            return None
+
+        pool = self.pools.get(key)
+        if pool is None:
+            # Generate with the theme as the player wrote it, minus the secret flag
+            pool = self.pools[key] = _Pool(re.sub(r'(?i)\bsecret\b', '', theme).strip() or key)
+            self._evict()
+        else:
+            self.pools.move_to_end(key)
+        pool.requests += 1
+
+        now = time.time()
+        while pool.variants and pool.variants[0][1] <= now:
+            pool.variants.popleft()
+            self.expired += 1
+
+        opener = pool.variants.popleft()[0] if pool.variants else None
+        if opener is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        if pool.requests >= self.popular_after and len(pool.variants) <= self.refill_at and pool.refill is None:
+            pool.refill = asyncio.ensure_future(self._refill(key, pool))
+        return opener
+
+    def report(self):
+        """
+        Summarize how the cache is doing
+
+        Returns:
+            dict: Hits, misses and hit rate, openers generated, expired and
+                evicted themes, themes tracked, openers ready and the memory
+                they take up in bytes
+        """
+        requests = self.hits + self.misses
+        ready = sum(len(pool.variants) for pool in self.pools.values())
+        memory = sum(sys.getsizeof(opener) for pool in self.pools.values() for opener, _ in pool.variants)
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "generated": self.generated,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "themes": len(self.pools),
+            "ready": ready,
+            "memory_bytes": memory,
+        }
+
+    def close(self):
+        """Stop every refill in progress and drop all openers"""
+        for pool in self.pools.values():
+            if pool.refill is not None:
+                pool.refill.cancel()
+        self.pools.clear()
+
+    async def _refill(self, key, pool):
+        try:
+            # One at a time, so a refill never takes more than one generation slot
+            while len(pool.variants) < self.pool_size and self.pools.get(key) is pool:
+                opener = await self.generate(pool.theme)
+                pool.variants.append((opener, time.time() + self.ttl))
+                self.generated += 1
+        except Exception as e:
+            print(f"Failed to pre-generate opener for '{key}': {str(e)}")
+        finally:
+            pool.refill = None
+
+    def _evict(self):
+        while len(self.pools) > self.max_themes:
+            _, pool = self.pools.popitem(last=False)
+            if pool.refill is not None:
+                pool.refill.cancel()
+            self.evicted += 1
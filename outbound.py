@@ -0,0 +1,178 @@
+import asyncio
+import time
+from collections import deque
+import metrics
+import tracing
+
+# Discord's published limits for the routes the bot uses, per channel: (requests, seconds)
+MESSAGE_CREATE_LIMIT = (5, 5.0)
+MESSAGE_EDIT_LIMIT = (5, 5.0)
+MESSAGE_DELETE_LIMIT = (5, 5.0)
+REACTION_LIMIT = (1, 0.25)
+
+# Discord's global limit for a bot, across every route
+GLOBAL_LIMIT = (50, 1.0)
+
+# Shortest wait on a full bucket; a float leftover of a few ulps wouldn't move the clock past the window
+MIN_WAIT = 0.001
+
+class RouteBucket:
+    """
+    Sliding-window limiter for one rate-limit bucket
+
+    Requests wait here for room in the window before they are made, so the
+    bot paces itself instead of sending until Discord answers with a 429.
+    """
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self._sent = deque()
+
+    async def acquire(self):
+        """Wait until a request fits in the bucket, then claim a slot for it"""
+        loop = asyncio.get_event_loop()
+        while True:
+            now = loop.time()
+            while self._sent and now - self._sent[0] >= self.period:
+                self._sent.popleft()
+            if len(self._sent) < self.limit:
+                self._sent.append(now)
+                return
+            await asyncio.sleep(max(self.period - (now - self._sent[0]), MIN_WAIT))
+
+# Shared by every outbox in the process
+global_bucket = RouteBucket(*GLOBAL_LIMIT)
+
+class Outbox:
+    """
+    Outbound requests for one channel
+
+    Every send, edit, delete and reaction waits on the bucket for its route
+    (and the global bucket) before it goes out. Status lines can be queued
+    with note() and are then delivered as part of the next story message
+    instead of as messages of their own. Each channel has its own outbox, so
+    channels never wait on each other's buckets.
+    """
+
+    def __init__(self, channel):
+        """
+        Args:
+            channel: The channel to post into
+        """
+        self.channel = channel
+        self.buckets = {
+            'send': RouteBucket(*MESSAGE_CREATE_LIMIT),
+            'edit': RouteBucket(*MESSAGE_EDIT_LIMIT),
+            'delete': RouteBucket(*MESSAGE_DELETE_LIMIT),
+            'react': RouteBucket(*REACTION_LIMIT),
+        }
+        self.queued = 0
+        self.requests = 0
+        self.latencies = deque(maxlen=100)
+        self._notes = []
+
+    def note(self, line):
+        """Queue a status line to go out with the next story message"""
+        self._notes.append(line)
+
+    def take_notes(self):
+        """
+        Collect the queued status lines
+
+        Returns:
+            str: The lines joined by newlines, or "" if there were none
+        """
+        notes, self._notes = self._notes, []
+        return "\n".join(notes)
+
+    async def send(self, content):
+        """Send a message to the channel"""
+        return await self._request('send', self.channel.send(content))
+
+    async def edit(self, message, content):
+        """Replace a message's content"""
+        return await self._request('edit', message.edit(content=content))
+
+    async def delete(self, message):
+        """Delete a message"""
+        return await self._request('delete', message.delete())
+
+    async def react(self, message, *emojis):
+        """Add reactions to a message, in order"""
+        for emoji in emojis:
+            await self._request('react', message.add_reaction(emoji))
+
+    def stats(self):
+        """
+        Report this channel's outbound load
+
+        Returns:
+            dict: Requests waiting on a bucket, requests made, and send latency in seconds
+        """
+        latencies = sorted(self.latencies)
+        return {
+            "queued": self.queued,
+            "requests": self.requests,
+            "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+    async def _request(self, route, request):
+        # Latency covers the time spent waiting on buckets as well as the request itself
+        started = time.monotonic()
+        self.queued += 1
+        try:
+            await self.buckets[route].acquire()
+            await global_bucket.acquire()
+        except BaseException:
+            request.close()
+            raise
+        finally:
+            self.queued -= 1
+
+        try:
+            return await request
+        except Exception as e:
+            metrics.error(route, e)
+            raise
+        finally:
+            latency = time.monotonic() - started
+            self.requests += 1
+            self.latencies.append(latency)
+            metrics.send_seconds.observe(latency, route)
+            tracing.record(f"discord:{route}", started, latency)
+
+# Outboxes for channels with a running story (channel id -> Outbox)
+outboxes = {}
+
+def get_outbox(channel):
+    """Return the channel's outbox, creating it if necessary"""
+    outbox = outboxes.get(channel.id)
+    if outbox is None:
+        outbox = outboxes[channel.id] = Outbox(channel)
+    return outbox
+
+def release_outbox(channel_id):
+    """Forget a channel's outbox once its story is over"""
+    outboxes.pop(channel_id, None)
+
+def stats():
+    """
+    Report outbound load for every channel
+
+    Returns:
+        dict: Channel id -> that channel's Outbox.stats()
+    """
+    return {channel_id: outbox.stats() for channel_id, outbox in outboxes.items()}
+
+def _per_channel(field):
+    # Only channels with a running story have an outbox, so the label set stays as small as the story count
+    return lambda: {(str(channel_id),): values[field] for channel_id, values in stats().items()}
+
+metrics.gauge('storybot_outbox_queued', "Discord requests waiting on a rate-limit bucket, by channel",
+              _per_channel("queued"), labels=("channel",))
+metrics.gauge('storybot_outbox_latency_seconds', "Average Discord request latency over each channel's last 100 requests",
+              _per_channel("latency_avg"), labels=("channel",))
+metrics.gauge('storybot_outbox_latency_max_seconds', "Slowest of each channel's last 100 Discord requests",
+              _per_channel("latency_max"), labels=("channel",))
@@ -0,0 +1,94 @@
+import os
+import math
+import metrics
+from story_context import CHARS_PER_TOKEN
+from message_handler import split_message
+
+# Discord messages a story segment, options included, should fit in
+SEGMENT_MESSAGES = int(os.getenv('SEGMENT_MESSAGES', '2'))
+
+# Characters per Discord message
+MESSAGE_CHARS = 2000
+
+# Share of each message the segment aims to fill; the rest absorbs status notes and paragraph-boundary splits
+FILL = 0.85
+
+# Rough characters per English word (including the space), for phrasing the target in words
+CHARS_PER_WORD = 6
+
+# How far past the target a response may run before Gemini cuts it off
+OVERRUN = 1.5
+
+# Weight of the newest response in the running length ratio
+SMOOTHING = 0.2
+
+segment_messages = metrics.histogram('storybot_segment_messages', "Discord messages each story segment needed",
+                                     buckets=(1, 2, 3, 4, 6))
+
+class OutputBudget:
+    """
+    Picks how long each story segment should be so it fits the message budget
+
+    The prompt asks for a target length in words, and max_output_tokens caps
+    the response somewhat above it so a runaway segment can't spill into
+    several more messages. Models don't hit a word count exactly, so the
+    ratio of what came back to what was asked for is tracked and the request
+    is scaled to compensate: a model that writes 30% long is asked for 30%
+    less.
+    """
+
+    def __init__(self, messages=SEGMENT_MESSAGES):
+        """
+        Args:
+            messages (int): Discord messages a segment should fit in
+        """
+        self.target_chars = int(messages * MESSAGE_CHARS * FILL)
+        self.max_tokens = math.ceil(self.target_chars * OVERRUN / CHARS_PER_TOKEN)
+        # Characters received per character requested, smoothed over recent responses
+        self.ratio = 1.0
+        self.segments = 0
+        self.over = 0
+
+    @property
+    def words(self):
+        """Words to ask for, adjusted for how far the model usually strays"""
+        return max(50, int(self.target_chars / self.ratio / CHARS_PER_WORD))
+
+    def instruction(self):
+        """The length instruction for a segment prompt"""
+        return (
+            f"Keep the whole response, including both choices, to about {self.words} words; "
+            "never go past that to finish a scene."
+        )
+
+    def record(self, text):
+        """
+        Note the length of a generated segment
+
+        Args:
+            text (str): The segment as generated
+        """
+        requested = self.words * CHARS_PER_WORD
+        observed = min(max(len(text) / requested, 0.5), 2.0)
+        self.ratio += SMOOTHING * (observed - self.ratio)
+        self.segments += 1
+        if len(text) > self.target_chars:
+            self.over += 1
+        segment_messages.observe(len(split_message(text)))
+
+    def report(self):
+        """
+        Summarize how segments have fit the budget
+
+        Returns:
+            dict: The target in characters and words, the output token cap,
+                the current length ratio, and segments seen and over target
+        """
+        return {
+            "target_chars": self.target_chars,
+            "words": self.words,
+            "max_tokens": self.max_tokens,
+            "ratio": round(self.ratio, 3),
+            "segments": self.segments,
+            "over": self.over,
+        }
@@ -0,0 +1,90 @@
+import os
+import time
+import asyncio
+import cProfile
+import pstats
+import tracemalloc
+
+# Directory profile captures are written to
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+# Longest capture allowed, in seconds
+PROFILE_MAX_SECONDS = 600
+
+# Stack frames kept per allocation while tracing memory
+TRACEMALLOC_FRAMES = 10
+
+# Allocations by the tracing machinery itself, left out of snapshots
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+_running = False
+
+class ProfileInProgress(Exception):
+    """Raised when a capture is requested while another is still running"""
+
+async def capture(seconds, directory=PROFILE_DIR, top=8):
+    """
+    Profile the event loop thread and trace memory allocations for a while
+
+    cProfile and tracemalloc are only switched on for the window, so they
+    cost nothing the rest of the time. The CPU profile is written in pstats
+    format (open it with snakeviz, gprof2dot or python -m pstats) and the
+    memory snapshot with tracemalloc's dump (tracemalloc.Snapshot.load).
+
+    Args:
+        seconds (float): How long to capture for (capped at PROFILE_MAX_SECONDS)
+        directory (str): Where to write the files
+        top (int): Entries to include in each summary
+
+    Returns:
+        dict: Paths of the .prof and .tracemalloc files, plus text summaries
+            of the functions with the most cumulative time and the lines
+            whose allocations grew the most during the window
+
+    Raises:
+        ProfileInProgress: If a capture is already running
+    """
+    global _running
+    if _running:
+        raise ProfileInProgress("A profile is already being captured")
+    _running = True
+    seconds = max(0.0, min(seconds, PROFILE_MAX_SECONDS))
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, time.strftime('%Y%m%d-%H%M%S'))
+
+    profile = cProfile.Profile()
+    started_tracing = not tracemalloc.is_tracing()
+    try:
+        if started_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        before = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+        after = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        _running = False
+
+    profile.dump_stats(f"{stem}.prof")
+    after.dump(f"{stem}.tracemalloc")
+
+    stats = pstats.Stats(profile).sort_stats('cumulative')
+    cpu = "\n".join(
+        f"{stats.stats[function][3]:.3f}s {os.path.basename(function[0])}:{function[1]}({function[2]})"
+        for function in stats.fcn_list[:top]
+    )
+    growth = "\n".join(str(stat) for stat in after.compare_to(before, 'lineno')[:top])
+    return {
+        "profile": f"{stem}.prof",
+        "snapshot": f"{stem}.tracemalloc",
+        "cpu": cpu,
+        "memory": growth,
+    }
@@ -0,0 +1,204 @@
+import os
+import time
+import asyncio
+import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from story_context import estimate_tokens
+import metrics
+
+# Model the cached prefixes are created for; context caching needs an explicitly versioned model
+PROMPT_CACHE_MODEL = os.getenv('PROMPT_CACHE_MODEL', 'models/gemini-2.0-flash-001')
+
+# Seconds a cached prefix lives without being used; extended while its story keeps going
+PROMPT_CACHE_TTL = float(os.getenv('PROMPT_CACHE_TTL', '600'))
+
+# Prefixes shorter than this many estimated tokens are sent normally (Gemini won't cache below its minimum)
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv('PROMPT_CACHE_MIN_TOKENS', '4096'))
+
+# An entry this close to expiring is replaced rather than used
+EXPIRY_MARGIN = 30
+
+tokens_sent = metrics.counter('storybot_prompt_input_tokens_total', "Input tokens sent to Gemini on requests that may use a cached prefix")
+tokens_cached = metrics.counter('storybot_prompt_cached_tokens_total', "Input tokens served from a cached prefix")
+
+class CacheEntry:
+    """One cached prompt prefix and the model bound to it"""
+
+    __slots__ = ('prefix', 'cached', 'model', 'expires')
+
+    def __init__(self, prefix, cached, model, expires):
+        self.prefix = prefix
+        self.cached = cached
+        self.model = model
+        self.expires = expires
+
+class PromptCache:
+    """
+    Gemini context caches for the stable prefix of each story's prompts
+
+    Each story (keyed by channel id) has at most one entry: the static
+    guidelines and the settled part of its history, registered with Gemini
+    once and referenced by later requests, which then only send the rest of
+    the prompt. A request whose prompt no longer starts with the cached
+    prefix - because the history was summarized - replaces the entry, as
+    does one whose settled history has grown min_tokens past it.
+    Entries are deleted when their story ends and otherwise expire after
+    ttl seconds without use.
+    """
+
+    def __init__(self, model_name=PROMPT_CACHE_MODEL, min_tokens=PROMPT_CACHE_MIN_TOKENS, ttl=PROMPT_CACHE_TTL):
+        """
+        Args:
+            model_name (str): The versioned model to cache prefixes for
+            min_tokens (int): Smallest prefix, in estimated tokens, worth caching
+            ttl (float): Seconds an unused entry lives
+        """
+        self.model_name = model_name
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.entries = {}
+        self.history = deque(maxlen=100)
+        self.created = 0
+        self._creating = {}
+        # Cache management calls are blocking in the SDK, so they run on their own thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prompt-cache')
+
+    async def resolve(self, key, prompt, stable_chars=0):
+        """
+        Work out how to send a prompt, creating a cache entry if worthwhile
+
+        Args:
+            key (str): The story's cache key (its channel id)
+            prompt (str): The full prompt
+            stable_chars (int): Length of the prompt's stable prefix, or 0 to
+                only use an existing entry
+
+        Returns:
+            tuple: A model bound to the cached prefix and the rest of the
+                prompt, or (None, prompt) if the prompt isn't cached
+        """
+        if key in self._creating:
+            await asyncio.wait([self._creating[key]])
+
+        entry = self.entries.get(key)
+        now = time.time()
+        if entry is not None and entry.expires - now > EXPIRY_MARGIN and prompt.startswith(entry.prefix):
+            # Settled history that has piled up past the cached prefix is worth a fresh entry once it is big enough
+            grown = estimate_tokens(prompt[len(entry.prefix):stable_chars]) if stable_chars > len(entry.prefix) else 0
+            if grown < self.min_tokens:
+                if entry.expires - now < self.ttl / 2:
+                    self._extend(entry)
+                return entry.model, prompt[len(entry.prefix):]
+
+        if not stable_chars or estimate_tokens(prompt[:stable_chars]) < self.min_tokens:
+            return None, prompt
+
+        # The history was summarized or has outgrown the entry (or the entry expired), so replace it
+        self.release(key)
+        task = asyncio.ensure_future(self._run(self._create, prompt[:stable_chars]))
+        self._creating[key] = task
+        try:
+            entry = await task
+        except Exception as e:
+            print(f"Failed to cache prompt prefix: {str(e)}")
+            return None, prompt
+        finally:
+            self._creating.pop(key, None)
+
+        self.entries[key] = entry
+        return entry.model, prompt[stable_chars:]
+
+    def invalidate(self, key, entry_model):
+        """Drop a key's entry after a request using it failed (e.g. it expired early)"""
+        entry = self.entries.get(key)
+        if entry is not None and entry.model is entry_model:
+            self.release(key)
+
+    def record(self, key, usage, latency):
+        """
+        Note one request's token usage and latency
+
+        Args:
+            key (str): The story's cache key
+            usage (dict): prompt_tokens, cached_tokens and output_tokens
+            latency (float): Seconds the request took
+        """
+        # Per-request lines would flood the log; report() and the token counters cover the savings
+        self.history.append(dict(usage, key=key, latency=latency))
+        tokens_sent.inc(amount=usage["prompt_tokens"])
+        tokens_cached.inc(amount=usage["cached_tokens"])
+
+    def report(self):
+        """
+        Summarize savings over the recent requests
+
+        Returns:
+            dict: Live entries, caches created, requests, hit rate, input and
+                cached tokens, the share of input tokens served from cache,
+                and average latency with and without a cache hit
+        """
+        hits = [request for request in self.history if request["cached_tokens"]]
+        misses = [request for request in self.history if not request["cached_tokens"]]
+        prompt_tokens = sum(request["prompt_tokens"] for request in self.history)
+        cached_tokens = sum(request["cached_tokens"] for request in hits)
+        return {
+            "entries": len(self.entries),
+            "created": self.created,
+            "requests": len(self.history),
+            "hit_rate": len(hits) / len(self.history) if self.history else 0.0,
+            "input_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "saved_share": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+            "latency_hit": sum(request["latency"] for request in hits) / len(hits) if hits else 0.0,
+            "latency_miss": sum(request["latency"] for request in misses) / len(misses) if misses else 0.0,
+        }
+
+    def release(self, key):
+        """Delete a key's entry in the background, e.g. when its story ends"""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            asyncio.ensure_future(self._run(self._delete, entry))
+
+    def close(self):
+        """Delete every entry and stop the background thread"""
+        entries = list(self.entries.values())
+        self.entries.clear()
+        for entry in entries:
+            self._delete(entry)
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _create(self, prefix):
+        # Imported here to avoid a cycle; gemini_api owns loading the SDK
+        from gemini_api import sdk
+        genai = sdk()
+        cached = genai.caching.CachedContent.create(
+            model=self.model_name,
+            contents=[prefix],
+            ttl=datetime.timedelta(seconds=self.ttl),
+        )
+        self.created += 1
+        model = genai.GenerativeModel.from_cached_content(cached_content=cached)
+        return CacheEntry(prefix, cached, model, time.time() + self.ttl)
+
+    def _extend(self, entry):
+        # Push the expiry back while the story is still being played
+        entry.expires = time.time() + self.ttl
+        asyncio.ensure_future(self._run(self._update_ttl, entry))
+
+    def _update_ttl(self, entry):
+        try:
+            entry.cached.update(ttl=datetime.timedelta(seconds=self.ttl))
+        except Exception as e:
+            print(f"Failed to extend prompt cache: {str(e)}")
+
+    def _delete(self, entry):
+        try:
+            entry.cached.delete()
+        except Exception as e:
+            # It expires on its own anyway
+            print(f"Failed to delete prompt cache: {str(e)}")
@@ -0,0 +1,314 @@
+import os
+import random
+import asyncio
+import contextvars
+from collections import deque
+import metrics
+from scheduler import Overloaded
+
+# Seconds one attempt at a Gemini request may take once the scheduler has let it through
+GEMINI_DEADLINE = float(os.getenv('GEMINI_DEADLINE', '30'))
+
+# Extra attempts after a retryable failure (timeouts, rate limits, 5xx errors)
+GEMINI_RETRIES = int(os.getenv('GEMINI_RETRIES', '2'))
+
+# Backoff before retry n is a random delay up to min(GEMINI_RETRY_CAP, GEMINI_RETRY_BASE * 2**n) seconds
+GEMINI_RETRY_BASE = float(os.getenv('GEMINI_RETRY_BASE', '0.5'))
+GEMINI_RETRY_CAP = float(os.getenv('GEMINI_RETRY_CAP', '8'))
+
+# Consecutive retryable failures that open the circuit, and seconds it stays open before a probe
+GEMINI_BREAKER_THRESHOLD = int(os.getenv('GEMINI_BREAKER_THRESHOLD', '5'))
+GEMINI_BREAKER_RESET = float(os.getenv('GEMINI_BREAKER_RESET', '30'))
+
+# Send a second copy of a request still unanswered after the recent p95 latency
+GEMINI_HEDGE = os.getenv('GEMINI_HEDGE', 'false').lower() == 'true'
+
+# Most hedged requests as a share of all requests (0.05 = at most one extra request per twenty)
+GEMINI_HEDGE_BUDGET = float(os.getenv('GEMINI_HEDGE_BUDGET', '0.05'))
+
+# Latencies needed before the p95 is trusted for hedging
+HEDGE_MIN_SAMPLES = 20
+
+# Exception class names (from google.api_core and the standard library) worth another attempt
+RETRYABLE_ERRORS = frozenset((
+    'TimeoutError', 'ConnectionError', 'ConnectionResetError', 'ServiceUnavailable',
+    'ResourceExhausted', 'TooManyRequests', 'InternalServerError', 'DeadlineExceeded',
+    'GatewayTimeout', 'BadGateway', 'RetryError',
+))
+
+# HTTP status codes worth another attempt
+RETRYABLE_CODES = frozenset((408, 429, 500, 502, 503, 504))
+
+retries = metrics.counter('storybot_generation_retries_total', "Gemini requests retried after a retryable failure")
+hedges = metrics.counter('storybot_generation_hedges_total', "Hedged Gemini requests, by which copy answered first", labels=("winner",))
+rejections = metrics.counter('storybot_generation_rejected_total', "Gemini requests refused while the circuit was open")
+
+# Set by _hedged for each copy of a request; timed() resolves it when the request goes out
+_sent = contextvars.ContextVar('sent', default=None)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while the circuit breaker is open"""
+
+def is_retryable(error):
+    """
+    Decide whether a failed request is worth another attempt
+
+    Args:
+        error (Exception): What the attempt raised
+
+    Returns:
+        bool: True for timeouts, connection failures, rate limits and server errors
+    """
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    if type(error).__name__ in RETRYABLE_ERRORS:
+        return True
+    code = getattr(error, 'code', None)
+    return isinstance(code, int) and code in RETRYABLE_CODES
+
+def _now():
+    # The event loop's clock, so the policy also runs under a simulated one
+    return asyncio.get_event_loop().time()
+
+def backoff(attempt, base=GEMINI_RETRY_BASE, cap=GEMINI_RETRY_CAP):
+    """Seconds to wait before retry number attempt (from 0), with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class CircuitBreaker:
+    """
+    Fails fast once the backend looks down
+
+    Closed, it lets everything through and counts consecutive failures. At
+    the threshold it opens and refuses requests for reset_after seconds, then
+    lets a single probe through (half-open): a success closes it again, a
+    failure reopens it. A probe that never reports back (e.g. it was
+    cancelled) is followed by another once reset_after has passed again.
+    """
+
+    def __init__(self, threshold=GEMINI_BREAKER_THRESHOLD, reset_after=GEMINI_BREAKER_RESET):
+        """
+        Args:
+            threshold (int): Consecutive failures that open the circuit
+            reset_after (float): Seconds before an open circuit allows a probe
+        """
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.state = 'closed'
+        self.failures = 0
+        # When the circuit opened, or when the last probe went out
+        self.opened_at = 0.0
+
+    def allow(self):
+        """Whether a request may go out now"""
+        if self.state == 'closed':
+            return True
+        if _now() - self.opened_at >= self.reset_after:
+            self.state = 'half-open'
+            self.opened_at = _now()
+            return True
+        return False
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half-open' or self.failures >= self.threshold:
+            if self.state != 'open':
+                print(f"Gemini circuit opened after {self.failures} failures")
+            self.state = 'open'
+            self.opened_at = _now()
+
+class CallPolicy:
+    """
+    Deadlines, retries, a circuit breaker and optional hedging for one backend
+
+    run() takes a coroutine function making one attempt, which wraps the
+    request itself in timed() so it is held to the deadline (time spent
+    queueing for the request doesn't count against it). Retryable failures are retried with jittered
+    exponential backoff unless the breaker has opened. With hedging on, an
+    attempt still running after the recent p95 latency gets a second copy,
+    and whichever answers first is used - as long as the hedge budget allows.
+    """
+
+    def __init__(self, deadline=GEMINI_DEADLINE, retries=GEMINI_RETRIES, breaker=None,
+                 hedge=GEMINI_HEDGE, hedge_budget=GEMINI_HEDGE_BUDGET):
+        """
+        Args:
+            deadline (float): Seconds each attempt may take
+            retries (int): Extra attempts after retryable failures
+            breaker (CircuitBreaker): Shared breaker; a new one by default
+            hedge (bool): Whether to hedge slow attempts
+            hedge_budget (float): Most hedges as a share of requests
+        """
+        self.deadline = deadline
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge = hedge
+        self.hedge_budget = hedge_budget
+        self.latencies = deque(maxlen=500)
+        self.stats = {"requests": 0, "retries": 0, "timeouts": 0, "rejected": 0, "hedges": 0, "hedge_wins": 0}
+        self._hedge_credit = 0.0
+
+    def check(self):
+        """Count a new request, raising CircuitOpenError if the breaker is refusing requests"""
+        if not self.breaker.allow():
+            self.stats["rejected"] += 1
+            rejections.inc()
+            raise CircuitOpenError("Gemini is unavailable right now; try again shortly")
+        self.stats["requests"] += 1
+
+    async def run(self, attempt):
+        """
+        Call attempt() under the policy
+
+        Args:
+            attempt: Coroutine function making one request, awaited through
+                timed(), and returning its result
+
+        Returns:
+            The result of the first successful attempt
+
+        Raises:
+            CircuitOpenError: If the breaker refused the request
+            Exception: The last attempt's error once retries are used up
+        """
+        self.check()
+        self._hedge_credit = min(self._hedge_credit + self.hedge_budget, 1.0)
+        number = 0
+        while True:
+            try:
+                result = await (self._hedged(attempt) if self.hedge else attempt())
+            except Exception as e:
+                if not await self.retry_after(e, number):
+                    raise
+                number += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def timed(self, awaitable, deadline=None):
+        """
+        Await something under the deadline, noting how long it took
+
+        Args:
+            awaitable: The request to wait for
+            deadline (float): Seconds allowed; defaults to the policy's deadline
+
+        Returns:
+            Whatever the awaitable returns
+        """
+        started = _now()
+        sent = _sent.get()
+        if sent is not None and not sent.done():
+            sent.set_result(None)
+        try:
+            result = await asyncio.wait_for(awaitable, deadline or self.deadline)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+        self.latencies.append(_now() - started)
+        return result
+
+    async def retry_after(self, error, number):
+        """
+        Record a failed attempt and wait out the backoff if it should be retried
+
+        Args:
+            error (Exception): What the attempt raised
+            number (int): Retries made so far for this request
+
+        Returns:
+            bool: True if the caller should try again
+        """
+        if not self.record_error(error):
+            return False
+        if number >= self.retries or not self.breaker.allow():
+            return False
+        self.stats["retries"] += 1
+        retries.inc()
+        await asyncio.sleep(backoff(number))
+        return True
+
+    def record_error(self, error):
+        """
+        Tell the breaker about a failed attempt
+
+        A non-retryable error still means the backend answered, so it counts
+        as a success; this way a half-open probe is resolved whatever happens.
+        Errors raised here before any request went out (a full queue or an
+        open breaker) say nothing about the backend and are left out.
+
+        Args:
+            error (Exception): What the attempt raised
+
+        Returns:
+            bool: Whether the error is retryable
+        """
+        if isinstance(error, (Overloaded, CircuitOpenError)):
+            return False
+        if not is_retryable(error):
+            self.breaker.record_success()
+            return False
+        self.breaker.record_failure()
+        return True
+
+    def hedge_delay(self):
+        """The recent p95 latency, or None until enough requests have been seen"""
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95)]
+
+    def report(self):
+        """
+        Summarize the policy's activity
+
+        Returns:
+            dict: Request, retry, timeout, rejection and hedge counts, the
+                breaker's state, and the current hedge delay
+        """
+        return dict(self.stats, breaker=self.breaker.state, hedge_delay=self.hedge_delay())
+
+    async def _hedged(self, attempt):
+        sent = asyncio.get_event_loop().create_future()
+        first = asyncio.ensure_future(self._marked(attempt, sent))
+        tasks = [first]
+        try:
+            delay = self.hedge_delay()
+            if delay is None:
+                return await first
+            # The delay runs from when the request goes out, not from when it joined the scheduler's queue
+            await asyncio.wait([first, sent], return_when=asyncio.FIRST_COMPLETED)
+            if not first.done():
+                await asyncio.wait([first], timeout=delay)
+            if first.done() or self._hedge_credit < 1.0:
+                return await first
+
+            self._hedge_credit -= 1.0
+            self.stats["hedges"] += 1
+            second = asyncio.ensure_future(attempt())
+            tasks.append(second)
+            pending = {first, second}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = "hedge" if task is second else "original"
+                        if task is second:
+                            self.stats["hedge_wins"] += 1
+                        hedges.inc(winner)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # The losing copy, or both if the caller gave up
+            for task in tasks:
+                task.cancel()
+
+    async def _marked(self, attempt, sent):
+        # Runs in its own task's copy of the context, so only this copy's timed() sees sent
+        _sent.set(sent)
+        return await attempt()
@@ -0,0 +1,273 @@
+import os
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import metrics
+
+# Requests per minute allowed by the Gemini quota
+GEMINI_RPM = float(os.getenv('GEMINI_RPM', '1000'))
+
+# Tokens (input plus output) per minute allowed by the Gemini quota
+GEMINI_TPM = float(os.getenv('GEMINI_TPM', '1000000'))
+
+# Requests allowed to wait at once; beyond this new requests are turned away
+GEMINI_MAX_QUEUED = int(os.getenv('GEMINI_MAX_QUEUED', '200'))
+
+# Output tokens reserved per request until the real count is known
+OUTPUT_ESTIMATE = int(os.getenv('GEMINI_OUTPUT_ESTIMATE', '800'))
+
+# Shortest quota wait the scheduler sets a timer for; a float leftover of a few ulps wouldn't move the clock
+MIN_WAIT = 0.001
+
+# Priority classes, served strictly in this order: a player waiting on !roleplay,
+# a story waiting on its next round, then work nobody is waiting on yet
+# (summaries, speculative branches, pre-generated openers)
+OPENER = 'opener'
+CONTINUE = 'continue'
+BACKGROUND = 'background'
+PRIORITIES = (OPENER, CONTINUE, BACKGROUND)
+
+queue_wait = metrics.histogram('storybot_queue_wait_seconds', "Time Gemini requests wait in the scheduler", labels=("priority",))
+shed = metrics.counter('storybot_requests_shed_total', "Gemini requests turned away because the queue was full", labels=("priority",))
+
+class Overloaded(Exception):
+    """Raised for a request the scheduler won't queue because it is full"""
+
+class Lane:
+    """Who a request is for: its priority class, guild and channel"""
+
+    __slots__ = ('priority', 'guild_id', 'channel_id')
+
+    def __init__(self, priority=BACKGROUND, guild_id=None, channel_id=None):
+        self.priority = priority
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+
+class TokenBucket:
+    """
+    Allowance that refills continuously at a per-minute rate
+
+    The level may go below zero when a request turns out to cost more than
+    was reserved for it; later requests then wait for the debt to refill.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = None
+
+    def wait_for(self, amount, now):
+        """Seconds until amount is available (0 if it is now)"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+    def _refill(self, now):
+        if self.updated is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+class _Waiter:
+    __slots__ = ('future', 'lane', 'tokens', 'enqueued')
+
+    def __init__(self, future, lane, tokens, enqueued):
+        self.future = future
+        self.lane = lane
+        self.tokens = tokens
+        self.enqueued = enqueued
+
+class Scheduler:
+    """
+    Admits Gemini requests fairly within the concurrency limit and quota
+
+    Waiting requests sit in one queue per priority class. Within a class
+    they are served round-robin by guild, and within a guild round-robin by
+    channel, so one busy guild can't crowd out the rest. A request is only
+    admitted when a slot is free and the RPM and TPM buckets can cover it;
+    its token cost is estimated up front and corrected with settle() once
+    the response reports real usage. When the queue is full, background
+    work is shed first and new requests are refused with Overloaded.
+    """
+
+    def __init__(self, max_in_flight, rpm=GEMINI_RPM, tpm=GEMINI_TPM, max_queued=GEMINI_MAX_QUEUED):
+        """
+        Args:
+            max_in_flight (int): Requests allowed in flight at once
+            rpm (float): Requests per minute
+            tpm (float): Tokens per minute
+            max_queued (int): Requests allowed to wait at once
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.in_flight = 0
+        self.queued = 0
+        self.shed = 0
+        # priority -> guild id -> channel id -> deque of waiters
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._timer = None
+
+    @asynccontextmanager
+    async def slot(self, lane, tokens):
+        """
+        Wait for the scheduler to admit a request, and hold its slot meanwhile
+
+        Args:
+            lane (Lane): Who the request is for
+            tokens (int): Estimated tokens the request will use
+
+        Raises:
+            Overloaded: If the queue is full
+        """
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        if self.queued or not self._admit(tokens, started):
+            await self._wait(lane, tokens, started)
+        queue_wait.observe(loop.time() - started, lane.priority)
+
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._pump()
+
+    def settle(self, estimated, actual):
+        """Correct the token bucket once a request's real usage is known"""
+        if actual:
+            self.tokens.take(actual - estimated, asyncio.get_event_loop().time())
+
+    def stats(self):
+        """
+        Report the scheduler's load
+
+        Returns:
+            dict: In-flight and queued requests, queued requests per priority,
+                requests shed, and what is left in the RPM and TPM buckets
+        """
+        now = asyncio.get_event_loop().time()
+        self.requests.wait_for(0, now)
+        self.tokens.wait_for(0, now)
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queued_by_priority": {
+                priority: sum(len(waiters) for guild in self._queues[priority].values() for waiters in guild.values())
+                for priority in PRIORITIES
+            },
+            "shed": self.shed,
+            "rpm_left": self.requests.level,
+            "tpm_left": self.tokens.level,
+        }
+
+    def _admit(self, tokens, now):
+        # Claim a slot and the quota for a request if all are available right now
+        if self.in_flight >= self.max_in_flight:
+            return False
+        if self.requests.wait_for(1, now) or self.tokens.wait_for(tokens, now):
+            return False
+        self.requests.take(1, now)
+        self.tokens.take(tokens, now)
+        self.in_flight += 1
+        return True
+
+    async def _wait(self, lane, tokens, started):
+        if self.queued >= self.max_queued and not self._shed_for(lane.priority):
+            self.shed += 1
+            shed.inc(lane.priority)
+            raise Overloaded("Too many stories are waiting on the storyteller right now")
+
+        waiter = _Waiter(asyncio.get_event_loop().create_future(), lane, tokens, started)
+        guilds = self._queues[lane.priority]
+        guilds.setdefault(lane.guild_id, OrderedDict()).setdefault(lane.channel_id, deque()).append(waiter)
+        self.queued += 1
+        self._pump()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                # Admitted just as the caller gave up; hand the slot back (a shed request never held one)
+                self.in_flight -= 1
+                self._pump()
+            else:
+                self._remove(waiter)
+            raise
+
+    def _shed_for(self, priority):
+        # Make room for a request by dropping the newest background request, if it outranks that
+        if priority == BACKGROUND:
+            return False
+        guilds = self._queues[BACKGROUND]
+        for guild_id in reversed(guilds):
+            for channel_id in reversed(guilds[guild_id]):
+                waiter = guilds[guild_id][channel_id][-1]
+                self._remove(waiter)
+                self.shed += 1
+                shed.inc(BACKGROUND)
+                waiter.future.set_exception(Overloaded("Dropped to make room for a story round"))
+                return True
+        return False
+
+    def _remove(self, waiter):
+        channels = self._queues[waiter.lane.priority].get(waiter.lane.guild_id)
+        waiters = channels.get(waiter.lane.channel_id) if channels else None
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        self.queued -= 1
+        if not waiters:
+            del channels[waiter.lane.channel_id]
+            if not channels:
+                del self._queues[waiter.lane.priority][waiter.lane.guild_id]
+
+    def _next(self):
+        # The next waiter in round-robin order: highest priority, then guild, then channel
+        for priority in PRIORITIES:
+            guilds = self._queues[priority]
+            if guilds:
+                channels = next(iter(guilds.values()))
+                return next(iter(channels.values()))[0]
+        return None
+
+    def _pump(self):
+        loop = asyncio.get_event_loop()
+        while self.queued:
+            waiter = self._next()
+            if self.in_flight >= self.max_in_flight:
+                return
+            now = loop.time()
+            wait = max(self.requests.wait_for(1, now), self.tokens.wait_for(waiter.tokens, now))
+            if wait:
+                # Out of quota; come back when the head of the queue fits
+                wait = max(wait, MIN_WAIT)
+                if self._timer is None or self._timer.when() > now + wait:
+                    if self._timer is not None:
+                        self._timer.cancel()
+                    self._timer = loop.call_at(now + wait, self._wake)
+                return
+
+            self._remove(waiter)
+            self._rotate(waiter.lane)
+            self.requests.take(1, now)
+            self.tokens.take(waiter.tokens, now)
+            self.in_flight += 1
+            waiter.future.set_result(None)
+
+    def _rotate(self, lane):
+        # Move the served guild, and the served channel within it, to the back of the line
+        guilds = self._queues[lane.priority]
+        channels = guilds.get(lane.guild_id)
+        if channels is None:
+            return
+        if lane.channel_id in channels:
+            channels.move_to_end(lane.channel_id)
+        guilds.move_to_end(lane.guild_id)
+
+    def _wake(self):
+        self._timer = None
+        self._pump()
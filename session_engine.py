@@ -0,0 +1,236 @@
+import asyncio
+import heapq
+import itertools
+from collections import deque
+
+# Rounds of voters remembered per session, for judging how many players to expect
+RECENT_ROUNDS = 3
+
+# Superseded deadlines allowed per live session before the heap is rebuilt without them
+STALE_DEADLINES = 4
+
+# Session states
+GENERATING = 'generating'
+VOTING = 'voting'
+TALLYING = 'tallying'
+ENDED = 'ended'
+
+class Session:
+    """
+    One channel's running story, holding only the state of the current round
+
+    Each round overwrites the previous round's message, emojis, options and
+    speculation, so a session's memory stays the same however long it runs.
+    """
+
+    __slots__ = (
+        'channel_id', 'channel', 'state', 'rounds', 'deadline',
+        'message', 'emoji_a', 'emoji_b', 'option_a', 'option_b', 'speculation', 'length_instruction', 'failures',
+        'opened', 'close_reason', 'participants',
+    )
+
+    def __init__(self, channel_id, channel):
+        self.channel_id = channel_id
+        self.channel = channel
+        self.state = GENERATING
+        self.rounds = 0
+        self.deadline = None
+        self.message = None
+        self.emoji_a = None
+        self.emoji_b = None
+        self.option_a = None
+        self.option_b = None
+        self.speculation = None
+        # The length instruction the round's prompts are built with, fixed when its vote opened
+        self.length_instruction = None
+        # Rounds in a row that failed to generate; reset by the next one that succeeds
+        self.failures = 0
+        # When the current vote opened (loop time) and why it closed, or will close unless moved
+        self.opened = None
+        self.close_reason = None
+        # Voters in each of the last few rounds (sets of user ids), newest last
+        self.participants = deque(maxlen=RECENT_ROUNDS)
+
+    def begin_vote(self, message, emoji_a, emoji_b, option_a, option_b, speculation=None, length_instruction=None):
+        """
+        Record the round that is now open for voting
+
+        Args:
+            message: The message users vote on
+            emoji_a (str): The emoji for option A
+            emoji_b (str): The emoji for option B
+            option_a (str): The text for option A
+            option_b (str): The text for option B
+            speculation: Branches being generated during the vote, if any
+            length_instruction (str): The length instruction for the round's
+                prompts, if it was fixed when the vote opened
+        """
+        self.message = message
+        self.emoji_a = emoji_a
+        self.emoji_b = emoji_b
+        self.option_a = option_a
+        self.option_b = option_b
+        self.speculation = speculation
+        self.length_instruction = length_instruction
+        self.rounds += 1
+
+class SessionEngine:
+    """
+    Runs every channel's story as a state machine: generating -> voting -> tallying
+
+    There is at most one session per channel. Voting deadlines for all
+    sessions sit in one heap served by a single timer on the event loop; when
+    a vote closes, the round handler runs as its own short task, and a session
+    that continues is simply put back on the heap. No round ever waits on the
+    next, so nothing accumulates as a story goes on.
+    """
+
+    def __init__(self, run_round, on_end=None, on_vote_open=None, voting_duration=60):
+        """
+        Args:
+            run_round: Async callable taking a Session whose vote just closed;
+                returns True if it opened a new vote, False if the story ended
+            on_end: Optional callable taking a Session, called once when it ends
+            on_vote_open: Optional callable taking a Session, called each time
+                a vote is opened (e.g. to checkpoint it)
+            voting_duration (float): Default seconds a vote stays open
+        """
+        self.run_round = run_round
+        self.on_end = on_end
+        self.on_vote_open = on_vote_open
+        self.voting_duration = voting_duration
+        self.sessions = {}
+        self._deadlines = []
+        self._order = itertools.count()
+        self._timer = None
+        self._timer_deadline = None
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def is_active(self, channel_id):
+        """Whether a channel already has a story running"""
+        return channel_id in self.sessions
+
+    def open(self, channel_id, channel):
+        """
+        Start a session for a channel
+
+        Args:
+            channel_id (str): The channel's id
+            channel: The channel the story is told in
+
+        Returns:
+            Session: The new session, or None if the channel already has one
+        """
+        if channel_id in self.sessions:
+            return None
+        session = Session(channel_id, channel)
+        self.sessions[channel_id] = session
+        return session
+
+    def schedule_vote(self, session, duration=None):
+        """
+        Open voting on a session's current round and arm its deadline
+
+        Args:
+            session (Session): The session whose vote opens
+            duration (float): Seconds until the vote closes; defaults to voting_duration
+        """
+        if session.state == ENDED:
+            return
+        loop = asyncio.get_event_loop()
+        session.state = VOTING
+        session.opened = loop.time()
+        session.close_reason = 'max'
+        session.deadline = session.opened + (self.voting_duration if duration is None else duration)
+        heapq.heappush(self._deadlines, (session.deadline, next(self._order), session))
+        self._arm(loop)
+        if self.on_vote_open is not None:
+            self.on_vote_open(session)
+
+    def close_vote_now(self, session):
+        """Close a session's vote immediately instead of waiting for its deadline"""
+        self.move_deadline(session, asyncio.get_event_loop().time())
+
+    def move_deadline(self, session, deadline):
+        """
+        Close a session's vote at a different time, earlier or later
+
+        Args:
+            session (Session): The session whose vote is open
+            deadline (float): When to close it, in event loop time
+        """
+        if session.state != VOTING or deadline == session.deadline:
+            return
+        loop = asyncio.get_event_loop()
+        session.deadline = max(deadline, loop.time())
+        # The old heap entry is skipped when it comes up, since it no longer matches session.deadline
+        heapq.heappush(self._deadlines, (session.deadline, next(self._order), session))
+        if len(self._deadlines) > STALE_DEADLINES * (len(self.sessions) + 1):
+            self._compact()
+        self._arm(loop)
+
+    def time_left(self, session):
+        """Seconds until a session's vote closes (0 if it isn't voting)"""
+        if session.state != VOTING:
+            return 0
+        return max(0.0, session.deadline - asyncio.get_event_loop().time())
+
+    def end(self, session):
+        """Finish a session and release its channel; safe to call more than once"""
+        if session.state == ENDED:
+            return
+        session.state = ENDED
+        if self.sessions.get(session.channel_id) is session:
+            del self.sessions[session.channel_id]
+        if self.on_end is not None:
+            self.on_end(session)
+
+    def _compact(self):
+        # Votes rescheduled on every reaction leave a trail of superseded entries; drop them in one pass
+        self._deadlines = [
+            entry for entry in self._deadlines
+            if entry[2].state == VOTING and entry[2].deadline == entry[0]
+        ]
+        heapq.heapify(self._deadlines)
+
+    def _arm(self, loop):
+        # Keep exactly one timer, set for the earliest pending deadline
+        if not self._deadlines:
+            return
+        deadline = self._deadlines[0][0]
+        if self._timer is not None:
+            if self._timer_deadline <= deadline:
+                return
+            self._timer.cancel()
+        self._timer = loop.call_at(deadline, self._fire)
+        self._timer_deadline = deadline
+
+    def _fire(self):
+        loop = asyncio.get_event_loop()
+        self._timer = None
+        now = loop.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, _, session = heapq.heappop(self._deadlines)
+            # Skip entries superseded by a reschedule or an ended session
+            if session.state != VOTING or session.deadline != deadline:
+                continue
+            session.state = TALLYING
+            task = loop.create_task(self._advance(session))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self._arm(loop)
+
+    async def _advance(self, session):
+        try:
+            keep_going = await self.run_round(session)
+        except Exception as e:
+            print(f"Story round failed in channel {session.channel_id}: {str(e)}")
+            keep_going = False
+
+        if keep_going and session.state != ENDED:
+            self.schedule_vote(session)
+        else:
+            self.end(session)
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+# SQLite database shared by every worker process
+SHARED_STATE_PATH = os.getenv('SHARED_STATE_PATH', 'sessions.db')
+
+# Identifies this process as the owner of the sessions it runs; stable across restarts
+WORKER_ID = os.getenv('WORKER_ID', 'main')
+
+# Seconds without a heartbeat before another worker may take over a session
+SESSION_LEASE = float(os.getenv('SESSION_LEASE', '60'))
+
+# Saved sessions older than this many seconds are dropped instead of resumed
+SESSION_RESUME_MAX_AGE = float(os.getenv('SESSION_RESUME_MAX_AGE', '3600'))
+
+def shard_for(guild_id, shard_count):
+    """
+    Work out which Discord shard a guild belongs to
+
+    Args:
+        guild_id: The guild's id, or None for DMs
+        shard_count (int): Total number of shards
+
+    Returns:
+        int: The shard id
+    """
+    if guild_id is None:
+        return 0
+    return (int(guild_id) >> 22) % shard_count
+
+class SessionStore:
+    """
+    Running stories saved in a SQLite file that all workers share
+
+    Each row holds everything needed to pick a story back up: its history and
+    the vote that is currently open. Rows are owned by the worker running them
+    and kept alive by a heartbeat, so when a worker dies its sessions can be
+    claimed by whichever worker now serves their shard. The votes themselves
+    live on the Discord message, so a resumed session recounts them there.
+    """
+
+    def __init__(self, path=SHARED_STATE_PATH, worker_id=WORKER_ID, lease=SESSION_LEASE):
+        """
+        Args:
+            path (str): Path of the SQLite database file
+            worker_id (str): This worker's id
+            lease (float): Seconds a silent worker keeps its sessions
+        """
+        self.path = path
+        self.worker_id = worker_id
+        self.lease = lease
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "channel_id TEXT PRIMARY KEY, "
+            "guild_id TEXT, "
+            "owner TEXT NOT NULL, "
+            "heartbeat REAL NOT NULL, "
+            "updated_at REAL NOT NULL, "
+            "state TEXT NOT NULL)"
+        )
+        # All access after startup goes through this one thread so the event loop never blocks on disk
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-store')
+        self._heartbeat = None
+        self._closed = False
+        # Writes queued by save_later/delete_later that haven't finished yet
+        self._pending = set()
+
+    async def save(self, channel_id, guild_id, state):
+        """
+        Save (or replace) a session's state, taking ownership of it
+
+        Args:
+            channel_id (str): The session's channel id
+            guild_id: The channel's guild id, or None for DMs
+            state (dict): JSON-serializable session state
+        """
+        await self._run(self._save, channel_id, guild_id, json.dumps(state))
+
+    async def delete(self, channel_id):
+        """Forget a session that has ended"""
+        await self._run(self._delete, channel_id)
+
+    def save_later(self, channel_id, guild_id, state):
+        """Queue save() without waiting for it; close() finishes it if it is still queued"""
+        self._queue(self._save, channel_id, guild_id, json.dumps(state))
+
+    def delete_later(self, channel_id):
+        """Queue delete() without waiting for it; close() finishes it if it is still queued"""
+        self._queue(self._delete, channel_id)
+
+    async def claim(self, shard_ids=None, shard_count=None):
+        """
+        Take over every saved session this worker should be running
+
+        That is this worker's own sessions (e.g. from before a restart) and any
+        whose owner's lease has expired, limited to the shards this worker serves.
+
+        Args:
+            shard_ids (list): Shards served by this worker, or None for all
+            shard_count (int): Total number of shards, or None if not sharded
+
+        Returns:
+            list: (channel_id, state) pairs for the claimed sessions
+        """
+        return await self._run(self._claim, shard_ids, shard_count) or []
+
+    def start_heartbeat(self, interval=None):
+        """Keep this worker's leases alive in the background"""
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.ensure_future(self._beat(interval or self.lease / 3))
+
+    def close(self):
+        """Stop the heartbeat, finish queued writes and close the database (saved sessions are kept for resuming)"""
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        self._closed = True
+        # Waits for everything already handed to the writer, so queued writes aren't lost on shutdown
+        self._writer.shutdown(wait=True)
+        self._db.close()
+
+    async def _run(self, function, *args):
+        if self._closed:
+            return None
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self._writer, function, *args)
+        except sqlite3.Error as e:
+            print(f"Session store error: {str(e)}")
+            return None
+
+    def _queue(self, function, *args):
+        # Handed straight to the writer thread rather than wrapped in a task, so the write
+        # doesn't depend on the event loop still running and stays in order with the rest
+        if self._closed:
+            return
+        future = self._writer.submit(function, *args)
+        self._pending.add(future)
+        future.add_done_callback(self._finished)
+
+    def _finished(self, future):
+        self._pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Session store error: {str(future.exception())}")
+
+    async def _beat(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self._run(self._touch)
+
+    def _save(self, channel_id, guild_id, state):
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions (channel_id, guild_id, owner, heartbeat, updated_at, state) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (channel_id, None if guild_id is None else str(guild_id), self.worker_id, now, now, state),
+        )
+
+    def _delete(self, channel_id):
+        self._db.execute("DELETE FROM sessions WHERE channel_id = ?", (channel_id,))
+
+    def _touch(self):
+        self._db.execute("UPDATE sessions SET heartbeat = ? WHERE owner = ?", (time.time(), self.worker_id))
+
+    def _claim(self, shard_ids, shard_count):
+        now = time.time()
+        claimed = []
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (now - SESSION_RESUME_MAX_AGE,))
+            rows = self._db.execute(
+                "SELECT channel_id, guild_id, state FROM sessions WHERE owner = ? OR heartbeat < ?",
+                (self.worker_id, now - self.lease),
+            ).fetchall()
+            for channel_id, guild_id, state in rows:
+                if shard_ids is not None and shard_for(guild_id, shard_count) not in shard_ids:
+                    continue
+                self._db.execute(
+                    "UPDATE sessions SET owner = ?, heartbeat = ? WHERE channel_id = ?",
+                    (self.worker_id, now, channel_id),
+                )
+                claimed.append((channel_id, json.loads(state)))
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return claimed
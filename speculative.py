@@ -0,0 +1,128 @@
+import asyncio
+import metrics
+from story_context import estimate_tokens
+
+# Totals across every speculative round in the process
+stats = {
+    "rounds": 0,
+    "hits": 0,
+    "misses": 0,
+    "wasted_prompt_tokens": 0,
+    "wasted_output_tokens": 0,
+}
+
+outcomes = metrics.counter('storybot_speculation_rounds_total', "Speculative rounds, by whether the winning branch was served",
+                           labels=("result",))
+wasted_tokens = metrics.counter('storybot_speculation_wasted_tokens_total',
+                                "Estimated tokens spent on speculative branches that were thrown away", labels=("kind",))
+
+def _count(result):
+    stats[result] += 1
+    outcomes.inc("hit" if result == "hits" else "miss")
+
+def report():
+    """
+    Summarize how well speculation has been paying off
+
+    Returns:
+        dict: The running totals plus the hit rate (0.0 when nothing was served yet)
+    """
+    result = dict(stats)
+    result["hit_rate"] = stats["hits"] / stats["rounds"] if stats["rounds"] else 0.0
+    return result
+
+class Speculation:
+    """
+    Continuations for every option of a round, generated while the vote is open
+
+    Each branch builds its prompt and generates in a background task. When the
+    vote closes, take() serves the winning branch if it was generated from the
+    same prompt the round would send now, and throws away everything else.
+    Prompts can change late (custom emoji elements, a refreshed summary), in
+    which case take() reports a miss and the caller generates fresh.
+    """
+
+    def __init__(self, generate):
+        """
+        Args:
+            generate: Async callable taking a prompt and returning generated text
+        """
+        self.generate = generate
+        self._branches = {}
+
+    def start(self, key, build_prompt, ready=None):
+        """
+        Begin generating one branch in the background
+
+        Args:
+            key (str): Identifies the branch, e.g. the formatted option text
+            build_prompt: Callable returning the prompt for this branch
+            ready: Optional async callable to wait on before building the prompt
+        """
+        branch = {"prompt": None}
+        branch["task"] = asyncio.ensure_future(self._run(branch, build_prompt, ready))
+        self._branches[key] = branch
+
+    async def take(self, key, prompt):
+        """
+        Claim the speculative result for the winning branch
+
+        Args:
+            key (str): The branch that won the vote
+            prompt (str): The prompt the round would send without speculation
+
+        Returns:
+            str: The generated text, or None if the branch can't be used
+        """
+        stats["rounds"] += 1
+        branch = self._branches.pop(key, None)
+        self.discard()
+
+        if branch is None:
+            _count("misses")
+            return None
+
+        # Don't wait on a branch that is already known to be stale
+        if branch["prompt"] is not None and branch["prompt"] != prompt:
+            _count("misses")
+            self._waste(branch)
+            return None
+
+        try:
+            text = await branch["task"]
+        except Exception:
+            _count("misses")
+            return None
+
+        if branch["prompt"] != prompt:
+            _count("misses")
+            self._waste(branch)
+            return None
+
+        _count("hits")
+        return text
+
+    def discard(self):
+        """Cancel or throw away every branch that has not been taken"""
+        for branch in self._branches.values():
+            self._waste(branch)
+        self._branches.clear()
+
+    async def _run(self, branch, build_prompt, ready):
+        if ready is not None:
+            await ready()
+        branch["prompt"] = build_prompt()
+        return await self.generate(branch["prompt"])
+
+    def _waste(self, branch):
+        task = branch["task"]
+        if branch["prompt"] is not None:
+            tokens = estimate_tokens(branch["prompt"])
+            stats["wasted_prompt_tokens"] += tokens
+            wasted_tokens.inc("prompt", amount=tokens)
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            tokens = estimate_tokens(task.result())
+            stats["wasted_output_tokens"] += tokens
+            wasted_tokens.inc("output", amount=tokens)
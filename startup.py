@@ -0,0 +1,49 @@
+import time
+import metrics
+
+# When this module was first imported; bot.py imports it before anything else
+STARTED = time.perf_counter()
+
+startup_seconds = metrics.histogram('storybot_startup_seconds', "Time taken by each phase of startup", labels=("phase",))
+
+# Phase name -> seconds, in the order the phases finished
+phases = {}
+
+_last = STARTED
+
+def mark(phase):
+    """
+    Record that a phase of startup has just finished
+
+    The phase is timed from the previous mark (or from process start), so
+    marks should be made in the order the phases run.
+
+    Args:
+        phase (str): Name of the phase, e.g. "imports"
+    """
+    global _last
+    now = time.perf_counter()
+    record(phase, now - _last)
+    _last = now
+
+def record(phase, seconds):
+    """
+    Record a phase that ran alongside the others and was timed separately
+
+    Args:
+        phase (str): Name of the phase, e.g. "warm-up"
+        seconds (float): How long it took
+    """
+    if phase not in phases:
+        phases[phase] = seconds
+        startup_seconds.observe(seconds, phase)
+
+def report():
+    """
+    Describe where startup time went
+
+    Returns:
+        str: Each phase's duration and the total time since process start
+    """
+    breakdown = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in phases.items())
+    return f"Startup: {breakdown} (ready after {_last - STARTED:.2f}s)"
@@ -0,0 +1,256 @@
+import os
+import time
+import asyncio
+from collections import deque
+
+# Number of most recent segments always sent to the model verbatim
+RECENT_SEGMENTS = int(os.getenv('STORY_RECENT_SEGMENTS', '4'))
+
+# Older segments are folded into the summary once this many have piled up
+SUMMARIZE_EVERY = int(os.getenv('STORY_SUMMARIZE_EVERY', '2'))
+
+# Maximum estimated tokens of story context included in a single prompt
+TOKEN_BUDGET = int(os.getenv('STORY_TOKEN_BUDGET', '6000'))
+
+# Rough characters-per-token ratio used for estimates (close enough for English prose)
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens in a piece of text
+
+    Args:
+        text (str): The text to measure
+
+    Returns:
+        int: Approximate token count
+    """
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def format_segment(segment):
+    """
+    Render one story segment the way it appears in a prompt
+
+    Args:
+        segment (dict): A segment with "narrative" and "chosen_option" keys
+
+    Returns:
+        str: The narrative followed by the group's choice, if one was made
+    """
+    text = segment["narrative"] + "\n\n"
+    if segment["chosen_option"]:
+        text += f"**The group chose: {segment['chosen_option']}**\n\n"
+    return text
+
+class StoryContext:
+    """
+    Rolling context window for one channel's story
+
+    The most recent segments are kept verbatim and everything older is folded
+    into a running summary. Summaries are generated in a background task so a
+    round never waits on them, and every prompt is held to a token budget.
+    """
+
+    def __init__(self, summarize=None, recent_segments=RECENT_SEGMENTS,
+                 summarize_every=SUMMARIZE_EVERY, token_budget=TOKEN_BUDGET):
+        """
+        Args:
+            summarize: Async callable taking a prompt and returning text, used
+                to refresh the summary; without one, old segments are dropped
+            recent_segments (int): Segments always kept verbatim
+            summarize_every (int): Old segments to accumulate before folding
+            token_budget (int): Maximum estimated tokens of context per prompt
+        """
+        self.summarize = summarize
+        self.recent_segments = recent_segments
+        self.summarize_every = summarize_every
+        self.token_budget = token_budget
+        self.segments = []
+        self.summary = ""
+        self.rounds = 0
+        self.prompt_sizes = deque(maxlen=100)
+        # When the story last moved on (time.monotonic()), for evicting abandoned stories
+        self.last_active = time.monotonic()
+        self._summary_task = None
+
+    def __len__(self):
+        return len(self.segments)
+
+    def add_segment(self, narrative):
+        """
+        Append a newly generated segment to the story
+
+        Args:
+            narrative (str): The segment text, including its options
+        """
+        self.segments.append({"narrative": narrative, "chosen_option": None})
+        self.rounds += 1
+        self.last_active = time.monotonic()
+        self._maybe_fold()
+
+    def record_choice(self, chosen_option):
+        """
+        Record the option the group chose for the latest segment
+
+        Args:
+            chosen_option (str): The formatted winning option
+        """
+        if self.segments:
+            self.segments[-1]["chosen_option"] = chosen_option
+        self.last_active = time.monotonic()
+
+    def build(self, pending_choice=None):
+        """
+        Build the story context for the next prompt within the token budget
+
+        The summary comes first, followed by as many of the newest segments as
+        fit. The latest segment is always included, trimmed from the front if
+        it alone exceeds the budget.
+
+        Args:
+            pending_choice (str): Render the latest segment as if this option
+                had been chosen, without recording it
+
+        Returns:
+            str: The story context text
+        """
+        return "".join(self._parts(pending_choice))
+
+    def build_split(self, pending_choice=None):
+        """
+        Build the same context as build(), split before the latest segment
+
+        Everything before the latest segment only changes when the summary is
+        refreshed (or the budget trims the oldest segment), so it can be cached
+        as a prompt prefix while the latest segment and choice are sent fresh.
+
+        Args:
+            pending_choice (str): As for build()
+
+        Returns:
+            tuple: (settled, latest) strings that join to build()'s result
+        """
+        parts = self._parts(pending_choice)
+        if not parts:
+            return "", ""
+        return "".join(parts[:-1]), parts[-1]
+
+    def _parts(self, pending_choice):
+        budget = self.token_budget
+        parts = []
+
+        segments = self.segments
+        if pending_choice is not None and segments:
+            segments = segments[:-1] + [dict(segments[-1], chosen_option=pending_choice)]
+
+        for segment in reversed(segments):
+            text = format_segment(segment)
+            cost = estimate_tokens(text)
+            if cost > budget:
+                if not parts:
+                    parts.append(text[-budget * CHARS_PER_TOKEN:])
+                    budget = 0
+                break
+            parts.append(text)
+            budget -= cost
+
+        if self.summary and budget > 0:
+            summary = f"**Story so far:** {self.summary}\n\n"
+            if estimate_tokens(summary) > budget:
+                summary = summary[-budget * CHARS_PER_TOKEN:]
+            parts.append(summary)
+
+        parts.reverse()
+        return parts
+
+    def record_prompt(self, prompt):
+        """
+        Note the size of a prompt built from this context
+
+        Args:
+            prompt (str): The full prompt sent to the model
+
+        Returns:
+            int: Estimated tokens in the prompt
+        """
+        tokens = estimate_tokens(prompt)
+        self.prompt_sizes.append(tokens)
+        return tokens
+
+    @property
+    def last_prompt_tokens(self):
+        """Estimated tokens in the most recently recorded prompt, or 0"""
+        return self.prompt_sizes[-1] if self.prompt_sizes else 0
+
+    def to_dict(self):
+        """
+        Capture the story so it can be saved and restored elsewhere
+
+        Returns:
+            dict: The segments, summary and round count
+        """
+        return {"segments": self.segments, "summary": self.summary, "rounds": self.rounds}
+
+    @classmethod
+    def from_dict(cls, data, **kwargs):
+        """
+        Rebuild a context saved with to_dict()
+
+        Args:
+            data (dict): The saved story
+            **kwargs: Passed on to the constructor (e.g. summarize)
+
+        Returns:
+            StoryContext: The restored context
+        """
+        context = cls(**kwargs)
+        context.segments = [dict(segment) for segment in data["segments"]]
+        context.summary = data["summary"]
+        context.rounds = data["rounds"]
+        return context
+
+    async def settled(self):
+        """Wait for any summary refresh in progress to finish"""
+        if self._summary_task and not self._summary_task.done():
+            await asyncio.wait([self._summary_task])
+
+    def close(self):
+        """Cancel any summary still being generated"""
+        if self._summary_task and not self._summary_task.done():
+            self._summary_task.cancel()
+
+    def _maybe_fold(self):
+        overflow = len(self.segments) - self.recent_segments
+        if overflow < self.summarize_every:
+            return
+        if self._summary_task and not self._summary_task.done():
+            return
+
+        if self.summarize is None:
+            # Nothing to summarize with; just let the oldest segments go
+            del self.segments[:overflow]
+            return
+
+        folded = self.segments[:overflow]
+        self._summary_task = asyncio.ensure_future(self._refresh_summary(folded))
+
+    async def _refresh_summary(self, folded):
+        prompt = (
+            "Summarize the following roleplay story in one compact paragraph of at most 200 words. "
+            "Keep character names, key items, unresolved threats and the choices the group made; "
+            "drop descriptive detail.\n\n"
+        )
+        if self.summary:
+            prompt += f"Summary of earlier events:\n{self.summary}\n\n"
+        prompt += "Events to add:\n" + "".join(format_segment(segment) for segment in folded)
+
+        try:
+            summary = await self.summarize(prompt)
+        except Exception as e:
+            # Keep the segments and try again after the next round
+            print(f"Failed to refresh story summary: {str(e)}")
+            return
+
+        self.summary = summary.strip()
+        # Segments are only ever appended, so the folded ones are still at the front
+        del self.segments[:len(folded)]
@@ -0,0 +1,146 @@
+import os
+import time
+import asyncio
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Directory holding one segment log per channel
+STORY_LOG_DIR = os.getenv('STORY_LOG_DIR', 'story_logs')
+
+# Days a channel's log is kept after it was last written, for !recap (0 = forever)
+STORY_LOG_RETENTION = float(os.getenv('STORY_LOG_RETENTION', '30'))
+
+# Record kinds
+SEGMENT = b'S'
+CHOICE = b'C'
+
+# Each record is its kind, the compressed length, then the zlib-compressed UTF-8 text
+_HEADER = struct.Struct('>cI')
+
+class StoryLog:
+    """
+    Append-only, compressed record of every channel's story on disk
+
+    StoryContext only keeps a summary and the last few segments in memory;
+    the full story goes here, one file per channel, so it can be replayed
+    with !recap. Each record is compressed on its own, so nothing is held
+    per channel between writes and a file can be read back a few records at
+    a time. Writes go through one background thread, which keeps them in
+    order and keeps disk access off the event loop. A record cut short by a
+    crash is ignored when the log is read.
+    """
+
+    def __init__(self, directory=STORY_LOG_DIR, retention=STORY_LOG_RETENTION):
+        """
+        Args:
+            directory (str): Where to keep the log files
+            retention (float): Days to keep a log after its last write (0 = forever)
+        """
+        self.directory = directory
+        self.retention = retention
+        os.makedirs(directory, exist_ok=True)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='story-log')
+
+    def path(self, channel_id):
+        """The log file for a channel"""
+        return os.path.join(self.directory, f"{channel_id}.log")
+
+    def start(self, channel_id):
+        """Begin a new story in a channel, discarding the log of any earlier one"""
+        self._submit(self._truncate, channel_id)
+
+    def append(self, channel_id, kind, text):
+        """
+        Add a record to a channel's log
+
+        Args:
+            channel_id (str): The channel's id
+            kind (bytes): SEGMENT or CHOICE
+            text (str): The segment or the chosen option
+        """
+        self._submit(self._append, channel_id, kind, text)
+
+    async def replay(self, channel_id, batch=8):
+        """
+        Read a channel's story back, a few records at a time
+
+        Args:
+            channel_id (str): The channel's id
+            batch (int): Records read from disk per trip to the writer thread
+
+        Yields:
+            tuple: (kind, text) for each record, oldest first
+        """
+        loop = asyncio.get_event_loop()
+        offset = 0
+        while True:
+            # Reads share the writer thread, so they see every record appended before them
+            records, offset = await loop.run_in_executor(self._writer, self._read, channel_id, offset, batch)
+            for record in records:
+                yield record
+            if len(records) < batch:
+                return
+
+    def exists(self, channel_id):
+        """Whether a channel has a story on record"""
+        return os.path.exists(self.path(channel_id))
+
+    def prune(self):
+        """Delete logs that haven't been written to within the retention period, in the background"""
+        if self.retention:
+            self._submit(self._prune, time.time() - self.retention * 86400)
+
+    def flush(self):
+        """Block until every write submitted so far is on disk"""
+        self._writer.submit(lambda: None).result()
+
+    def close(self):
+        """Finish any pending writes"""
+        self._writer.shutdown(wait=True)
+
+    def _submit(self, function, *args):
+        self._writer.submit(function, *args).add_done_callback(_report_failure)
+
+    def _truncate(self, channel_id):
+        open(self.path(channel_id), 'wb').close()
+
+    def _append(self, channel_id, kind, text):
+        raw = text.encode('utf-8')
+        data = zlib.compress(raw)
+        with open(self.path(channel_id), 'ab') as log:
+            log.write(_HEADER.pack(kind, len(data)) + data)
+        self.bytes_in += len(raw)
+        self.bytes_out += _HEADER.size + len(data)
+
+    def _read(self, channel_id, offset, count):
+        records = []
+        try:
+            log = open(self.path(channel_id), 'rb')
+        except FileNotFoundError:
+            return records, offset
+        with log:
+            log.seek(offset)
+            while len(records) < count:
+                header = log.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                kind, length = _HEADER.unpack(header)
+                data = log.read(length)
+                if len(data) < length:
+                    break
+                records.append((kind, zlib.decompress(data).decode('utf-8')))
+                offset += _HEADER.size + length
+        return records, offset
+
+    def _prune(self, cutoff):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.log') and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+def _report_failure(future):
+    # Writes are fire-and-forget, so failures are logged here rather than raised
+    if future.exception() is not None:
+        print(f"Failed to write story log: {future.exception()}")
@@ -0,0 +1,208 @@
+import json
+import re
+import metrics
+
+# Options used when the model gives none
+DEFAULT_OPTIONS = ("Continue cautiously", "Take a risk")
+
+# Appended to a prompt when asking the model for a structured response
+STRUCTURED_INSTRUCTIONS = (
+    "\n\nRespond only with a JSON object with exactly these keys:\n"
+    '"narrative": the story text, following the formatting guidelines above but without the choices,\n'
+    '"option_a": the first choice as one sentence, without any label,\n'
+    '"option_b": the second choice as one sentence, without any label.'
+)
+
+# Where the narrative's string value starts in a JSON response, whatever order the keys come in
+_NARRATIVE_KEY = re.compile(r'"narrative"\s*:\s*"')
+
+# A line that starts with an option label, e.g. "**A)** Run", "A) Run" or "> **B) Hide**"
+_OPTION_LINE = re.compile(r'[ \t>]*(\*\*)?[ \t]*([AB])\)[ \t]*(\*\*)?[ \t]*(.*)')
+
+# Parsing tiers, from best to worst; every segment is counted under exactly one
+TIERS = ("structured", "bold", "plain", "fallback")
+
+# How often each parsing tier was used, plus JSON responses that had to fall back to text parsing
+stats = dict.fromkeys(TIERS + ("structured_failed",), 0)
+
+tier_counts = metrics.counter('storybot_parse_tier_total', "Story segments parsed, by the tier that found their options",
+                              labels=("tier",))
+structured_failures = metrics.counter('storybot_parse_structured_failed_total',
+                                      "JSON responses that had to fall back to text parsing")
+
+def _count(tier):
+    stats[tier] += 1
+    tier_counts.inc(tier)
+
+def report():
+    """
+    Summarize how often each parsing tier fired
+
+    Returns:
+        dict: Count and share of segments for each tier, and the number of
+            structured responses that could not be used
+    """
+    total = sum(stats[tier] for tier in TIERS)
+    summary = {
+        tier: {"count": stats[tier], "share": stats[tier] / total if total else 0.0}
+        for tier in TIERS
+    }
+    summary["structured_failed"] = stats["structured_failed"]
+    return summary
+
+def format_segment(narrative, option_a, option_b):
+    """
+    Lay out a narrative and its two options the way the bot posts them
+
+    Returns:
+        str: The narrative followed by the bold-labelled options
+    """
+    return f"{narrative}\n\n**A)** {option_a}\n**B)** {option_b}"
+
+def parse_segment(text, structured=False):
+    """
+    Split a generated story segment into its display text and two options
+
+    Options are only recognized on lines that start with an "A)" or "B)"
+    label, so narrative that merely contains "A)" is never mistaken for a
+    choice. The text is scanned once, line by line, and the last A/B pair wins.
+
+    Args:
+        text (str): The generated response
+        structured (bool): Whether the response should be a JSON object with
+            narrative, option_a and option_b fields
+
+    Returns:
+        tuple: (display_text, option_a, option_b); display_text always ends
+            with bold-labelled options
+
+    Raises:
+        ValueError: If a structured response was cut off before any of its
+            narrative, so there is nothing to show without the raw JSON
+    """
+    if structured:
+        parsed = _parse_structured(text)
+        if parsed is not None:
+            _count("structured")
+            return parsed
+        stats["structured_failed"] += 1
+        structured_failures.inc()
+        if _strip_fence(text).startswith('{'):
+            # Usually cut off at max_output_tokens; the JSON itself must never reach players
+            narrative = _partial_narrative(text)
+            if narrative is None:
+                raise ValueError("The structured response was cut off before its narrative")
+            _count("fallback")
+            return (format_segment(narrative, *DEFAULT_OPTIONS),) + DEFAULT_OPTIONS
+
+    lines = text.split('\n')
+    a_line = None
+    pair = None
+    for index, line in enumerate(lines):
+        match = _OPTION_LINE.match(line)
+        if match is None:
+            continue
+        if match.group(2) == 'A':
+            a_line = (index, match)
+        elif a_line is not None:
+            pair = (a_line, (index, match))
+            a_line = None
+
+    if pair is None:
+        # No usable options; treat the last paragraph as a malformed attempt at them
+        _count("fallback")
+        paragraphs = text.split('\n\n')
+        narrative = '\n\n'.join(paragraphs[:-1]) if len(paragraphs) > 1 else text
+        return (format_segment(narrative, *DEFAULT_OPTIONS),) + DEFAULT_OPTIONS
+
+    (a_index, a_match), (b_index, b_match) = pair
+    option_a = _option_text(a_match)
+    option_b = _option_text(b_match)
+
+    if a_match.group(1) and a_match.group(3) and b_match.group(1) and b_match.group(3):
+        # Already in the expected **A)** / **B)** form; keep the text exactly as generated
+        _count("bold")
+        return text, option_a, option_b
+
+    # Labels without bold formatting; rebuild the options in the expected form
+    _count("plain")
+    narrative = '\n'.join(lines[:a_index]).strip()
+    segment = format_segment(narrative, option_a, option_b)
+    trailing = '\n'.join(lines[b_index + 1:]).strip()
+    if trailing:
+        segment += f"\n\n{trailing}"
+    return segment, option_a, option_b
+
+def visible_text(text, structured=False):
+    """
+    The part of a response players would see, for measuring its length
+
+    Unlike parse_segment(), this counts nothing towards the tier stats.
+
+    Args:
+        text (str): The generated response
+        structured (bool): As for parse_segment()
+
+    Returns:
+        str: The laid-out segment of a structured response (or as much of
+            its narrative as arrived), otherwise the text itself
+    """
+    if not structured:
+        return text
+    parsed = _parse_structured(text)
+    if parsed is not None:
+        return parsed[0]
+    if _strip_fence(text).startswith('{'):
+        return _partial_narrative(text) or ""
+    return text
+
+def _option_text(match):
+    option = match.group(4).strip()
+    # "**A) Run**" - the bold opened before the label closes at the end of the line
+    if match.group(1) and not match.group(3) and option.endswith('**'):
+        option = option[:-2].rstrip()
+    return option
+
+def _strip_fence(text):
+    # Models sometimes wrap JSON in a ```json fence even when asked not to
+    body = text.strip()
+    if body.startswith('```'):
+        body = body.strip('`')
+        if body.startswith('json'):
+            body = body[4:]
+    return body.strip()
+
+def _partial_narrative(text):
+    # The narrative string from JSON that may stop anywhere, even inside the string or an escape
+    body = _strip_fence(text)
+    match = _NARRATIVE_KEY.search(body)
+    if match is None:
+        return None
+    start = match.end() - 1
+    try:
+        narrative, _ = json.JSONDecoder().raw_decode(body, start)
+    except ValueError:
+        rest = body[start + 1:]
+        # Drop an escape sequence that was cut short: a lone backslash or an incomplete \uXXXX
+        escape = re.search(r'(\\+)(u[0-9a-fA-F]{0,3})?$', rest)
+        if escape and len(escape.group(1)) % 2:
+            rest = rest[:escape.end(1) - 1]
+        try:
+            narrative = json.loads(f'"{rest}"')
+        except ValueError:
+            return None
+    narrative = narrative.strip() if isinstance(narrative, str) else ""
+    return narrative or None
+
+def _parse_structured(text):
+    body = _strip_fence(text)
+    try:
+        data = json.loads(body)
+        narrative = data["narrative"].strip()
+        option_a = data["option_a"].strip()
+        option_b = data["option_b"].strip()
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    if not (narrative and option_a and option_b):
+        return None
+    return format_segment(narrative, option_a, option_b), option_a, option_b
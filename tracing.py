@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import random
+import functools
+from contextvars import ContextVar
+
+# JSON Lines file each traced round is appended to; unset disables tracing
+TRACE_PATH = os.getenv('TRACE_PATH')
+
+# Share of rounds traced when TRACE_PATH is set
+TRACE_SAMPLE = float(os.getenv('TRACE_SAMPLE', '1.0'))
+
+# The round the running task belongs to; tasks started from it (e.g. hedged requests) inherit it
+_current = ContextVar('round_trace', default=None)
+
+_file = None
+
+class RoundTrace:
+    """
+    Timings of one story round, broken down into pipeline stages
+
+    Spans are recorded as offsets from the start of the round, flat and in
+    the order they finish; nested stages (a Discord send inside "send") can
+    be told apart by their offsets. Written as one JSON line when the round
+    finishes.
+    """
+
+    __slots__ = ('kind', 'channel_id', 'started', 'wall_started', 'spans', 'done')
+
+    def __init__(self, kind, channel_id):
+        self.kind = kind
+        self.channel_id = channel_id
+        self.started = time.monotonic()
+        self.wall_started = time.time()
+        self.spans = []
+        self.done = False
+
+    def add(self, name, started, duration):
+        """Record a stage that began at started (time.monotonic()) and took duration seconds"""
+        if not self.done:
+            self.spans.append((name, started - self.started, duration))
+
+    def to_dict(self, outcome):
+        return {
+            "ts": round(self.wall_started, 3),
+            "kind": self.kind,
+            "channel": self.channel_id,
+            "duration": round(time.monotonic() - self.started, 6),
+            "outcome": outcome,
+            "spans": [
+                {"name": name, "start": round(start, 6), "duration": round(duration, 6)}
+                for name, start, duration in self.spans
+            ],
+        }
+
+class _Span:
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.name, self.started, time.monotonic() - self.started)
+
+class _NoSpan:
+    # Shared stand-in when the round isn't traced, so an untraced span costs one lookup
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+def begin(kind, channel_id):
+    """
+    Start tracing a round in the current task, if tracing is on and it is sampled
+
+    Args:
+        kind (str): What the round is, e.g. "opener" or "continue"
+        channel_id (str): The story's channel
+
+    Returns:
+        The context token to pass to finish(), or None if the round isn't traced
+    """
+    if not TRACE_PATH or random.random() >= TRACE_SAMPLE:
+        return None
+    return _current.set(RoundTrace(kind, channel_id))
+
+def finish(token, outcome="ok"):
+    """
+    Write out the round started by begin()
+
+    Args:
+        token: What begin() returned
+        outcome (str): How the round ended, e.g. "ok", "ended" or "failed"
+    """
+    if token is None:
+        return
+    trace = _current.get()
+    _current.reset(token)
+    trace.done = True
+    try:
+        _write(trace.to_dict(outcome))
+    except OSError as e:
+        print(f"Failed to write round trace: {str(e)}")
+
+def span(name):
+    """
+    Time a stage of the current round
+
+    Args:
+        name (str): The stage, e.g. "tally" or "generate"
+
+    Returns:
+        A context manager; a shared no-op one when the round isn't traced
+    """
+    trace = _current.get()
+    return _NO_SPAN if trace is None else _Span(trace, name)
+
+def record(name, started, duration):
+    """Add a stage timed elsewhere (started is a time.monotonic() reading) to the current round"""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, started, duration)
+
+def traced(kind, channel_of):
+    """
+    Decorator tracing each call of an async round handler as one round
+
+    The outcome is "ok" when the handler returns True, "ended" when it
+    returns anything else and "failed" when it raises.
+
+    Args:
+        kind (str): What the rounds are
+        channel_of: Callable taking the handler's first argument and
+            returning the channel id
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(first, *args, **kwargs):
+            token = begin(kind, channel_of(first))
+            outcome = "failed"
+            try:
+                result = await function(first, *args, **kwargs)
+                outcome = "ok" if result is True else "ended"
+                return result
+            finally:
+                finish(token, outcome)
+        return wrapper
+    return decorate
+
+def _write(entry):
+    global _file
+    if _file is None:
+        _file = open(TRACE_PATH, 'a', encoding='utf-8')
+    # A round's line is a few hundred bytes, small enough to write straight from the event loop
+    _file.write(json.dumps(entry, separators=(',', ':')) + "\n")
+    _file.flush()
+
+def close():
+    """Close the trace file"""
+    global _file
+    if _file is not None:
+        _file.close()
+        _file = None
@@ -0,0 +1,105 @@
+# Live tallies for messages that are currently open for voting (message id -> VoteTally)
+active_tallies = {}
+
+class VoteTally:
+    """
+    Reactions on one voting message, kept up to date from gateway events
+
+    Every emoji maps to the set of user ids currently reacting with it, so the
+    result of a vote is available the moment it closes without any API calls.
+    A tally is marked stale if the gateway connection drops while it is open,
+    since events may have been missed; stale tallies should be reconciled by
+    fetching the message instead.
+    """
+
+    def __init__(self, message_id, channel_id, emoji_a, emoji_b):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.emoji_a = str(emoji_a)
+        self.emoji_b = str(emoji_b)
+        self.reactions = {}
+        self.stale = False
+
+    def add(self, emoji, user_id):
+        """Record that a user reacted with an emoji"""
+        self.reactions.setdefault(str(emoji), set()).add(user_id)
+
+    def remove(self, emoji, user_id):
+        """Record that a user removed their reaction"""
+        users = self.reactions.get(str(emoji))
+        if users is not None:
+            users.discard(user_id)
+
+    @property
+    def voters_a(self):
+        """User ids currently voting for option A"""
+        return self.reactions.get(self.emoji_a, set())
+
+    @property
+    def voters_b(self):
+        """User ids currently voting for option B"""
+        return self.reactions.get(self.emoji_b, set())
+
+    @property
+    def reactors(self):
+        """User ids with any reaction on the message, custom emojis included"""
+        return set().union(*self.reactions.values())
+
+    @property
+    def custom_reactions(self):
+        """Reaction counts for every emoji other than the two options"""
+        return {
+            emoji: len(users)
+            for emoji, users in self.reactions.items()
+            if users and emoji != self.emoji_a and emoji != self.emoji_b
+        }
+
+def open_tally(message, emoji_a, emoji_b):
+    """
+    Start tracking reactions on a voting message
+
+    Args:
+        message: The message users vote on
+        emoji_a (str): The emoji for option A
+        emoji_b (str): The emoji for option B
+
+    Returns:
+        VoteTally: The new tally
+    """
+    tally = VoteTally(message.id, message.channel.id, emoji_a, emoji_b)
+    active_tallies[message.id] = tally
+    return tally
+
+def close_tally(message_id):
+    """
+    Stop tracking a voting message
+
+    Args:
+        message_id (int): The voting message's id
+
+    Returns:
+        VoteTally: The final tally, or None if the message wasn't tracked
+    """
+    return active_tallies.pop(message_id, None)
+
+def close_channel(channel_id):
+    """Stop tracking every voting message in a channel"""
+    for message_id in [m for m, t in active_tallies.items() if t.channel_id == channel_id]:
+        del active_tallies[message_id]
+
+def record_add(message_id, emoji, user_id):
+    """Apply a reaction-add event to the matching tally, if any"""
+    tally = active_tallies.get(message_id)
+    if tally is not None:
+        tally.add(emoji, user_id)
+
+def record_remove(message_id, emoji, user_id):
+    """Apply a reaction-remove event to the matching tally, if any"""
+    tally = active_tallies.get(message_id)
+    if tally is not None:
+        tally.remove(emoji, user_id)
+
+def mark_all_stale():
+    """Flag every open tally as possibly missing events (e.g. after a disconnect)"""
+    for tally in active_tallies.values():
+        tally.stale = True
@@ -0,0 +1,92 @@
+import os
+import math
+import metrics
+
+# Close votes before the full window when the result is already clear
+EARLY_CLOSE = os.getenv('VOTE_EARLY_CLOSE', 'true').lower() == 'true'
+
+# Seconds every vote stays open, however clear the result, so nobody misses a round by blinking
+VOTE_MIN_DURATION = float(os.getenv('VOTE_MIN_DURATION', '10'))
+
+# Share of recent participants whose votes close the round
+VOTE_QUORUM = float(os.getenv('VOTE_QUORUM', '0.8'))
+
+# Seconds without a reaction, once someone has voted, after which the vote closes
+VOTE_IDLE_TIMEOUT = float(os.getenv('VOTE_IDLE_TIMEOUT', '20'))
+
+vote_seconds = metrics.histogram('storybot_vote_seconds', "How long votes stayed open, by why they closed",
+                                 buckets=(5, 10, 15, 20, 30, 45, 60, 90, 120), labels=("reason",))
+
+class VotingPolicy:
+    """
+    Decides when a vote can close, from its reactions so far
+
+    A vote closes at the hard maximum unless one of these comes first, and
+    never before the minimum:
+
+    - quorum: enough of the players from recent rounds have voted
+    - decided: one option leads by more than the recent players yet to vote
+      could make up (players changing their vote aren't counted)
+    - idle: someone has voted and nobody has reacted for a while
+
+    A vote nobody has reacted to always runs to the maximum, since an empty
+    vote ends the story.
+    """
+
+    def __init__(self, max_duration, min_duration=VOTE_MIN_DURATION, quorum=VOTE_QUORUM,
+                 idle_timeout=VOTE_IDLE_TIMEOUT):
+        """
+        Args:
+            max_duration (float): Seconds a vote may stay open
+            min_duration (float): Seconds a vote must stay open
+            quorum (float): Share of expected players whose votes close it (0 disables)
+            idle_timeout (float): Seconds of quiet after which it closes (0 disables)
+        """
+        self.max_duration = max_duration
+        self.min_duration = min(min_duration, max_duration)
+        self.quorum = quorum
+        self.idle_timeout = idle_timeout
+
+    def decide(self, voters_a, voters_b, reactors, expected, opened, last_reaction):
+        """
+        Work out when a vote should close, given its reactions so far
+
+        Args:
+            voters_a (set): User ids voting for option A
+            voters_b (set): User ids voting for option B
+            reactors (set): Everyone who has reacted at all, custom emojis included
+            expected (set): Players from recent rounds (empty for a new story)
+            opened (float): When the vote opened
+            last_reaction (float): When its reactions last changed
+
+        Returns:
+            tuple: When to close the vote (same clock as opened), and why:
+                "quorum", "decided", "idle" or "max"
+        """
+        earliest = opened + self.min_duration
+        latest = opened + self.max_duration
+        if not reactors:
+            return latest, "max"
+
+        if expected:
+            voted = voters_a | voters_b
+            if self.quorum and len(voted & expected) >= math.ceil(self.quorum * len(expected)):
+                return earliest, "quorum"
+            if abs(len(voters_a) - len(voters_b)) > len(expected - voted):
+                return earliest, "decided"
+
+        if self.idle_timeout and last_reaction + self.idle_timeout < latest:
+            return max(earliest, last_reaction + self.idle_timeout), "idle"
+        return latest, "max"
+
+def expected_players(participants):
+    """
+    The players a vote can expect to hear from
+
+    Args:
+        participants: Sets of voters from recent rounds
+
+    Returns:
+        set: Everyone who voted in any of them
+    """
+    return set().union(*participants)